@@ -0,0 +1,190 @@
+"""Benchmark creating the build context of 'docker' targets.
+
+Generates a synthetic repository in a pants `RuleRunner` with a
+`docker` target depending on N python sources, M third-party
+requirements & K resources, and measures the rules which create the
+image's Dockerfile & build context: everything `package` does before
+running docker, which is never run. For each repository size it
+records:
+
+- the wall-clock time taken to create the build context, & the
+  duration of each phase of it (see metrics.py)
+- the size (in bytes) & number of files of the build context
+- the number of layers the Dockerfile creates
+
+Each measurement uses a new `RuleRunner`, so nothing is memoized
+between them. Run with e.g.
+
+  python -m sendwave.pants_docker.benchmark --sources 100 1000 \\
+      --requirements 50 --resources 100 \\
+      --option=--sendwave-docker-layers=split
+
+to print one JSON object per repository size.
+"""
+import argparse
+import json
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pants.backend.python import register as python_backend
+from pants.core import register as core
+from pants.engine.addresses import Address
+from pants.engine.fs import Digest, DigestEntries, FileEntry
+from pants.testutil.rule_runner import QueryRule, RuleRunner
+from sendwave.pants_docker import register
+from sendwave.pants_docker.metrics import count_layers
+from sendwave.pants_docker.package import DockerBuildContext
+from sendwave.pants_docker.target import DockerPackageFieldSet
+
+# python sources & resources are spread over this many packages, each
+# with its own BUILD file
+PACKAGES = 10
+
+
+@dataclass(frozen=True)
+class BenchmarkResult:
+    """The measurements of creating one image's build context."""
+
+    sources: int
+    requirements: int
+    resources: int
+    seconds: float
+    phases: Dict[str, float]
+    context_bytes: int
+    context_files: int
+    layers: int
+
+
+def synthetic_repo(
+    sources: int, requirements: int, resources: int
+) -> Dict[str, str]:
+    """The files of a repository with a `docker` target at `app:image`.
+
+    The image depends on `sources` python files & `resources` resource
+    files spread over PACKAGES packages under `src/`, and on
+    `requirements` python requirements in `3rdparty/`.
+    """
+    files = {}
+    dependencies = []
+    for source in range(sources):
+        package = source % PACKAGES
+        files[f"src/pkg{package}/module{source}.py"] = (
+            f"VALUE = {source}\n" * 10
+        )
+    for resource in range(resources):
+        package = resource % PACKAGES
+        files[f"src/pkg{package}/resource{resource}.txt"] = "data\n" * 10
+    for package in range(PACKAGES):
+        build = []
+        if package < sources:
+            build.append("python_sources()\n")
+            dependencies.append(f"src/pkg{package}")
+        if package < resources:
+            build.append("resources(name='resources', sources=['*.txt'])\n")
+            dependencies.append(f"src/pkg{package}:resources")
+        if build:
+            files[f"src/pkg{package}/BUILD"] = "".join(build)
+    files["3rdparty/BUILD"] = "".join(
+        f"python_requirement(name='req{r}', requirements=['req{r}==1.0'])\n"
+        for r in range(requirements)
+    )
+    dependencies.extend(f"3rdparty:req{r}" for r in range(requirements))
+    files["app/BUILD"] = (
+        "docker(\n"
+        "    name='image',\n"
+        "    base_image='python:3.8-slim',\n"
+        f"    dependencies={json.dumps(dependencies)},\n"
+        ")\n"
+    )
+    return files
+
+
+def benchmark_runner() -> RuleRunner:
+    """A RuleRunner with every rule & target type the plugin needs."""
+    return RuleRunner(
+        target_types=[
+            *core.target_types(),
+            *python_backend.target_types(),
+            *register.target_types(),
+        ],
+        rules=[
+            *core.rules(),
+            *python_backend.rules(),
+            *register.rules(),
+            QueryRule(DockerBuildContext, [DockerPackageFieldSet]),
+            QueryRule(DigestEntries, [Digest]),
+        ],
+    )
+
+
+def run_benchmark(
+    sources: int,
+    requirements: int,
+    resources: int,
+    options: Iterable[str] = (),
+) -> BenchmarkResult:
+    """Measure creating the build context of a synthetic repository."""
+    rule_runner = benchmark_runner()
+    rule_runner.write_files(synthetic_repo(sources, requirements, resources))
+    rule_runner.set_options(list(options))
+    target = rule_runner.get_target(Address("app", target_name="image"))
+    start = time.monotonic()
+    context = rule_runner.request(
+        DockerBuildContext, [DockerPackageFieldSet.create(target)]
+    )
+    seconds = time.monotonic() - start
+    entries = rule_runner.request(DigestEntries, [context.digest])
+    files = [entry for entry in entries if isinstance(entry, FileEntry)]
+    return BenchmarkResult(
+        sources=sources,
+        requirements=requirements,
+        resources=resources,
+        seconds=round(seconds, 3),
+        phases=dict(context.timings),
+        context_bytes=sum(
+            entry.file_digest.serialized_bytes_length for entry in files
+        ),
+        context_files=len(files),
+        layers=count_layers(context.dockerfile),
+    )
+
+
+def _sizes(
+    sources: Sequence[int],
+    requirements: Sequence[int],
+    resources: Sequence[int],
+) -> List[Tuple[int, int, int]]:
+    """Every combination of the requested repository sizes."""
+    return [(n, m, k) for n in sources for m in requirements for k in resources]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--sources", type=int, nargs="+", default=[100])
+    parser.add_argument("--requirements", type=int, nargs="+", default=[10])
+    parser.add_argument("--resources", type=int, nargs="+", default=[10])
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        help=(
+            "a pants option to set, "
+            "e.g. --option=--sendwave-docker-layers=split"
+        ),
+    )
+    args = parser.parse_args(argv)
+    for sources, requirements, resources in _sizes(
+        args.sources, args.requirements, args.resources
+    ):
+        result = run_benchmark(sources, requirements, resources, args.option)
+        print(json.dumps(asdict(result), sort_keys=True), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
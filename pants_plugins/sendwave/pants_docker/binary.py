@@ -0,0 +1,145 @@
+"""Locate the docker executable & the environment needed to run it."""
+import logging
+import os
+import pkgutil
+from dataclasses import dataclass
+from typing import Iterable, Mapping, Optional, Tuple
+
+import sendwave.pants_docker.utils as utils
+from pants.core.util_rules.system_binaries import (
+    BinaryPathRequest,
+    BinaryPaths,
+    PythonBinary,
+)
+from pants.engine.environment import Environment, EnvironmentRequest
+from pants.engine.fs import EMPTY_DIGEST, Digest
+from pants.engine.process import Process, ProcessCacheScope
+from pants.engine.rules import Get, MultiGet, collect_rules, rule
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PATH = ("/bin", "/usr/bin", "/usr/local/bin", "$HOME/")
+
+# pants named cache (shared by every process sandbox) holding the lock
+# files which limit the number of concurrent builds, & streamed logs
+CACHE_NAME = "sendwave_docker"
+CACHE_DIR = ".sendwave_docker"
+LOCK_DIR = f"{CACHE_DIR}/slots"
+LOG_DIR = f"{CACHE_DIR}/logs"
+# number of lines of output kept from a build streamed to a log file
+OUTPUT_TAIL_LINES = 200
+
+
+def log_path(named_caches_dir: str, log_file: str) -> str:
+    """The path, outside of any sandbox, of a log file streamed to."""
+    return os.path.join(named_caches_dir, CACHE_NAME, "logs", log_file)
+
+
+@dataclass(frozen=True)
+class DockerBinary:
+    """The docker CLI, and the environment variables used to reach the
+    docker daemon.
+
+    `python` is used to run builds which are limited to a number of
+    concurrent slots, or stream their output (see
+    scripts/run_docker.py).
+    """
+
+    path: str
+    env: Environment
+    python: str
+
+    def wrap(
+        self,
+        argv: Iterable[str],
+        slots: int = 0,
+        log_file: Optional[str] = None,
+    ) -> Tuple[str, ...]:
+        """Wrap `argv` to run while holding one of `slots` slots, and
+        stream its output to `log_file` (relative to LOG_DIR).
+
+        Processes running the returned argv must have the CACHE_NAME
+        named cache.
+        """
+        runner = pkgutil.get_data(
+            "sendwave.pants_docker.scripts", "run_docker.py"
+        )
+        stream_args: Tuple[str, ...] = ()
+        if log_file:
+            stream_args = (
+                "--log-file",
+                f"{LOG_DIR}/{log_file}",
+                "--tail",
+                str(OUTPUT_TAIL_LINES),
+            )
+        return (
+            self.python,
+            "-c",
+            runner.decode("utf-8"),
+            "--slots",
+            str(slots),
+            "--lock-dir",
+            LOCK_DIR,
+            *stream_args,
+            "--",
+            *argv,
+        )
+
+    def process(
+        self,
+        args: Iterable[str],
+        description: str,
+        input_digest: Digest = EMPTY_DIGEST,
+        cache_scope: ProcessCacheScope = ProcessCacheScope.PER_SESSION,
+        output_files: Optional[Iterable[str]] = None,
+        extra_env: Optional[Mapping[str, str]] = None,
+        slots: int = 0,
+        log_file: Optional[str] = None,
+    ) -> Process:
+        """Build a Process running `docker {args}`.
+
+        The state of the docker daemon is not tracked by pants, so by
+        default the result is only cached for the current pants run.
+        With `slots` at most that many processes run at once, with
+        `log_file` output is streamed to that file as it is written.
+        """
+        argv: Tuple[str, ...] = (self.path, *args)
+        wrapped = bool(slots or log_file)
+        if wrapped:
+            argv = self.wrap(argv, slots, log_file)
+        return Process(
+            env={**self.env, **(extra_env or {})},
+            argv=argv,
+            input_digest=input_digest,
+            description=description,
+            cache_scope=cache_scope,
+            output_files=output_files,
+            append_only_caches={CACHE_NAME: CACHE_DIR} if wrapped else None,
+        )
+
+
+@rule
+async def find_docker(python: PythonBinary) -> DockerBinary:
+    # fetch docker connection enviornment variables and the location
+    # of the docker process
+    docker_env, docker_paths = await MultiGet(
+        Get(Environment, EnvironmentRequest(utils.DOCKER_ENV_VARS)),
+        Get(
+            BinaryPaths,
+            BinaryPathRequest(
+                binary_name="docker",
+                search_path=SEARCH_PATH,
+            ),
+        ),
+    )
+    if not docker_paths.first_path:
+        raise ValueError(
+            "Unable to locate Docker binary on paths: {}".format(SEARCH_PATH)
+        )
+    return DockerBinary(docker_paths.first_path.path, docker_env, python.path)
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
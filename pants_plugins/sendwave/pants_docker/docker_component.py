@@ -1,8 +1,10 @@
 import logging
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import Tuple
+from typing import Dict, Iterable, List, Optional, Tuple, Type
 
 from pants.engine.fs import Digest
+from pants.engine.target import Field, FieldSet, Target
 from pants.engine.unions import union
 
 logger = logging.getLogger(__name__)
@@ -18,3 +20,38 @@ class DockerComponent:
 @union
 class DockerComponentFieldSet:
     pass
+
+
+def applicable_field_sets(
+    field_set_types: Iterable[Type[FieldSet]], targets: Iterable[Target]
+) -> Dict[Type[FieldSet], List[Target]]:
+    """Find the targets each field set type applies to.
+
+    Field set types are indexed by their first required field, so each
+    target is only checked against the field set types requiring one of
+    its fields rather than against every registered type. The result
+    is ordered like `field_set_types`, & each list like `targets`.
+    """
+    field_set_types = list(field_set_types)
+    index: Dict[Optional[Type[Field]], List[Type[FieldSet]]] = defaultdict(list)
+    for field_set_type in field_set_types:
+        required = field_set_type.required_fields
+        index[required[0] if required else None].append(field_set_type)
+    applicable = defaultdict(list)
+    for target in targets:
+        # a target has a field when it has a subclass of it
+        candidates = {
+            field_set_type
+            for field_type in target.field_types
+            for base in field_type.__mro__
+            for field_set_type in index.get(base, ())
+        }
+        candidates.update(index.get(None, ()))
+        for field_set_type in candidates:
+            if field_set_type.is_applicable(target):
+                applicable[field_set_type].append(target)
+    return {
+        field_set_type: applicable[field_set_type]
+        for field_set_type in field_set_types
+        if field_set_type in applicable
+    }
@@ -0,0 +1,55 @@
+"""Exclude files from the build context of an image.
+
+Patterns in a target's `docker_ignore` field use the syntax of a
+.dockerignore file, and are matched against the paths files have in
+the image (relative to the working directory), e.g. `app/fixtures` or
+`**/*.md`. They are applied to the sources & resources of an image
+before the build context is created, so ignored files are never sent to
+the docker daemon. Exceptions (lines starting with `!`) are not
+supported.
+
+The `--sendwave-docker-exclude-tests` and
+`--sendwave-docker-exclude-bytecode` options add built-in patterns
+for python test files & compiled bytecode.
+"""
+from typing import Iterable, List
+
+from pants.engine.fs import PathGlobs
+
+# the default `sources` of `python_tests` & `python_test_utils` targets
+TEST_PATTERNS = (
+    "**/test_*.py",
+    "**/*_test.py",
+    "**/tests.py",
+    "**/conftest.py",
+)
+BYTECODE_PATTERNS = ("**/__pycache__", "**/*.pyc", "**/*.pyo")
+
+
+def ignore_globs(patterns: Iterable[str]) -> List[str]:
+    """Convert .dockerignore patterns into pants exclude globs.
+
+    A pattern matching a directory excludes everything in it, so each
+    pattern excludes both the paths it matches & their contents.
+    """
+    globs = []
+    for line in patterns:
+        pattern = line.strip()
+        if not pattern or pattern.startswith("#"):
+            continue
+        if pattern.startswith("!"):
+            raise ValueError(
+                "Exceptions are not supported in `docker_ignore`: "
+                "{}".format(pattern)
+            )
+        while pattern.startswith(("./", "/")):
+            pattern = pattern[1:] if pattern[0] == "/" else pattern[2:]
+        pattern = pattern.rstrip("/")
+        if pattern:
+            globs.extend(["!{}".format(pattern), "!{}/**".format(pattern)])
+    return globs
+
+
+def ignore_path_globs(patterns: Iterable[str]) -> PathGlobs:
+    """Build PathGlobs matching every file not matched by `patterns`."""
+    return PathGlobs(["**/*", *ignore_globs(patterns)])
@@ -0,0 +1,207 @@
+"""Rebuild images by adding a thin layer of changed sources to them.
+
+With `--sendwave-docker-incremental` the build context of an image also
+records:
+
+- the files the image copies into its working directory (the
+  contents of every directory of the build context copied by a COPY
+  instruction), and
+- the image's "recipe": a fingerprint of its Dockerfile without those
+  COPY instructions, and of the files used to install its third-party
+  requirements.
+
+Before running `docker build`, scripts/thin_layer.py looks up the last
+image built from the target. If it was built from the same recipe
+(i.e. only python sources, resources or files changed) the new image is
+built `FROM` it, adding one layer with the changed files & removing the
+deleted ones, which takes a fraction of the time of a full build.
+Otherwise the image is built from its Dockerfile as usual, and then
+recorded as the image to build the next one from. After
+`--sendwave-docker-max-thin-layers` thin layers the image is built in
+full again, so images don't accumulate ever more layers of stale files.
+"""
+import logging
+import pkgutil
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import sendwave.pants_docker.utils as utils
+from pants.engine.addresses import Address
+from pants.engine.fs import AddPrefix, Digest
+from pants.engine.process import (
+    FallibleProcessResult,
+    Process,
+    ProcessCacheScope,
+    ProcessResult,
+)
+from pants.engine.rules import Get, collect_rules, rule
+from sendwave.pants_docker.binary import CACHE_DIR, CACHE_NAME, DockerBinary
+from sendwave.pants_docker.subsystem import Docker
+
+logger = logging.getLogger(__name__)
+
+# the last image built from each target, in the CACHE_NAME named cache
+RECORD_DIR = f"{CACHE_DIR}/builds"
+# where the files copied into the image are staged in the sandbox
+FILES_DIR = "image_files"
+# exit code of scripts/thin_layer.py when the image has to be built from
+# its Dockerfile
+FULL_BUILD = 3
+
+
+def record_path(address: Address) -> str:
+    """The path of the record of the last image built from a target."""
+    return f"{RECORD_DIR}/{address.path_safe_spec}.json"
+
+
+def _thin_layer_argv(
+    docker_binary: DockerBinary, command: str, address: Address, recipe: str
+) -> Tuple[str, ...]:
+    script = pkgutil.get_data("sendwave.pants_docker.scripts", "thin_layer.py")
+    assert script is not None
+    return (
+        docker_binary.python,
+        "-c",
+        script.decode("utf-8"),
+        command,
+        "--record",
+        record_path(address),
+        "--recipe",
+        recipe,
+        "--files",
+        FILES_DIR,
+        "--docker",
+        docker_binary.path,
+    )
+
+
+@dataclass(frozen=True)
+class ThinLayerRequest:
+    """Build an image from the last image built from the same target.
+
+    files: the files the image copies into its working directory
+    recipe: the fingerprint of every other input of the image
+    plain_progress: if true, `docker build` prints plain progress output
+    log_file: the log file build output is streamed to, if any
+    """
+
+    address: Address
+    files: Digest
+    recipe: str
+    tags: Tuple[str, ...]
+    fingerprint: str
+    compile_sources: bool
+    plain_progress: bool = False
+    log_file: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class ThinLayerResult:
+    """Whether the image was built by adding a thin layer, & the output
+    of building it."""
+
+    built: bool
+    output: str = ""
+
+
+@rule
+async def build_thin_layer(
+    request: ThinLayerRequest, docker: Docker, docker_binary: DockerBinary
+) -> ThinLayerResult:
+    """Add the changed files to the last image built from the target,
+    if it was built from the same recipe."""
+    files = await Get(Digest, AddPrefix(request.files, FILES_DIR))
+    argv = _thin_layer_argv(
+        docker_binary, "build", request.address, request.recipe
+    )
+    for tag in request.tags:
+        argv += ("--tag", tag)
+    argv += (
+        "--label",
+        f"{utils.FINGERPRINT_LABEL}={request.fingerprint}",
+        "--max-layers",
+        str(docker.options.max_thin_layers),
+    )
+    if request.compile_sources:
+        argv += ("--compile",)
+    if request.plain_progress:
+        argv += ("--progress", "plain")
+    # the thin layer is built by `docker build`, so it holds one of the
+    # same slots & streams its output like a full build, & its output is
+    # merged into stdout in the order it was written
+    argv = docker_binary.wrap(
+        argv, docker.options.build_concurrency, request.log_file
+    )
+    result = await Get(
+        FallibleProcessResult,
+        Process(
+            argv=argv,
+            env=docker_binary.env,
+            input_digest=files,
+            description=(
+                f"Adding changed files to the last image of {request.address}"
+            ),
+            cache_scope=ProcessCacheScope.PER_SESSION,
+            append_only_caches={CACHE_NAME: CACHE_DIR},
+        ),
+    )
+    output = result.stdout.decode(errors="replace").strip()
+    if result.exit_code == FULL_BUILD:
+        logger.info("Building %s in full: %s", request.address, output)
+        return ThinLayerResult(False)
+    if result.exit_code != 0:
+        logger.warning(
+            "Adding changed files to the last image of %s failed, building "
+            "it in full: %s",
+            request.address,
+            output,
+        )
+        return ThinLayerResult(False)
+    logger.info(output.splitlines()[-1] if output else "")
+    return ThinLayerResult(True, output)
+
+
+@dataclass(frozen=True)
+class RecordBuildRequest:
+    """Record an image built in full as the last image of a target."""
+
+    address: Address
+    files: Digest
+    recipe: str
+    image: str
+
+
+@dataclass(frozen=True)
+class RecordedBuild:
+    pass
+
+
+@rule
+async def record_build(
+    request: RecordBuildRequest, docker_binary: DockerBinary
+) -> RecordedBuild:
+    files = await Get(Digest, AddPrefix(request.files, FILES_DIR))
+    await Get(
+        ProcessResult,
+        Process(
+            argv=(
+                *_thin_layer_argv(
+                    docker_binary, "record", request.address, request.recipe
+                ),
+                "--image",
+                request.image,
+            ),
+            env=docker_binary.env,
+            input_digest=files,
+            description=f"Recording the image built from {request.address}",
+            cache_scope=ProcessCacheScope.PER_SESSION,
+            append_only_caches={CACHE_NAME: CACHE_DIR},
+        ),
+    )
+    return RecordedBuild()
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
@@ -0,0 +1,226 @@
+"""Arrange the files of a docker build context into image layers.
+
+Every directory in the returned build context is copied into the
+image by its own `COPY` instruction. Docker caches (and registries
+store) each of those layers independently, so the way files are
+grouped into directories controls how much of an image has to be
+rebuilt & re-pushed when a file changes.
+
+With the 'single' strategy all files are copied into the image at
+once from the `application` directory.
+
+With the 'split' strategy files are copied in order of how often they
+are expected to change:
+
+1. `application`: the files used to install third-party dependencies
+   (e.g. the constraints file). Commands emitted by DockerComponents
+   refer to these files as `application/{path}`, so they keep that
+   location.
+2. `layers/resources`: the contents of `resources`, `files` and
+   `relocated_files` targets.
+3. `layers/python/{package}`: first-party python sources, one layer
+   per top-level package, with any top-level modules copied from
+   `layers/python_modules`.
+
+With the 'content' strategy third-party files are copied from
+`application` as with 'split', then the resources & python sources of
+each group (the directory of the BUILD file of the targets which own
+them) are copied from `layers/content/{fingerprint}`, named after the
+digest of the group's files. The layer of a library is then the same
+in every image which depends on it, no matter what else is in the
+image.
+
+Files staged in `layers/venv` (a PEX of third-party requirements built
+by pants) are added to the build context with either strategy, but are
+never copied into the image's working directory: the component which
+created them installs them itself.
+"""
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from pants.engine.fs import (
+    EMPTY_DIGEST,
+    AddPrefix,
+    Digest,
+    DigestSubset,
+    MergeDigests,
+    PathGlobs,
+    Snapshot,
+)
+from pants.engine.rules import Get, MultiGet, collect_rules, rule
+from sendwave.pants_docker.subsystem import LayerStrategy
+
+logger = logging.getLogger(__name__)
+
+APPLICATION_DIR = "application"
+RESOURCES_DIR = "layers/resources"
+PYTHON_PACKAGES_DIR = "layers/python"
+PYTHON_MODULES_DIR = "layers/python_modules"
+VIRTUAL_ENV_DIR = "layers/venv"
+CONTENT_DIR = "layers/content"
+
+
+@dataclass(frozen=True)
+class ContextLayersRequest:
+    """The source files of an image, grouped by the kind of component.
+
+    third_party: files used when installing third-party dependencies
+    resources: files, resources & relocated files
+    python_sources: first-party python source files
+    virtual_env: files staged for a component to install itself
+    resource_groups & python_groups: the group of each digest in
+        `resources` & `python_sources`, used by the 'content' strategy
+    """
+
+    strategy: LayerStrategy
+    third_party: Tuple[Digest, ...]
+    resources: Tuple[Digest, ...]
+    python_sources: Tuple[Digest, ...]
+    virtual_env: Tuple[Digest, ...] = ()
+    resource_groups: Tuple[str, ...] = ()
+    python_groups: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class ContextLayers:
+    """Source files laid out in a docker build context.
+
+    Each entry of `directories` is a directory in `digest` which
+    should be copied into the image by its own `COPY` instruction, in
+    order. `origins` describes the files in each directory.
+    """
+
+    digest: Digest
+    directories: Tuple[str, ...]
+    origins: Tuple[str, ...] = ()
+
+
+def _shard_by_package(files: Iterable[str]) -> Dict[str, List[str]]:
+    """Group source file paths by the context directory they belong in.
+
+    Files are grouped by their top-level package, files which are not
+    in a package at all are grouped together.
+    """
+    shards = defaultdict(list)
+    for path in sorted(files):
+        package, sep, _ = path.partition("/")
+        if sep:
+            shards[f"{PYTHON_PACKAGES_DIR}/{package}"].append(path)
+        else:
+            shards[PYTHON_MODULES_DIR].append(path)
+    return dict(sorted(shards.items()))
+
+
+def _group_digests(
+    digests: Iterable[Digest], groups: Iterable[str]
+) -> Dict[str, List[Digest]]:
+    """Group digests by name, ordered by the name of the group."""
+    grouped = defaultdict(list)
+    for digest, group in zip(digests, groups):
+        grouped[group].append(digest)
+    return dict(sorted(grouped.items()))
+
+
+@rule
+async def create_context_layers(
+    request: ContextLayersRequest,
+) -> ContextLayers:
+    """Lay out source files in the build context per the layer strategy."""
+    virtual_env = await Get(Digest, MergeDigests(request.virtual_env))
+    staged_digest = await Get(Digest, AddPrefix(virtual_env, VIRTUAL_ENV_DIR))
+    if request.strategy == LayerStrategy.single:
+        source_digest = await Get(
+            Digest,
+            MergeDigests(
+                [
+                    *request.third_party,
+                    *request.resources,
+                    *request.python_sources,
+                ]
+            ),
+        )
+        application_digest = await Get(
+            Digest, AddPrefix(source_digest, APPLICATION_DIR)
+        )
+        context_digest = await Get(
+            Digest, MergeDigests([application_digest, staged_digest])
+        )
+        return ContextLayers(
+            context_digest,
+            (APPLICATION_DIR,),
+            ("sources & third-party files",),
+        )
+
+    if request.strategy == LayerStrategy.content:
+        groups = _group_digests(
+            [*request.resources, *request.python_sources],
+            [*request.resource_groups, *request.python_groups],
+        )
+        third_party = await Get(Digest, MergeDigests(request.third_party))
+        group_digests = await MultiGet(
+            Get(Digest, MergeDigests(digests)) for digests in groups.values()
+        )
+        # groups with the same files are the same layer
+        group_names = defaultdict(list)
+        for group, digest in zip(groups, group_digests):
+            group_names[digest].append(group or "//")
+        layers = [
+            (APPLICATION_DIR, third_party, "third-party files"),
+            *(
+                (
+                    f"{CONTENT_DIR}/{digest.fingerprint}",
+                    digest,
+                    "sources of {}".format(", ".join(names)),
+                )
+                for digest, names in group_names.items()
+            ),
+        ]
+    else:
+        third_party, resources, python_digest = await MultiGet(
+            Get(Digest, MergeDigests(request.third_party)),
+            Get(Digest, MergeDigests(request.resources)),
+            Get(Digest, MergeDigests(request.python_sources)),
+        )
+        python_sources = await Get(Snapshot, Digest, python_digest)
+        shards = _shard_by_package(python_sources.files)
+        shard_digests = await MultiGet(
+            Get(Digest, DigestSubset(python_sources.digest, PathGlobs(files)))
+            for files in shards.values()
+        )
+        layers = [
+            (APPLICATION_DIR, third_party, "third-party files"),
+            (RESOURCES_DIR, resources, "resources & files"),
+            *(
+                (
+                    shard,
+                    digest,
+                    "python package {}".format(shard.rpartition("/")[2])
+                    if shard != PYTHON_MODULES_DIR
+                    else "top-level python modules",
+                )
+                for shard, digest in zip(shards.keys(), shard_digests)
+            ),
+        ]
+    layers = [layer for layer in layers if layer[1] != EMPTY_DIGEST]
+    logger.debug(
+        "Split build context into layers %s", [p for p, _, _ in layers]
+    )
+    prefixed_digests = await MultiGet(
+        Get(Digest, AddPrefix(digest, path)) for path, digest, _ in layers
+    )
+    context_digest = await Get(
+        Digest, MergeDigests([*prefixed_digests, staged_digest])
+    )
+    return ContextLayers(
+        context_digest,
+        tuple(path for path, _, _ in layers),
+        tuple(origin for _, _, origin in layers),
+    )
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
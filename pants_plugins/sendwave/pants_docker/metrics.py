@@ -0,0 +1,102 @@
+"""Measure where the time building an image goes.
+
+With `--sendwave-docker-metrics` a JSON report is written next to each
+package's output (under dist/) recording:
+
+- the wall-clock duration of each phase of the build: resolving the
+  target's transitive dependencies, creating DockerComponents, laying
+  out & merging the build context, building a shared base image and
+  running `docker build` (or adding a thin layer to the last image, see
+  incremental.py)
+- the size (in bytes) & number of files of the build context
+- the number of layers the Dockerfile creates
+- the duration of each step of the build, parsed from the `--progress
+  plain` output of BuildKit
+
+Durations are measured inside pants rules, so a phase whose result was
+memoized or cached by pants is recorded as (close to) zero.
+"""
+import json
+import re
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+# Dockerfile instructions which add a layer to the image
+LAYER_INSTRUCTIONS = ("RUN", "COPY", "ADD")
+
+# `--progress plain` output of BuildKit, e.g.
+#   #7 [3/5] RUN python -m pip install flask
+#   #7 DONE 12.4s
+#   #8 CACHED
+STEP_START = re.compile(r"^#(\d+) \[[^\]]+\] (.+)$")
+STEP_DONE = re.compile(r"^#(\d+) DONE (\d+(?:\.\d+)?)s$")
+STEP_CACHED = re.compile(r"^#(\d+) CACHED$")
+
+
+class PhaseTimer:
+    """Record the wall-clock duration of consecutive phases of a rule."""
+
+    def __init__(self) -> None:
+        self._start = time.monotonic()
+        self._durations: Dict[str, float] = {}
+
+    def lap(self, phase: str) -> None:
+        """End the current phase, naming it `phase`."""
+        now = time.monotonic()
+        self._durations[phase] = round(now - self._start, 3)
+        self._start = now
+
+    def durations(self) -> Tuple[Tuple[str, float], ...]:
+        return tuple(self._durations.items())
+
+
+def count_layers(dockerfile: str) -> int:
+    """Count the instructions in a Dockerfile which create a layer."""
+    return sum(
+        1
+        for line in dockerfile.splitlines()
+        if line.split(" ", 1)[0].upper() in LAYER_INSTRUCTIONS
+    )
+
+
+def parse_build_steps(output: str) -> List[Dict[str, Any]]:
+    """Parse the duration of each step from `--progress plain` output.
+
+    Steps are returned in the order they started, each with the
+    instruction it ran, its duration in seconds (None if it never
+    finished) & whether it was cached.
+    """
+    steps: Dict[str, Dict[str, Any]] = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if match := STEP_START.match(line):
+            steps.setdefault(
+                match.group(1),
+                {"step": match.group(2), "seconds": None, "cached": False},
+            )
+        elif (match := STEP_DONE.match(line)) and match.group(1) in steps:
+            steps[match.group(1)]["seconds"] = float(match.group(2))
+        elif (match := STEP_CACHED.match(line)) and match.group(1) in steps:
+            steps[match.group(1)]["cached"] = True
+    return list(steps.values())
+
+
+def build_report(
+    target: str,
+    fingerprint: str,
+    phases: Iterable[Tuple[str, float]],
+    context_bytes: int,
+    context_files: int,
+    dockerfile: str,
+    build_output: str,
+) -> bytes:
+    """Serialize the metrics of one image build as JSON."""
+    report = {
+        "target": target,
+        "fingerprint": fingerprint,
+        "phases": dict(phases),
+        "context": {"bytes": context_bytes, "files": context_files},
+        "layers": count_layers(dockerfile),
+        "steps": parse_build_steps(build_output),
+    }
+    return json.dumps(report, indent=2, sort_keys=True).encode("utf-8")
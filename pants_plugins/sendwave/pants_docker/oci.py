@@ -0,0 +1,120 @@
+"""Build images without a docker daemon.
+
+The 'oci' backend assembles an image from the generated Dockerfile &
+build context in pure python (see scripts/oci_builder.py), on top of a
+base image read from an OCI image layout in the repository. The result
+is written as an OCI image tarball, which can be loaded with `docker
+load` and is cached by pants like the output of any other process.
+
+Only Dockerfile instructions which don't need a running container are
+supported, so images with `image_setup_commands` or third-party
+requirements installed with pip can't be built with this backend.
+"""
+import itertools
+import logging
+import pkgutil
+from dataclasses import dataclass
+from typing import Tuple
+
+from pants.core.goals.package import BuiltPackage, BuiltPackageArtifact
+from pants.core.util_rules.system_binaries import PythonBinary
+from pants.engine.fs import (
+    AddPrefix,
+    CreateDigest,
+    Digest,
+    FileContent,
+    GlobMatchErrorBehavior,
+    MergeDigests,
+    PathGlobs,
+)
+from pants.engine.process import Process, ProcessResult
+from pants.engine.rules import Get, MultiGet, collect_rules, rule
+from sendwave.pants_docker.subsystem import Docker
+
+logger = logging.getLogger(__name__)
+
+BUILDER_SCRIPT = "__oci_builder.py"
+CONTEXT_DIR = "__context"
+
+
+@dataclass(frozen=True)
+class OciImageRequest:
+    """Assemble an image from a build context into an OCI tarball.
+
+    context: the build context, including the Dockerfile
+    tags: references the image is tagged with in the tarball
+    output_path: where to write the tarball
+    """
+
+    context: Digest
+    tags: Tuple[str, ...]
+    output_path: str
+    target_name: str
+
+
+@rule
+async def build_oci_image(
+    request: OciImageRequest, docker: Docker, python: PythonBinary
+) -> BuiltPackage:
+    layout_dir = (docker.options.oci_layout or "").rstrip("/")
+    if not layout_dir:
+        raise ValueError(
+            "The option `--sendwave-docker-oci-layout` must be set to build "
+            "images with the 'oci' backend"
+        )
+    script = pkgutil.get_data("sendwave.pants_docker.scripts", "oci_builder.py")
+    assert script is not None
+    layout, script_digest, context = await MultiGet(
+        Get(
+            Digest,
+            PathGlobs(
+                [f"{layout_dir}/**"],
+                glob_match_error_behavior=GlobMatchErrorBehavior.error,
+                description_of_origin="the option `--sendwave-docker-oci-layout`",
+            ),
+        ),
+        Get(Digest, CreateDigest([FileContent(BUILDER_SCRIPT, script)])),
+        Get(Digest, AddPrefix(request.context, CONTEXT_DIR)),
+    )
+    input_digest = await Get(
+        Digest, MergeDigests([layout, script_digest, context])
+    )
+    argv = [
+        python.path,
+        BUILDER_SCRIPT,
+        "--context",
+        CONTEXT_DIR,
+        "--base-layout",
+        layout_dir,
+        "--output",
+        request.output_path,
+        "--platform",
+        docker.options.oci_platform,
+        *(
+            ("--source-date-epoch", str(docker.options.source_date_epoch))
+            if docker.options.reproducible
+            else ()
+        ),
+        *itertools.chain(*(("--tag", tag) for tag in request.tags)),
+    ]
+    process_result = await Get(
+        ProcessResult,
+        Process(
+            argv=argv,
+            input_digest=input_digest,
+            output_files=(request.output_path,),
+            description=f"Assembling OCI image from {request.target_name}",
+        ),
+    )
+    if docker.options.report_progress:
+        logger.info(process_result.stdout.decode())
+    return BuiltPackage(
+        digest=process_result.output_digest,
+        artifacts=(BuiltPackageArtifact(request.output_path),),
+    )
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
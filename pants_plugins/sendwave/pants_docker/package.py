@@ -10,52 +10,179 @@ which has both: files, to be included in the docker build context and
 component has an 'order' attribute which controls when it executes
 relative to other docker components.
 
+Dependencies are matched to the DockerComponentFieldSets which apply
+to them in a single pass (see docker_component.py), and the source
+files of python sources, resources & files are hydrated in one batched
+request rather than one per target.
+
 An implicit command is generated to copy all files in the docker
-component into the built image Once all files have been merged into a
+component into the built image (see layers.py for how files are split
+across COPY instructions). Once all files have been merged into a
 digest and the Dockerfile generated, we shell out to docker in order
-to actually build the image.
+to actually build the image. Alternatively, with the 'oci' backend the
+image is assembled without a docker daemon (see oci.py).
 
 The resulting image is then tagged if any tags were configured as part
-of the build target definition.
+of the build target definition, and when
+`--sendwave-docker-export-image` is set, written to the target's output
+path as a tarball. Every image is labelled with a fingerprint of its
+Dockerfile & build context, when `--sendwave-docker-skip-unchanged` is
+set and an image with a matching fingerprint already exists the build
+is skipped & that image is tagged instead. With
+`--sendwave-docker-pin-base-images` the base images are pinned to
+digests in the Dockerfile (see pinning.py). With
+`--sendwave-docker-metrics` a report of the time spent in each phase of
+the build is written alongside the package's output (see metrics.py).
+With `--sendwave-docker-size-report` a report of the size of each layer
+of the image, & which part of the target added it, is written too (see
+size_report.py).
+
+Files matching the target's `docker_ignore` patterns are removed from
+the build context before it is created (see ignore.py).
+
+With `--sendwave-docker-share-base-images` the base image, setup
+commands & third-party requirements of an image are built as a
+separate intermediate image, which every image with the same inputs is
+then built from. When a target has a `builder_image`, setup commands &
+third-party requirements are instead installed in a separate build
+stage, and only the resulting virtual env is copied into the image.
+A target with `precompile_bytecode` compiles its virtual env & sources
+to bytecode during the build.
+With `--sendwave-docker-incremental` an image whose only changes are
+to the files it copies is built from the last image of the target, by
+adding a layer of the changed files (see incremental.py).
+`--sendwave-docker-build-concurrency` limits the
+number of builds run by the docker daemon at once.
 
 Please see the ./pants help docker for more information on available
 docker target fields, and see the documentation for sources.py,
 python_requirements.py for specifics on how the DockerComponents are
 generated
 """
+import hashlib
 import itertools
 import logging
+import re
+import shlex
+from collections import defaultdict
+from dataclasses import dataclass, field
 from io import StringIO
-from typing import Iterable, List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import sendwave.pants_docker.utils as utils
 from pants.backend.python.subsystems.setup import PythonSetup
-from pants.backend.python.target_types import PythonRequirementTarget
+from pants.backend.python.target_types import (
+    PythonRequirementsField,
+    PythonRequirementTarget,
+    PythonResolveField,
+)
 from pants.core.goals.package import BuiltPackage, BuiltPackageArtifact
-from pants.core.util_rules.system_binaries import BinaryPathRequest, BinaryPaths
-from pants.engine.environment import Environment, EnvironmentRequest
+from pants.core.util_rules.system_binaries import BashBinary
 from pants.engine.fs import (
+    EMPTY_DIGEST,
     AddPrefix,
     CreateDigest,
     Digest,
+    DigestEntries,
+    DigestSubset,
     FileContent,
+    FileEntry,
     MergeDigests,
+    PathGlobs,
+    RemovePrefix,
     Snapshot,
 )
-from pants.engine.process import Process, ProcessCacheScope, ProcessResult
+from pants.engine.process import (
+    FallibleProcessResult,
+    Process,
+    ProcessCacheScope,
+    ProcessResult,
+)
 from pants.engine.rules import Get, MultiGet, collect_rules, rule
 from pants.engine.target import TransitiveTargets, TransitiveTargetsRequest
 from pants.engine.unions import UnionMembership
+from pants.option.global_options import GlobalOptions
+from sendwave.pants_docker.binary import (
+    CACHE_DIR,
+    CACHE_NAME,
+    DockerBinary,
+    log_path,
+)
 from sendwave.pants_docker.docker_component import (
     DockerComponent,
     DockerComponentFieldSet,
+    applicable_field_sets,
+)
+from sendwave.pants_docker.ignore import (
+    BYTECODE_PATTERNS,
+    TEST_PATTERNS,
+    ignore_path_globs,
+)
+from sendwave.pants_docker.incremental import (
+    RecordBuildRequest,
+    RecordedBuild,
+    ThinLayerRequest,
+    ThinLayerResult,
+)
+from sendwave.pants_docker.layers import (
+    APPLICATION_DIR,
+    VIRTUAL_ENV_DIR,
+    ContextLayers,
+    ContextLayersRequest,
+)
+from sendwave.pants_docker.metrics import PhaseTimer, build_report
+from sendwave.pants_docker.oci import OciImageRequest
+from sendwave.pants_docker.pinning import PinImagesRequest, PinnedImages
+from sendwave.pants_docker.python_requirement import (
+    PexVirtualEnvRequest,
+    PythonRequirementsFS,
+    RequirementsFileRequest,
+    VirtualEnvRequest,
+)
+from sendwave.pants_docker.size_report import SizeReport, SizeReportRequest
+from sendwave.pants_docker.sources import (
+    BATCHED_FIELD_SETS,
+    DockerFilesFS,
+    DockerPythonSourcesFS,
+    DockerRelocatedFilesFS,
+    DockerResourcesFS,
+    SourcesBatchRequest,
+)
+from sendwave.pants_docker.subsystem import (
+    BuildBackend,
+    Docker,
+    LayerStrategy,
+    VirtualEnvBuilder,
 )
-from sendwave.pants_docker.python_requirement import VirtualEnvRequest
-from sendwave.pants_docker.subsystem import Docker
 from sendwave.pants_docker.target import DockerPackageFieldSet
 
 logger = logging.getLogger(__name__)
 
+# matches commands using apt to install system packages
+APT = re.compile(r"\bapt(-get)?\s")
+# package managers setup commands may use, & the command removing the
+# package indexes & caches they leave behind in the image
+PACKAGE_MANAGER_CLEANUP = (
+    (APT, "rm -rf /var/lib/apt/lists/* /var/cache/apt/archives/*.deb"),
+    (re.compile(r"\bapk\s"), "rm -rf /var/cache/apk/*"),
+    (re.compile(r"\b(yum|dnf)\s"), "rm -rf /var/cache/yum /var/cache/dnf"),
+    (re.compile(r"\bpip3?\s"), "rm -rf /root/.cache/pip"),
+)
+# instructions with flags only understood by version 1.4 & later of the
+# Dockerfile frontend, i.e. `RUN --mount` & `COPY --link`
+FRONTEND_FLAGS = re.compile(r"^(RUN|COPY)(\s+--\S+)*?\s+--(mount|link)\b", re.M)
+
+# components whose sources are copied into the image alongside resources
+RESOURCE_FIELD_SETS = (DockerResourcesFS, DockerFilesFS, DockerRelocatedFilesFS)
+
+# name of the stage third-party requirements are installed in, when an
+# image has a builder image
+BUILDER_STAGE = "builder"
+
+# repository of the intermediate images shared by images with the same
+# base image, setup commands & third-party requirements
+BASE_IMAGE_REPOSITORY = "pants-docker-base"
+
 
 def _build_tags(
     target_name: str, tags: List[str], registry: Optional[str]
@@ -72,6 +199,22 @@ def _build_tags(
     return [f"{registry}/{tag}" for tag in tags]
 
 
+def _image_path(field_set: DockerPackageFieldSet) -> str:
+    """The path of the tarball a target's image is written to."""
+    return field_set.output_path.value_or_default(file_ending="tar")
+
+
+def _report_path(field_set: DockerPackageFieldSet, name: str) -> str:
+    """The path of the report `name` about a target's image.
+
+    An explicit `output_path` is used unchanged (it names the image's
+    tarball), so reports are named after it, e.g. `app.tar.metrics.json`,
+    rather than replacing its file ending.
+    """
+    base = field_set.output_path.value_or_default(file_ending=None)
+    return f"{base}.{name}"
+
+
 def _build_tag_argument_list(
     target_name: str, tags: List[str], registry: Optional[str]
 ) -> List[str]:
@@ -91,26 +234,153 @@ def _build_tag_argument_list(
     return list(tags)
 
 
+def _fingerprint(dockerfile_contents: str, docker_context: Digest) -> str:
+    """Fingerprint the inputs of a docker build.
+
+    Images built from the same Dockerfile & build context will have
+    the same fingerprint.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(dockerfile_contents.encode("utf-8"))
+    hasher.update(docker_context.fingerprint.encode("ascii"))
+    hasher.update(str(docker_context.serialized_bytes_length).encode("ascii"))
+    return hasher.hexdigest()
+
+
+def _without_copies(
+    dockerfile_contents: str, directories: Iterable[str]
+) -> str:
+    """The Dockerfile without the instructions copying `directories`
+    of the build context into the image."""
+    copies = {
+        f"{copy} {directory} ."
+        for copy in ("COPY", "COPY --link")
+        for directory in directories
+    }
+    return "".join(
+        line
+        for line in dockerfile_contents.splitlines(keepends=True)
+        if line.rstrip("\n") not in copies
+    )
+
+
+def _component_origin(component_type: Optional[type], group: str) -> str:
+    """Describe what the commands of a component add to an image."""
+    if component_type is DockerPythonSourcesFS:
+        origin = "python sources"
+    elif component_type in RESOURCE_FIELD_SETS:
+        origin = "resources & files"
+    elif component_type in (None, PythonRequirementsFS, PexVirtualEnvRequest):
+        origin = "third-party requirements"
+    else:
+        origin = component_type.__name__
+    return f"{origin} ({group})" if group else origin
+
+
+def _instruction_origins(
+    component_commands: Iterable[Tuple[str, str]],
+    setup: Iterable[str],
+    directories: Iterable[str],
+    directory_origins: Iterable[str],
+) -> Tuple[Tuple[str, str], ...]:
+    """Pair the instructions which may be in an image's Dockerfile with
+    what they add to the image."""
+    origins = [
+        (command.strip(), origin) for command, origin in component_commands
+    ]
+    origins.extend((f"RUN {line}", "image_setup_commands") for line in setup)
+    origins.extend(
+        [
+            (
+                _compile_bytecode("/.virtual_env").strip(),
+                "bytecode (virtual env)",
+            ),
+            (_compile_bytecode(".").strip(), "bytecode (sources)"),
+            (
+                _copy_virtual_env(BUILDER_STAGE, True)[0].strip(),
+                "third-party requirements (builder_image)",
+            ),
+        ]
+    )
+    origins.extend(
+        (f"COPY {directory} .", origin)
+        for directory, origin in zip(directories, directory_origins)
+    )
+    return tuple(origins)
+
+
+def _base_image_tag(fingerprint: str) -> str:
+    """Tag of the shared intermediate image with the given fingerprint."""
+    return f"{BASE_IMAGE_REPOSITORY}:{fingerprint}"
+
+
+def _compile_bytecode(path: str) -> str:
+    """A RUN instruction compiling the python files under `path`.
+
+    The bytecode is checked against the hash of its source only when
+    the source is compiled, never when it is imported, so it stays
+    valid in the image & is the same in every build.
+    """
+    return (
+        "RUN python -m compileall -q --invalidation-mode unchecked-hash "
+        "{}\n".format(path)
+    )
+
+
 def _create_dockerfile(
     base_image: str,
     workdir: Optional[str],
     setup: Iterable[str],
     commands: Iterable[str],
     init_command: Iterable[str],
+    copy_directories: Iterable[str] = ("application",),
+    cache_mounts: bool = False,
+    compile_sources: bool = False,
+    link_copies: bool = False,
+    collapse_setup: bool = False,
 ) -> str:
     """Construct a Dockerfile and write it into a string variable.
 
     Uses commands explicitly specified in the docker target definition &
-    generated from the Target's dependencies
+    generated from the Target's dependencies. Each directory of the
+    build context in `copy_directories` is copied into the image by its
+    own COPY instruction. With `cache_mounts` the setup commands using
+    apt keep its package lists & archives in BuildKit cache mounts. With
+    `compile_sources` the copied files are compiled to bytecode. With
+    `link_copies` directories are copied with `COPY --link`, so their
+    layers don't depend on the layers before them. With `collapse_setup`
+    setup commands run in a single RUN instruction, which then removes
+    the caches of the package managers they used (see _setup_cleanup).
     """
     dockerfile = StringIO()
     dockerfile.write("FROM {}\n".format(base_image))
     if workdir:
         dockerfile.write("WORKDIR {}\n".format(workdir))
-    if setup:
-        dockerfile.writelines(["RUN {}\n".format(line) for line in setup])
+    apt_cache_mounts = (
+        setup and cache_mounts and any(APT.search(line) for line in setup)
+    )
+    if apt_cache_mounts:
+        dockerfile.write(utils.APT_KEEP_CACHE)
+    if setup and collapse_setup:
+        # each command runs in its own subshell, as it would in its own
+        # RUN instruction, so e.g. `cd` & `||` don't change the others
+        setup = [
+            *("({})".format(line) for line in setup),
+            *_setup_cleanup(setup, cache_mounts),
+        ]
+        setup = [" && ".join(setup)]
+    for line in setup or ():
+        if apt_cache_mounts and APT.search(line):
+            # only commands using apt get its cache mounts
+            line = "{} {}".format(utils.APT_CACHE_MOUNTS, line)
+        dockerfile.write("RUN {}\n".format(line))
     dockerfile.writelines(commands)
-    dockerfile.write("COPY application .\n")
+    copy = "COPY --link" if link_copies else "COPY"
+    dockerfile.writelines(
+        ["{} {} .\n".format(copy, directory) for directory in copy_directories]
+    )
+    if compile_sources:
+        dockerfile.write(_compile_bytecode("."))
     if init_command:
         cmd = "CMD [{}]\n".format(
             ",".join('"{}"'.format(c) for c in init_command)
@@ -119,80 +389,515 @@ def _create_dockerfile(
     return dockerfile.getvalue()
 
 
-@rule()
-async def package_into_image(
+def _setup_cleanup(setup: Iterable[str], cache_mounts: bool) -> List[str]:
+    """Commands removing the caches of the package managers `setup`
+    uses, so they aren't left in the layer setup commands create.
+
+    With `cache_mounts` apt's caches are in BuildKit cache mounts, which
+    aren't part of the layer & are kept.
+    """
+    setup = list(setup)
+    return [
+        cleanup
+        for pattern, cleanup in PACKAGE_MANAGER_CLEANUP
+        if any(pattern.search(line) for line in setup)
+        and not (cache_mounts and pattern is APT)
+    ]
+
+
+def _declare_build_arg(dockerfile: str, name: str, default: str) -> str:
+    """Declare the build arg `name` in every stage of a Dockerfile.
+
+    The default value is part of the Dockerfile, & so of the image's
+    fingerprint.
+    """
+    return "".join(
+        line + (f"ARG {name}={default}\n" if line.startswith("FROM ") else "")
+        for line in dockerfile.splitlines(keepends=True)
+    )
+
+
+def _declare_syntax(dockerfile: str, frontend: Optional[str]) -> str:
+    """Request the Dockerfile `frontend` image, when one is configured,
+    for a `dockerfile` using flags which older versions of BuildKit's
+    built-in frontend don't understand.
+
+    BuildKit pulls the frontend image when building, so none is
+    requested unless configured (e.g. as a mirrored copy of
+    `docker/dockerfile:1.4`).
+    """
+    if frontend and FRONTEND_FLAGS.search(dockerfile):
+        return f"# syntax={frontend}\n{dockerfile}"
+    return dockerfile
+
+
+def _copy_virtual_env(stage: str, has_virtual_env: bool) -> List[str]:
+    """Commands copying & activating the virtual env built in `stage`."""
+    if not has_virtual_env:
+        return []
+    return [
+        f"COPY --from={stage} /.virtual_env /.virtual_env\n",
+        "ENV PATH=/.virtual_env/bin:$PATH\n",
+        "ENV VIRTUAL_ENV=/.virtual_env\n",
+    ]
+
+
+def _create_multistage_dockerfile(
+    builder_image: str,
+    base_image: str,
+    workdir: Optional[str],
+    setup: Iterable[str],
+    builder_commands: Iterable[str],
+    commands: Iterable[str],
+    init_command: Iterable[str],
+    copy_directories: Iterable[str] = ("application",),
+    cache_mounts: bool = False,
+    compile_sources: bool = False,
+    link_copies: bool = False,
+    collapse_setup: bool = False,
+) -> str:
+    """Construct a Dockerfile building the virtual env in its own stage.
+
+    Setup commands & `builder_commands` (which install third-party
+    requirements) run in a stage from `builder_image`. The image is
+    built from `base_image`, and only gets the virtual env from the
+    builder stage along with the copied directories of the build
+    context.
+    """
+    builder_commands = list(builder_commands)
+    builder_stage = _create_dockerfile(
+        f"{builder_image} AS {BUILDER_STAGE}",
+        workdir,
+        setup,
+        builder_commands,
+        (),
+        (),
+        cache_mounts,
+        collapse_setup=collapse_setup,
+    )
+    runtime_stage = _create_dockerfile(
+        base_image,
+        workdir,
+        (),
+        [
+            *_copy_virtual_env(BUILDER_STAGE, bool(builder_commands)),
+            *commands,
+        ],
+        init_command,
+        copy_directories,
+        compile_sources=compile_sources,
+        link_copies=link_copies,
+    )
+    return builder_stage + runtime_stage
+
+
+@dataclass(frozen=True)
+class DockerBuildContext:
+    """The Dockerfile & build context generated for a 'docker' target.
+
+    `digest` contains the Dockerfile along with every other file in the
+    build context. `fingerprint` identifies the inputs of the build.
+    When base images are shared `base` is the context of the
+    intermediate image the Dockerfile starts from. With incremental
+    builds `files` holds the files copied into the image's working
+    directory & `recipe` fingerprints every other input (see
+    incremental.py). `timings` are not part of the context's identity.
+    """
+
+    dockerfile: str
+    digest: Digest
+    fingerprint: str
+    base: Optional["DockerBuildContext"] = None
+    files: Digest = EMPTY_DIGEST
+    recipe: str = ""
+    # the Dockerfile instructions of the image (& its base), each with a
+    # description of what they add to the image
+    origins: Tuple[Tuple[str, str], ...] = ()
+    # how long each phase of creating the context took, in seconds
+    timings: Tuple[Tuple[str, float], ...] = field(default=(), compare=False)
+
+
+@rule
+async def create_build_context(
     field_set: DockerPackageFieldSet,
     union_membership: UnionMembership,
     setup: PythonSetup,
     docker: Docker,
-) -> BuiltPackage:
-    """Build a docker image from a 'docker' build target.
+) -> DockerBuildContext:
+    """Create a Dockerfile & build context from a 'docker' build target.
 
-    Creates a build context & dockerfile from the build target & its
-    dependencies. Then builds & tags that image. (see the module
-    docstring for more information)
+    Collects DockerComponents from the target's transitive dependencies
+    and merges them into a build context. (see the module docstring for
+    more information)
     """
     target_name = field_set.address.target_name
+    timer = PhaseTimer()
     transitive_targets = await Get(
         TransitiveTargets, TransitiveTargetsRequest([field_set.address])
     )
+    timer.lap("transitive_targets")
 
     component_list = []
-    created_virtual_env = False
+    # the field set type each component was created from, the request
+    # type of a PEX virtual env, or None for other components
+    # installing third-party requirements
+    component_types = []
+    # the directory of the BUILD file of the target each component was
+    # created from, used to group files into content-addressed layers
+    component_groups = []
+    batched_requirements = set()
+    pex_requirements = []
+    build_pex = docker.options.virtual_env == VirtualEnvBuilder.pex
+    install_from_lockfile = setup.enable_resolves and not build_pex
+    lockfile = None
+    lockfile_requirements = ()
+    requirement_targets = [
+        target
+        for target in transitive_targets.dependencies
+        if isinstance(target, PythonRequirementTarget)
+    ]
+    if install_from_lockfile and requirement_targets:
+        resolves = {
+            target[PythonResolveField].normalized_value(setup)
+            for target in requirement_targets
+        }
+        if len(resolves) > 1:
+            raise ValueError(
+                "The requirements of {} belong to more than one resolve: "
+                "{}".format(target_name, ", ".join(sorted(resolves)))
+            )
+        lockfile = setup.resolves[resolves.pop()]
+        lockfile_requirements = tuple(
+            sorted(
+                str(req)
+                for target in requirement_targets
+                for req in target[PythonRequirementsField].value
+            )
+        )
     logger.debug("Building Target %s", target_name)
-    for field_set_type in union_membership[DockerComponentFieldSet]:
-        for target in transitive_targets.dependencies:
-            if (
-                isinstance(target, PythonRequirementTarget)
-                and not created_virtual_env
-            ):
-                # if there are any third party python dependencies
-                # create & activate a virtual env in the image, this
-                # will copy in a constraints file (which will be used
-                # when installing any 3rd-party dependencies)
-                component_list.append(
-                    Get(
-                        DockerComponent,
-                        VirtualEnvRequest(
-                            setup.enable_resolves, setup.requirement_constraints
-                        ),
-                    )
-                )
-                # we only want one virtual env per image
-                created_virtual_env = True
-            if field_set_type.is_applicable(target):
-                logger.debug(
-                    "Dependent Target %s applies to as component %s",
-                    target.address,
-                    field_set_type.__name__,
+    if requirement_targets and not build_pex:
+        # if there are any third party python dependencies create &
+        # activate a virtual env in the image, this will copy in a
+        # constraints file (which will be used when installing any
+        # 3rd-party dependencies)
+        component_list.append(
+            Get(
+                DockerComponent,
+                VirtualEnvRequest(
+                    setup.enable_resolves,
+                    setup.requirement_constraints,
+                    cache_mounts=docker.options.buildkit_cache_mounts,
+                    reproducible=docker.options.reproducible,
+                    lockfile=lockfile,
+                    requirements=lockfile_requirements,
+                    platforms=tuple(field_set.python_platforms.value or ()),
+                ),
+            )
+        )
+        component_types.append(None)
+        component_groups.append("")
+    if build_pex:
+        # resolved by pants into a single PEX below
+        pex_requirements = [target.address for target in requirement_targets]
+    content_layers = docker.options.layers == LayerStrategy.content
+    applicable = applicable_field_sets(
+        union_membership[DockerComponentFieldSet],
+        [
+            target
+            for target in transitive_targets.dependencies
+            if not (build_pex and isinstance(target, PythonRequirementTarget))
+        ],
+    )
+    for field_set_type, targets in applicable.items():
+        if install_from_lockfile and field_set_type is PythonRequirementsFS:
+            # installed from the lockfile along with the virtual env
+            continue
+        if (
+            docker.options.batch_requirements
+            and field_set_type is PythonRequirementsFS
+        ):
+            # installed all at once below, rather than one component
+            # per requirement
+            batched_requirements.update(
+                str(req)
+                for target in targets
+                for req in target[PythonRequirementsField].value
+            )
+            continue
+        if field_set_type in BATCHED_FIELD_SETS:
+            # hydrate the sources of all targets at once (or of each
+            # layer group), rather than with one request per target
+            grouped_sources = defaultdict(list)
+            for target in targets:
+                group = target.address.spec_path if content_layers else ""
+                grouped_sources[group].append(
+                    field_set_type.create(target).sources
                 )
+            for group, sources in grouped_sources.items():
                 component_list.append(
-                    Get(
-                        DockerComponent,
-                        DockerComponentFieldSet,
-                        field_set_type.create(target),
-                    )
+                    Get(DockerComponent, SourcesBatchRequest(tuple(sources)))
                 )
+                component_types.append(field_set_type)
+                component_groups.append(group)
+            continue
+        for target in targets:
+            logger.debug(
+                "Dependent Target %s applies to as component %s",
+                target.address,
+                field_set_type.__name__,
+            )
+            component_list.append(
+                Get(
+                    DockerComponent,
+                    DockerComponentFieldSet,
+                    field_set_type.create(target),
+                )
+            )
+            component_types.append(field_set_type)
+            component_groups.append(target.address.spec_path)
+    if batched_requirements:
+        component_list.append(
+            Get(
+                DockerComponent,
+                RequirementsFileRequest(tuple(sorted(batched_requirements))),
+            )
+        )
+        component_types.append(None)
+        component_groups.append("")
+
+    if pex_requirements:
+        component_list.append(
+            Get(
+                DockerComponent,
+                PexVirtualEnvRequest(
+                    tuple(pex_requirements),
+                    tuple(field_set.python_platforms.value),
+                    docker.options.buildkit_cache_mounts,
+                ),
+            )
+        )
+        component_types.append(PexVirtualEnvRequest)
+        component_groups.append("")
 
     components = await MultiGet(*component_list)
+    timer.lap("components")
 
-    source_digests = []
+    third_party_digests = []
+    resource_digests = []
+    resource_groups = []
+    python_digests = []
+    python_groups = []
+    virtual_env_digests = []
     run_commands = []
-    components = sorted(components, key=lambda c: c.order)
-    for component in components:
-        if component.sources:
-            source_digests.append(component.sources)
+    # commands split by whether they install third-party requirements,
+    # for building a shared base image
+    third_party_commands = []
+    source_commands = []
+    components = sorted(
+        zip(components, component_types, component_groups),
+        key=lambda c: c[0].order,
+    )
+    for component, component_type, component_group in components:
         run_commands.extend(component.commands)
-    source_digest = await Get(Digest, MergeDigests(source_digests))
-    application_digest = await Get(
-        Digest, AddPrefix(source_digest, "application")
+        if (
+            component_type is DockerPythonSourcesFS
+            or component_type in RESOURCE_FIELD_SETS
+        ):
+            source_commands.extend(component.commands)
+        else:
+            third_party_commands.extend(component.commands)
+        if not component.sources:
+            continue
+        if component_type is DockerPythonSourcesFS:
+            python_digests.append(component.sources)
+            python_groups.append(component_group)
+        elif component_type in RESOURCE_FIELD_SETS:
+            resource_digests.append(component.sources)
+            resource_groups.append(component_group)
+        elif component_type is PexVirtualEnvRequest:
+            virtual_env_digests.append(component.sources)
+        else:
+            third_party_digests.append(component.sources)
+    precompile_bytecode = field_set.precompile_bytecode.value
+    if precompile_bytecode and third_party_commands:
+        # compiled right after the requirements are installed, so the
+        # layer is cached until they change
+        run_commands.append(_compile_bytecode("/.virtual_env"))
+        third_party_commands.append(_compile_bytecode("/.virtual_env"))
+    ignore_patterns = list(field_set.ignore.value or ())
+    if docker.options.exclude_tests:
+        ignore_patterns.extend(TEST_PATTERNS)
+    if docker.options.exclude_bytecode:
+        ignore_patterns.extend(BYTECODE_PATTERNS)
+    if ignore_patterns:
+        # prune ignored files before the context is laid out, so they
+        # are never sent to the docker daemon. Each component's files are
+        # pruned separately, so they stay in their layer group
+        included = ignore_path_globs(ignore_patterns)
+        resource_digests = await MultiGet(
+            Get(Digest, DigestSubset(digest, included))
+            for digest in resource_digests
+        )
+        python_digests = await MultiGet(
+            Get(Digest, DigestSubset(digest, included))
+            for digest in python_digests
+        )
+        timer.lap("ignore")
+    context_layers = await Get(
+        ContextLayers,
+        ContextLayersRequest(
+            docker.options.layers,
+            tuple(third_party_digests),
+            tuple(resource_digests),
+            tuple(python_digests),
+            tuple(virtual_env_digests),
+            tuple(resource_groups),
+            tuple(python_groups),
+        ),
     )
-    dockerfile_contents = _create_dockerfile(
-        field_set.base_image.value,
-        field_set.workdir.value,
-        field_set.image_setup.value,
-        run_commands,
-        field_set.command.value,
+    timer.lap("context_layers")
+    # layers keyed by their contents are only reusable in any image if
+    # they don't depend on the layers before them
+    link_copies = docker.options.layers == LayerStrategy.content
+    base_image = field_set.base_image.value
+    builder_image = field_set.builder_image.value
+    if (
+        docker.options.pin_base_images
+        and docker.options.backend != BuildBackend.oci
+    ):
+        pinned = await Get(
+            PinnedImages,
+            PinImagesRequest(
+                tuple(image for image in (base_image, builder_image) if image)
+            ),
+        )
+        base_image = pinned.get(base_image)
+        if builder_image:
+            builder_image = pinned.get(builder_image)
+        timer.lap("pin_base_images")
+    base = None
+    if (
+        docker.options.share_base_images
+        and docker.options.backend == BuildBackend.docker
+    ):
+        # everything up to the installed third-party requirements is
+        # built as an intermediate image, which images with the same
+        # inputs share
+        base_dockerfile_contents = _create_dockerfile(
+            builder_image or base_image,
+            field_set.workdir.value,
+            field_set.image_setup.value,
+            third_party_commands,
+            (),
+            (),
+            docker.options.buildkit_cache_mounts,
+            collapse_setup=docker.options.collapse_setup,
+        )
+        if docker.options.reproducible:
+            base_dockerfile_contents = _declare_build_arg(
+                base_dockerfile_contents,
+                "SOURCE_DATE_EPOCH",
+                str(docker.options.source_date_epoch),
+            )
+        base_dockerfile_contents = _declare_syntax(
+            base_dockerfile_contents, docker.options.dockerfile_frontend
+        )
+        third_party, virtual_env, base_dockerfile = await MultiGet(
+            Get(Digest, MergeDigests(third_party_digests)),
+            Get(Digest, MergeDigests(virtual_env_digests)),
+            Get(
+                Digest,
+                CreateDigest(
+                    [
+                        FileContent(
+                            "Dockerfile",
+                            base_dockerfile_contents.encode("utf-8"),
+                        )
+                    ]
+                ),
+            ),
+        )
+        prefixed_digests = await MultiGet(
+            Get(Digest, AddPrefix(third_party, APPLICATION_DIR)),
+            Get(Digest, AddPrefix(virtual_env, VIRTUAL_ENV_DIR)),
+        )
+        base_context = await Get(
+            Digest, MergeDigests([base_dockerfile, *prefixed_digests])
+        )
+        base = DockerBuildContext(
+            base_dockerfile_contents,
+            base_context,
+            _fingerprint(base_dockerfile_contents, base_context),
+        )
+        timer.lap("base_context")
+        if builder_image:
+            # the intermediate image is the builder stage, only its
+            # virtual env is copied into the image
+            dockerfile_contents = _create_dockerfile(
+                base_image,
+                field_set.workdir.value,
+                (),
+                [
+                    *_copy_virtual_env(
+                        _base_image_tag(base.fingerprint),
+                        bool(third_party_commands),
+                    ),
+                    *source_commands,
+                ],
+                field_set.command.value,
+                context_layers.directories,
+                compile_sources=precompile_bytecode,
+                link_copies=link_copies,
+            )
+        else:
+            dockerfile_contents = _create_dockerfile(
+                _base_image_tag(base.fingerprint),
+                None,
+                (),
+                source_commands,
+                field_set.command.value,
+                context_layers.directories,
+                compile_sources=precompile_bytecode,
+                link_copies=link_copies,
+            )
+    elif builder_image:
+        dockerfile_contents = _create_multistage_dockerfile(
+            builder_image,
+            base_image,
+            field_set.workdir.value,
+            field_set.image_setup.value,
+            third_party_commands,
+            source_commands,
+            field_set.command.value,
+            context_layers.directories,
+            docker.options.buildkit_cache_mounts,
+            precompile_bytecode,
+            link_copies,
+            docker.options.collapse_setup,
+        )
+    else:
+        dockerfile_contents = _create_dockerfile(
+            base_image,
+            field_set.workdir.value,
+            field_set.image_setup.value,
+            run_commands,
+            field_set.command.value,
+            context_layers.directories,
+            docker.options.buildkit_cache_mounts,
+            precompile_bytecode,
+            link_copies,
+            docker.options.collapse_setup,
+        )
+    if docker.options.reproducible:
+        # expose the epoch to RUN instructions, e.g. so that wheels built
+        # by pip are reproducible
+        dockerfile_contents = _declare_build_arg(
+            dockerfile_contents,
+            "SOURCE_DATE_EPOCH",
+            str(docker.options.source_date_epoch),
+        )
+    dockerfile_contents = _declare_syntax(
+        dockerfile_contents, docker.options.dockerfile_frontend
     )
     logger.info("Constructed Dockerfile:\n{}".format(dockerfile_contents))
     dockerfile = await Get(
@@ -201,54 +906,621 @@ async def package_into_image(
             [FileContent("Dockerfile", dockerfile_contents.encode("utf-8"))]
         ),
     )
-    # create docker build context of all merged files & fetch docker
-    # connection enviornment variables
-    # and the location of the docker process
-    search_path = ["/bin", "/usr/bin", "/usr/local/bin", "$HOME/"]
-    docker_context, docker_env, docker_paths = await MultiGet(
-        Get(Digest, MergeDigests([dockerfile, application_digest])),
-        Get(Environment, EnvironmentRequest(utils.DOCKER_ENV_VARS)),
-        Get(
-            BinaryPaths,
-            BinaryPathRequest(
-                binary_name="docker",
-                search_path=search_path,
+    docker_context = await Get(
+        Digest, MergeDigests([dockerfile, context_layers.digest])
+    )
+    timer.lap("context_digest")
+    files = EMPTY_DIGEST
+    recipe = ""
+    if docker.options.incremental:
+        # the files copied into the working directory, as they are laid
+        # out in the image
+        directories = context_layers.directories
+        copied = await MultiGet(
+            Get(
+                Digest,
+                DigestSubset(
+                    context_layers.digest, PathGlobs([f"{directory}/**"])
+                ),
+            )
+            for directory in directories
+        )
+        unprefixed = await MultiGet(
+            Get(Digest, RemovePrefix(digest, directory))
+            for digest, directory in zip(copied, directories)
+        )
+        files, recipe_inputs = await MultiGet(
+            Get(Digest, MergeDigests(unprefixed)),
+            Get(
+                Digest,
+                MergeDigests([*third_party_digests, *virtual_env_digests]),
             ),
+        )
+        recipe = _fingerprint(
+            _without_copies(dockerfile_contents, directories), recipe_inputs
+        )
+        timer.lap("incremental")
+    origins = _instruction_origins(
+        (
+            (command, _component_origin(component_type, component_group))
+            for component, component_type, component_group in components
+            for command in component.commands
         ),
+        field_set.image_setup.value or (),
+        context_layers.directories,
+        context_layers.origins,
     )
-    if not docker_paths.first_path:
-        raise ValueError(
-            "Unable to locate Docker binary on paths: %s", search_path
+    return DockerBuildContext(
+        dockerfile_contents,
+        docker_context,
+        _fingerprint(dockerfile_contents, docker_context),
+        base,
+        files,
+        recipe,
+        origins,
+        timer.durations(),
+    )
+
+
+@dataclass(frozen=True)
+class BaseImageRequest:
+    """Build the intermediate image shared by images with the same base."""
+
+    context: DockerBuildContext
+
+
+@dataclass(frozen=True)
+class BaseImage:
+    tag: str
+
+
+@rule
+async def build_base_image(
+    request: BaseImageRequest,
+    docker: Docker,
+    docker_binary: DockerBinary,
+    global_options: GlobalOptions,
+) -> BaseImage:
+    """Build a shared intermediate image, unless it already exists.
+
+    The image is tagged with the fingerprint of its inputs. Pants only
+    runs this rule once for every distinct request, so images sharing
+    a base within one pants run wait on the same build.
+    """
+    tag = _base_image_tag(request.context.fingerprint)
+    existing = await Get(
+        FallibleProcessResult,
+        Process,
+        docker_binary.process(
+            ["image", "inspect", "--format", "{{.Id}}", tag],
+            description=f"Looking up shared base image {tag}",
+        ),
+    )
+    if existing.exit_code == 0:
+        logger.debug("Shared base image %s already exists", tag)
+        return BaseImage(tag)
+    build_args = ["build", "-t", tag, *_reproducible_args(docker), "."]
+    if docker.options.report_progress:
+        build_args.extend(["--progress", "plain"])
+    build_result = await Get(
+        ProcessResult,
+        Process,
+        docker_binary.process(
+            build_args,
+            description=f"Creating shared base image {tag}",
+            input_digest=request.context.digest,
+            extra_env=_build_env(docker),
+            slots=docker.options.build_concurrency,
+            log_file=_stream_log(
+                f"base-{request.context.fingerprint[:12]}",
+                docker,
+                global_options,
+            ),
+        ),
+    )
+    if docker.options.report_progress:
+        logger.info(build_result.stdout.decode())
+        logger.info(build_result.stderr.decode())
+    return BaseImage(tag)
+
+
+def _stream_log(
+    name: str, docker: Docker, global_options: GlobalOptions
+) -> Optional[str]:
+    """Name the log file build output is streamed to, if it is reported."""
+    if not docker.options.report_progress:
+        return None
+    log_file = f"{name}.log"
+    logger.info(
+        "Streaming output of `docker build` to %s",
+        log_path(global_options.options.named_caches_dir, log_file),
+    )
+    return log_file
+
+
+def _build_env(docker: Docker) -> Dict[str, str]:
+    """Environment variables to set when running `docker build`."""
+    if (
+        docker.options.buildkit_cache_mounts
+        or docker.options.reproducible
+        or docker.options.layers == LayerStrategy.content
+    ):
+        # RUN --mount, COPY --link & rewriting timestamps are only
+        # supported by BuildKit
+        return {"DOCKER_BUILDKIT": "1"}
+    return {}
+
+
+def _reproducible_args(docker: Docker) -> List[str]:
+    """Arguments to `docker build` making the built image reproducible.
+
+    Every timestamp in the image is set to SOURCE_DATE_EPOCH.
+    """
+    if not docker.options.reproducible:
+        return []
+    return [
+        "--build-arg",
+        f"SOURCE_DATE_EPOCH={docker.options.source_date_epoch}",
+        "--output",
+        "type=docker,rewrite-timestamp=true",
+    ]
+
+
+def _load_exported_image_command(
+    docker_path: str, fingerprint: str, tags: Iterable[str], archive: str
+) -> str:
+    """A shell command making sure the docker daemon has an exported
+    image, with all of its tags.
+
+    An image built from the same inputs is tagged if the daemon has
+    one, otherwise the image is loaded from its exported tarball.
+    """
+    lookup = shlex.join(
+        [
+            docker_path,
+            "image",
+            "ls",
+            "--quiet",
+            "--no-trunc",
+            "--filter",
+            f"label={utils.FINGERPRINT_LABEL}={fingerprint}",
+        ]
+    )
+    tag_image = " && ".join(
+        '{} tag "$image" {}'.format(shlex.quote(docker_path), shlex.quote(tag))
+        for tag in tags
+    )
+    load_image = shlex.join([docker_path, "load", "--input", archive])
+    return (
+        f"image=$({lookup} | head -n 1) && "
+        f'if [ -n "$image" ]; then {tag_image}; else {load_image}; fi'
+    )
+
+
+@dataclass(frozen=True)
+class LoadExportedImageRequest:
+    """Make sure the docker daemon has an exported image.
+
+    digest: holds the image's tarball, at `path`
+    """
+
+    digest: Digest
+    path: str
+    fingerprint: str
+    tags: Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class LoadedImage:
+    pass
+
+
+@rule
+async def load_exported_image(
+    request: LoadExportedImageRequest,
+    docker_binary: DockerBinary,
+    bash: BashBinary,
+) -> LoadedImage:
+    """Load an exported image into the docker daemon, unless it has it.
+
+    The process building & exporting an image is cached by pants, so
+    when its tarball comes from the (local or remote) cache the image
+    was never built by this docker daemon.
+    """
+    await Get(
+        ProcessResult,
+        Process(
+            argv=(
+                bash.path,
+                "-c",
+                _load_exported_image_command(
+                    docker_binary.path,
+                    request.fingerprint,
+                    request.tags,
+                    request.path,
+                ),
+            ),
+            env=docker_binary.env,
+            input_digest=request.digest,
+            description=f"Loading {request.path} into the docker daemon",
+            cache_scope=ProcessCacheScope.PER_SESSION,
+        ),
+    )
+    return LoadedImage()
+
+
+@dataclass(frozen=True)
+class DockerBuildRequest:
+    """Build an image from a build context with the docker CLI."""
+
+    field_set: DockerPackageFieldSet
+    context: DockerBuildContext
+
+
+@rule()
+async def package_into_image(
+    field_set: DockerPackageFieldSet,
+    docker: Docker,
+) -> BuiltPackage:
+    """Build a docker image from a 'docker' build target.
+
+    Creates a build context & dockerfile from the build target & its
+    dependencies. Then builds & tags that image with the configured
+    backend. (see the module docstring for more information)
+    """
+    context = await Get(DockerBuildContext, DockerPackageFieldSet, field_set)
+    tags = _build_tags(
+        field_set.address.target_name,
+        field_set.tags.value or [],
+        field_set.registry.value,
+    )
+    if docker.options.backend == BuildBackend.oci:
+        return await Get(
+            BuiltPackage,
+            OciImageRequest(
+                context.digest,
+                tuple(tags),
+                _image_path(field_set),
+                field_set.address.target_name,
+            ),
+        )
+    return await Get(BuiltPackage, DockerBuildRequest(field_set, context))
+
+
+@dataclass(frozen=True)
+class ExistingImageRequest:
+    """Tag an image previously built from identical inputs, if any."""
+
+    target_name: str
+    fingerprint: str
+    tags: Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class ExistingImage:
+    image: Optional[str]
+
+
+@rule
+async def tag_existing_image(
+    request: ExistingImageRequest, docker: Docker, docker_binary: DockerBinary
+) -> ExistingImage:
+    """Look for an image labelled with the fingerprint of the inputs of
+    the request, & tag it with the request's tags."""
+    lookup_result = await Get(
+        ProcessResult,
+        Process,
+        docker_binary.process(
+            [
+                "image",
+                "ls",
+                "--quiet",
+                "--no-trunc",
+                "--filter",
+                f"label={utils.FINGERPRINT_LABEL}={request.fingerprint}",
+            ],
+            description=f"Looking up existing image for {request.target_name}",
+        ),
+    )
+    existing_images = lookup_result.stdout.decode().split()
+    if not existing_images:
+        return ExistingImage(None)
+    image = existing_images[0]
+    logger.info(
+        "Inputs of %s are unchanged, tagging existing image %s",
+        request.target_name,
+        image,
+    )
+    if docker.options.metrics or docker.options.size_report:
+        logger.info(
+            "Skipped building %s, so its build metrics & size report are "
+            "not written",
+            request.target_name,
+        )
+    await MultiGet(
+        Get(
+            ProcessResult,
+            Process,
+            docker_binary.process(
+                ["tag", image, tag],
+                description=f"Tagging {image} as {tag}",
+            ),
         )
-    process_path = docker_paths.first_path.path
+        for tag in request.tags
+    )
+    return ExistingImage(image)
+
+
+def _docker_build_process(
+    request: DockerBuildRequest,
+    docker: Docker,
+    docker_binary: DockerBinary,
+    bash: BashBinary,
+    tags: List[str],
+    plain_progress: bool,
+    log_file: Optional[str],
+) -> Process:
+    """The process running `docker build` on the build context, &
+    `docker save` when images are exported."""
+    field_set = request.field_set
+    target_name = field_set.address.target_name
     # build an list of arguments of the form ["-t",
     # "registry/name:tag"] to pass to the docker executable
     tag_arguments = _build_tag_argument_list(
         target_name, field_set.tags.value or [], field_set.registry.value
     )
     # create the image
-    process_args = [process_path, "build"]
+    process_args = ["build"]
     process_args.extend(tag_arguments)
+    # stamp the image with its input fingerprint so that it can be
+    # found again when the inputs are unchanged
+    process_args.extend(
+        ["--label", f"{utils.FINGERPRINT_LABEL}={request.context.fingerprint}"]
+    )
+    process_args.extend(_reproducible_args(docker))
     process_args.append(".")  # use current (sealed) directory as build context
-    if docker.options.report_progress:
+    if plain_progress:
         process_args.append("--progress")
         process_args.append("plain")
+    build_env = _build_env(docker)
+    slots = docker.options.build_concurrency
+    if not docker.options.export_image:
+        return docker_binary.process(
+            process_args,
+            description=f"Creating Docker Image from {target_name}",
+            input_digest=request.context.digest,
+            extra_env=build_env,
+            slots=slots,
+            log_file=log_file,
+        )
+    output_path = _image_path(field_set)
+    build_argv = [docker_binary.path, *process_args]
+    save_argv = [docker_binary.path, "save", "--output", output_path, *tags]
+    # build & save the image in one process, so that the tarball is
+    # only ever cached along with the inputs it was built from
+    argv: Tuple[str, ...] = (
+        bash.path,
+        "-c",
+        f"{shlex.join(build_argv)} && {shlex.join(save_argv)}",
+    )
+    if slots or log_file:
+        argv = docker_binary.wrap(argv, slots, log_file)
+    return Process(
+        argv=argv,
+        env={**docker_binary.env, **build_env},
+        input_digest=request.context.digest,
+        output_files=(output_path,),
+        description=f"Creating & exporting Docker Image from {target_name}",
+        cache_scope=ProcessCacheScope.SUCCESSFUL,
+        append_only_caches={CACHE_NAME: CACHE_DIR}
+        if slots or log_file
+        else None,
+    )
+
+
+@rule
+async def build_with_docker(
+    request: DockerBuildRequest,
+    docker: Docker,
+    docker_binary: DockerBinary,
+    bash: BashBinary,
+    global_options: GlobalOptions,
+) -> BuiltPackage:
+    """Build & tag an image by running `docker build`.
+
+    Unchanged images are tagged instead (see tag_existing_image). When
+    images are exported, the built image is also written to the
+    target's output path with `docker save`, and loaded back into the
+    docker daemon when the tarball came from the pants cache (see
+    load_exported_image). With incremental builds the
+    image is built from the last image of the target instead, when only
+    the files it copies changed (see incremental.py). Either way the
+    metrics & size report of the image are written by
+    write_build_reports.
+    """
+    field_set = request.field_set
+    target_name = field_set.address.target_name
+    tags = _build_tags(
+        target_name, field_set.tags.value or [], field_set.registry.value
+    )
+    # an exported image is cached by pants, & loaded from the cached
+    # tarball, so there is no need to look for an existing image
+    if docker.options.skip_unchanged and not docker.options.export_image:
+        existing = await Get(
+            ExistingImage,
+            ExistingImageRequest(
+                target_name, request.context.fingerprint, tuple(tags)
+            ),
+        )
+        if existing.image:
+            return BuiltPackage(digest=EMPTY_DIGEST, artifacts=())
+    timer = PhaseTimer()
+    plain_progress = docker.options.report_progress or docker.options.metrics
+    log_file = _stream_log(
+        field_set.address.path_safe_spec, docker, global_options
+    )
+    # exported & reproducible images have to be built from their
+    # Dockerfile, to have the same layers as any other build of it
+    incremental = (
+        docker.options.incremental
+        and not docker.options.export_image
+        and not docker.options.reproducible
+    )
+    if incremental:
+        thin_layer = await Get(
+            ThinLayerResult,
+            ThinLayerRequest(
+                field_set.address,
+                request.context.files,
+                request.context.recipe,
+                tuple(tags),
+                request.context.fingerprint,
+                field_set.precompile_bytecode.value,
+                plain_progress,
+                log_file,
+            ),
+        )
+        timer.lap("thin_layer")
+        if thin_layer.built:
+            return await Get(
+                BuiltPackage,
+                BuildReportsRequest(
+                    request,
+                    tags[0],
+                    thin_layer.output,
+                    timer.durations(),
+                    EMPTY_DIGEST,
+                ),
+            )
+    if request.context.base:
+        await Get(BaseImage, BaseImageRequest(request.context.base))
+        timer.lap("base_image")
     process_result = await Get(
         ProcessResult,
-        Process(
-            env=docker_env,
-            argv=process_args,
-            input_digest=docker_context,
-            description=f"Creating Docker Image from {target_name}",
-            cache_scope=ProcessCacheScope.PER_SESSION,
+        Process,
+        _docker_build_process(
+            request,
+            docker,
+            docker_binary,
+            bash,
+            tags,
+            plain_progress,
+            log_file,
+        ),
+    )
+    timer.lap("docker_build")
+    if docker.options.export_image:
+        await Get(
+            LoadedImage,
+            LoadExportedImageRequest(
+                process_result.output_digest,
+                _image_path(field_set),
+                request.context.fingerprint,
+                tuple(tags),
+            ),
+        )
+        timer.lap("load_exported_image")
+    if incremental:
+        await Get(
+            RecordedBuild,
+            RecordBuildRequest(
+                field_set.address,
+                request.context.files,
+                request.context.recipe,
+                tags[0],
+            ),
+        )
+    return await Get(
+        BuiltPackage,
+        BuildReportsRequest(
+            request,
+            tags[0],
+            process_result.stdout.decode() + process_result.stderr.decode(),
+            timer.durations(),
+            process_result.output_digest,
         ),
     )
+
+
+@dataclass(frozen=True)
+class BuildReportsRequest:
+    """Write the reports of an image built with the docker CLI.
+
+    output: the output of building the image
+    timings: the duration of each phase of building the image
+    digest: the files built along with the image, e.g. its tarball
+    """
+
+    build: DockerBuildRequest
+    tag: str
+    output: str
+    timings: Tuple[Tuple[str, float], ...]
+    digest: Digest
+
+
+@rule
+async def write_build_reports(
+    request: BuildReportsRequest, docker: Docker
+) -> BuiltPackage:
+    """Add the configured metrics & size report of an image to the
+    files built along with it, however the image was built."""
+    field_set = request.build.field_set
+    context = request.build.context
+    target_name = field_set.address.target_name
     if docker.options.report_progress:
-        logger.info(process_result.stdout.decode())
-        logger.info(process_result.stderr.decode())
-    output_digest = await Get(Snapshot, Digest, process_result.output_digest)
+        logger.info(request.output)
+    package_digest = request.digest
+    if docker.options.metrics:
+        context_entries = await Get(DigestEntries, Digest, context.digest)
+        context_files = [
+            entry for entry in context_entries if isinstance(entry, FileEntry)
+        ]
+        report = build_report(
+            str(field_set.address),
+            context.fingerprint,
+            (*context.timings, *request.timings),
+            sum(f.file_digest.serialized_bytes_length for f in context_files),
+            len(context_files),
+            context.dockerfile,
+            request.output,
+        )
+        metrics_path = _report_path(field_set, "metrics.json")
+        logger.info(
+            "Writing build metrics of %s to %s", target_name, metrics_path
+        )
+        metrics_digest = await Get(
+            Digest, CreateDigest([FileContent(metrics_path, report)])
+        )
+        package_digest = await Get(
+            Digest, MergeDigests([package_digest, metrics_digest])
+        )
+    if docker.options.size_report:
+        report_path = _report_path(field_set, "size.json")
+        logger.info(
+            "Writing the size report of %s to %s", target_name, report_path
+        )
+        archive_path = None
+        if docker.options.export_image:
+            # analyze the exported tarball rather than saving the image
+            # from the docker daemon again
+            archive_path = _image_path(field_set)
+        size_report = await Get(
+            SizeReport,
+            SizeReportRequest(
+                field_set.address,
+                request.tag,
+                context.origins,
+                report_path,
+                request.digest,
+                archive_path,
+            ),
+        )
+        package_digest = await Get(
+            Digest, MergeDigests([package_digest, size_report.digest])
+        )
+    output_digest = await Get(Snapshot, Digest, package_digest)
     return BuiltPackage(
-        digest=process_result.output_digest,
+        digest=package_digest,
         artifacts=([BuiltPackageArtifact(f, ()) for f in output_digest.files]),
     )
 
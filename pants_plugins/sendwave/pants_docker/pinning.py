@@ -0,0 +1,110 @@
+"""Pin the base images of Dockerfiles to immutable digests.
+
+With `--sendwave-docker-pin-base-images` the `base_image` (&
+`builder_image`) of a target, e.g. `python:3.8.8-slim-buster`, is
+resolved to the digest of the manifest it points to and written in the
+Dockerfile as `python:3.8.8-slim-buster@sha256:...`. The image (and
+its fingerprint) then only changes when the resolved digest does,
+rather than whenever the tag is moved upstream.
+
+Digests are resolved with the registry API by scripts/registry.py,
+which caches them in the plugin's pants named cache until they are
+older than `--sendwave-docker-base-image-ttl`, so builds within the
+TTL don't contact any registry. Private registries are logged in to
+with the credentials saved by `docker login`. With
+`--sendwave-docker-base-image-registry` base images are resolved
+against, & pinned to their copy in, that registry.
+"""
+import json
+import logging
+import pkgutil
+from dataclasses import dataclass
+from typing import Tuple
+
+from pants.core.util_rules.system_binaries import PythonBinary
+from pants.engine.environment import Environment, EnvironmentRequest
+from pants.engine.process import Process, ProcessCacheScope, ProcessResult
+from pants.engine.rules import Get, collect_rules, rule
+from sendwave.pants_docker.binary import CACHE_DIR, CACHE_NAME
+from sendwave.pants_docker.subsystem import Docker
+
+logger = logging.getLogger(__name__)
+
+# the cache of resolved digests, in the CACHE_NAME named cache
+PINS_FILE = f"{CACHE_DIR}/base_images.json"
+# used by urllib to reach registries through a proxy
+PROXY_ENV_VARS = ("HTTP_PROXY", "HTTPS_PROXY", "NO_PROXY")
+
+
+@dataclass(frozen=True)
+class PinImagesRequest:
+    """Image references to pin to digests."""
+
+    references: Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class PinnedImages:
+    """Image references, each with the reference pinned to its digest."""
+
+    pins: Tuple[Tuple[str, str], ...]
+
+    def get(self, reference: str) -> str:
+        return dict(self.pins)[reference]
+
+
+@rule
+async def pin_images(
+    request: PinImagesRequest, docker: Docker, python: PythonBinary
+) -> PinnedImages:
+    """Resolve image references to digests, using the cached digests
+    until they expire."""
+    script = pkgutil.get_data("sendwave.pants_docker.scripts", "registry.py")
+    assert script is not None
+    registry_args: Tuple[str, ...] = ()
+    if docker.options.base_image_registry:
+        registry_args = ("--registry", docker.options.base_image_registry)
+    # HOME & DOCKER_CONFIG locate the `docker login` credentials, and
+    # PATH any credential helper storing them
+    env = await Get(
+        Environment,
+        EnvironmentRequest(("HOME", "DOCKER_CONFIG", "PATH", *PROXY_ENV_VARS)),
+    )
+    result = await Get(
+        ProcessResult,
+        Process(
+            argv=(
+                python.path,
+                "-c",
+                script.decode("utf-8"),
+                "resolve",
+                "--cache",
+                PINS_FILE,
+                "--ttl",
+                str(docker.options.base_image_ttl),
+                *registry_args,
+                *request.references,
+            ),
+            env=env,
+            description="Resolving base images {}".format(
+                ", ".join(request.references)
+            ),
+            # the TTL is applied by the script, against its own cache
+            cache_scope=ProcessCacheScope.PER_SESSION,
+            append_only_caches={CACHE_NAME: CACHE_DIR},
+        ),
+    )
+    if result.stderr:
+        logger.warning(result.stderr.decode(errors="replace").strip())
+    pinned = json.loads(result.stdout)
+    return PinnedImages(
+        tuple(
+            (reference, pinned[reference]) for reference in request.references
+        )
+    )
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
@@ -0,0 +1,183 @@
+"""Write the Dockerfile & build context plan of images, without building them.
+
+`./pants docker-plan ::` creates the Dockerfile & build context of
+every `docker` target given, exactly as `package` would, but never runs
+docker (so no docker daemon, or docker CLI, is needed). For each target
+it writes, under `dist/docker-plan/{target}/`:
+
+- `Dockerfile`, and `base.Dockerfile` when the image is built from a
+  shared base image (see `--sendwave-docker-share-base-images`)
+- `plan.json`: the image's fingerprint, the number of layers its
+  Dockerfile creates, the size & number of files of its build context,
+  the size of each directory copied into the image, and the path, size
+  & digest of every file in the build context
+
+and logs a one line summary of each. The contexts of all targets are
+created concurrently by pants, so checking the Dockerfiles of many
+images takes little more than resolving their dependencies.
+"""
+import json
+from dataclasses import dataclass
+from typing import Dict, Iterable, Tuple
+
+from pants.core.util_rules.distdir import DistDir
+from pants.engine.console import Console
+from pants.engine.fs import (
+    CreateDigest,
+    Digest,
+    DigestEntries,
+    FileContent,
+    FileEntry,
+    Workspace,
+)
+from pants.engine.goal import Goal, GoalSubsystem
+from pants.engine.rules import Get, MultiGet, collect_rules, goal_rule
+from pants.engine.target import Targets
+from sendwave.pants_docker.metrics import count_layers
+from sendwave.pants_docker.package import DockerBuildContext
+from sendwave.pants_docker.target import DockerPackageFieldSet
+
+PLAN_DIR = "docker-plan"
+
+
+@dataclass(frozen=True)
+class ContextFile:
+    """A file in a build context."""
+
+    path: str
+    size: int
+    digest: str
+
+
+def copied_directories(dockerfile: str) -> Tuple[str, ...]:
+    """The build context directories a Dockerfile copies into the image."""
+    directories = []
+    for line in dockerfile.splitlines():
+        words = line.split()
+        if not words or words[0].upper() != "COPY":
+            continue
+        flags = [w for w in words[1:-1] if w.startswith("--")]
+        if any(flag.startswith("--from") for flag in flags):
+            # copied from another stage or image, not the build context
+            continue
+        directories.extend(w for w in words[1:-1] if w not in flags)
+    return tuple(directories)
+
+
+def plan_report(
+    target: str,
+    fingerprint: str,
+    dockerfile: str,
+    files: Iterable[ContextFile],
+) -> Dict:
+    """Summarize the Dockerfile & build context of an image."""
+    files = sorted(files, key=lambda f: f.path)
+    copied = {
+        directory: sum(
+            f.size
+            for f in files
+            if f.path == directory
+            or f.path.startswith(directory.rstrip("/") + "/")
+        )
+        for directory in copied_directories(dockerfile)
+    }
+    return {
+        "target": target,
+        "fingerprint": fingerprint,
+        "layers": count_layers(dockerfile),
+        "context_bytes": sum(f.size for f in files),
+        "context_files": len(files),
+        "copied_bytes": copied,
+        "files": [
+            {"path": f.path, "bytes": f.size, "digest": f.digest} for f in files
+        ],
+    }
+
+
+class DockerPlanSubsystem(GoalSubsystem):
+    name = "docker-plan"
+    help = (
+        "Write the Dockerfile & a manifest of the build context of `docker` "
+        "targets under dist/, without building them."
+    )
+
+
+class DockerPlan(Goal):
+    subsystem_cls = DockerPlanSubsystem
+
+
+@goal_rule
+async def docker_plan(
+    targets: Targets,
+    console: Console,
+    workspace: Workspace,
+    dist_dir: DistDir,
+) -> DockerPlan:
+    field_sets = [
+        DockerPackageFieldSet.create(target)
+        for target in targets
+        if DockerPackageFieldSet.is_applicable(target)
+    ]
+    contexts = await MultiGet(
+        Get(DockerBuildContext, DockerPackageFieldSet, field_set)
+        for field_set in field_sets
+    )
+    context_entries = await MultiGet(
+        Get(DigestEntries, Digest, context.digest) for context in contexts
+    )
+    plan_files = []
+    for field_set, context, entries in zip(
+        field_sets, contexts, context_entries
+    ):
+        directory = f"{PLAN_DIR}/{field_set.address.path_safe_spec}"
+        report = plan_report(
+            str(field_set.address),
+            context.fingerprint,
+            context.dockerfile,
+            (
+                ContextFile(
+                    entry.path,
+                    entry.file_digest.serialized_bytes_length,
+                    entry.file_digest.fingerprint,
+                )
+                for entry in entries
+                if isinstance(entry, FileEntry)
+            ),
+        )
+        plan_files.extend(
+            [
+                FileContent(
+                    f"{directory}/Dockerfile", context.dockerfile.encode()
+                ),
+                FileContent(
+                    f"{directory}/plan.json",
+                    json.dumps(report, indent=2).encode(),
+                ),
+            ]
+        )
+        if context.base:
+            plan_files.append(
+                FileContent(
+                    f"{directory}/base.Dockerfile",
+                    context.base.dockerfile.encode(),
+                )
+            )
+        console.print_stdout(
+            "{}: {} layers, {} files, {} bytes -> {}/{}".format(
+                field_set.address,
+                report["layers"],
+                report["context_files"],
+                report["context_bytes"],
+                dist_dir.relpath,
+                directory,
+            )
+        )
+    plan_digest = await Get(Digest, CreateDigest(plan_files))
+    workspace.write_digest(plan_digest, path_prefix=str(dist_dir.relpath))
+    return DockerPlan(exit_code=0)
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
@@ -0,0 +1,165 @@
+"""Push images to their registries.
+
+`./pants docker-push ::` builds every `docker` target given which has
+a `registry` (as `package` would) and then pushes all the tags of all
+of those images in a single process (see the `push` command of
+scripts/registry.py), rather than with one `docker push` per tag:
+
+- at most `--sendwave-docker-push-concurrency` requests are sent to
+  registries at once, across all images
+- each blob (layer or image config) is checked for once per registry,
+  however many images & tags share it, and only uploaded when the
+  registry doesn't have it yet. Blobs already pushed to another
+  repository of the registry are mounted from that repository.
+
+Images are read from the tarball they were packaged as, when built by
+the 'oci' backend or exported with `--sendwave-docker-export-image`,
+and otherwise from the docker daemon with `docker save`.
+Registries are logged in to with the credentials stored by `docker
+login`, whether in docker's config.json or in the credential helpers it
+configures (`credHelpers` & `credsStore`), which are looked up on the
+PATH.
+"""
+import logging
+import pkgutil
+import shlex
+
+from pants.core.goals.package import BuiltPackage
+from pants.core.util_rules.system_binaries import BashBinary
+from pants.engine.console import Console
+from pants.engine.environment import Environment, EnvironmentRequest
+from pants.engine.fs import CreateDigest, Digest, FileContent, MergeDigests
+from pants.engine.goal import Goal, GoalSubsystem
+from pants.engine.process import (
+    FallibleProcessResult,
+    Process,
+    ProcessCacheScope,
+)
+from pants.engine.rules import Get, MultiGet, collect_rules, goal_rule
+from pants.engine.target import Targets
+from sendwave.pants_docker.binary import DockerBinary
+from sendwave.pants_docker.package import _build_tags, _image_path
+from sendwave.pants_docker.pinning import PROXY_ENV_VARS
+from sendwave.pants_docker.subsystem import BuildBackend, Docker
+from sendwave.pants_docker.target import DockerPackageFieldSet
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_SCRIPT = "__registry.py"
+# images read from the docker daemon are saved to this archive
+SAVED_IMAGES = "__images.tar"
+
+
+class DockerPushSubsystem(GoalSubsystem):
+    name = "docker-push"
+    help = (
+        "Build `docker` targets with a `registry` & push all of their tags, "
+        "uploading each layer at most once."
+    )
+
+
+class DockerPush(Goal):
+    subsystem_cls = DockerPushSubsystem
+
+
+@goal_rule
+async def docker_push(
+    targets: Targets,
+    console: Console,
+    docker: Docker,
+    docker_binary: DockerBinary,
+    bash: BashBinary,
+) -> DockerPush:
+    field_sets = []
+    for target in targets:
+        if not DockerPackageFieldSet.is_applicable(target):
+            continue
+        field_set = DockerPackageFieldSet.create(target)
+        if field_set.registry.value:
+            field_sets.append(field_set)
+        else:
+            logger.warning(
+                "Not pushing %s, which has no `registry`", field_set.address
+            )
+    if not field_sets:
+        return DockerPush(exit_code=0)
+    packages = await MultiGet(
+        Get(BuiltPackage, DockerPackageFieldSet, field_set)
+        for field_set in field_sets
+    )
+    script = pkgutil.get_data("sendwave.pants_docker.scripts", "registry.py")
+    assert script is not None
+    env, script_digest, packages_digest = await MultiGet(
+        Get(
+            Environment,
+            EnvironmentRequest(("HOME", "PATH", *PROXY_ENV_VARS)),
+        ),
+        Get(Digest, CreateDigest([FileContent(REGISTRY_SCRIPT, script)])),
+        Get(Digest, MergeDigests(package.digest for package in packages)),
+    )
+    input_digest = await Get(
+        Digest, MergeDigests([script_digest, packages_digest])
+    )
+    push_argv = [
+        docker_binary.python,
+        REGISTRY_SCRIPT,
+        "push",
+        "--concurrency",
+        str(docker.options.push_concurrency),
+    ]
+    if docker.options.backend == BuildBackend.oci or (
+        docker.options.backend == BuildBackend.docker
+        and docker.options.export_image
+    ):
+        # the images were packaged as tarballs, at their target's image
+        # path
+        for field_set, package in zip(field_sets, packages):
+            archive = _image_path(field_set)
+            if not any(
+                artifact.relpath == archive for artifact in package.artifacts
+            ):
+                console.print_stderr(
+                    f"The image of {field_set.address} was not packaged at "
+                    f"{archive}, so it can't be pushed"
+                )
+                return DockerPush(exit_code=1)
+            push_argv.append(archive)
+        command = shlex.join(push_argv)
+    else:
+        tags = [
+            tag
+            for field_set in field_sets
+            for tag in _build_tags(
+                field_set.address.target_name,
+                field_set.tags.value or [],
+                field_set.registry.value,
+            )
+        ]
+        save_argv = [docker_binary.path, "save", "--output", SAVED_IMAGES]
+        command = "{} && {}".format(
+            shlex.join([*save_argv, *tags]),
+            shlex.join([*push_argv, SAVED_IMAGES]),
+        )
+    result = await Get(
+        FallibleProcessResult,
+        Process(
+            argv=(bash.path, "-c", command),
+            env={**env, **docker_binary.env},
+            input_digest=input_digest,
+            description="Pushing {} images".format(len(field_sets)),
+            cache_scope=ProcessCacheScope.PER_SESSION,
+        ),
+    )
+    if result.exit_code != 0:
+        console.print_stderr(result.stderr.decode(errors="replace"))
+        return DockerPush(exit_code=result.exit_code)
+    for field_set in field_sets:
+        console.print_stdout(f"Pushed {field_set.address}")
+    console.print_stdout(result.stdout.decode(errors="replace"))
+    return DockerPush(exit_code=0)
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
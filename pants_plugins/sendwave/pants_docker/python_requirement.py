@@ -1,12 +1,38 @@
+import json
 import logging
+import re
 from dataclasses import dataclass
-from typing import Any, Optional
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
+import sendwave.pants_docker.utils as utils
+from packaging.markers import Marker
+from packaging.requirements import Requirement
 from pants.backend.python.subsystems.repos import PythonRepos
 from pants.backend.python.subsystems.setup import PythonSetup
 from pants.backend.python.target_types import PythonRequirementsField
+from pants.backend.python.util_rules.pex import Pex, PexPlatforms
+from pants.backend.python.util_rules.pex_from_targets import (
+    PexFromTargetsRequest,
+)
 from pants.core.util_rules.system_binaries import BinaryPathRequest, BinaryPaths
-from pants.engine.fs import Digest, GlobMatchErrorBehavior, PathGlobs
+from pants.engine.addresses import Address
+from pants.engine.fs import (
+    CreateDigest,
+    Digest,
+    DigestContents,
+    FileContent,
+    GlobMatchErrorBehavior,
+    PathGlobs,
+)
 from pants.engine.rules import Get, collect_rules, rule
 from pants.engine.target import FieldSet
 from pants.engine.unions import UnionRule
@@ -15,23 +41,273 @@ from sendwave.pants_docker.docker_component import (
     DockerComponent,
     DockerComponentFieldSet,
 )
+from sendwave.pants_docker.layers import VIRTUAL_ENV_DIR
+from sendwave.pants_docker.subsystem import Docker
 
 logger = logging.getLogger(__name__)
 
+# name of the generated file (in the build context) listing every
+# requirement installed when requirements are batched together
+REQUIREMENTS_FILE = "pants_docker_requirements.txt"
+# name of the PEX (in the build context) holding every third-party
+# requirement when the virtual env is built by pants
+VIRTUAL_ENV_PEX = "pants_docker_venv.pex"
+# name of the generated file (in the build context) pinning every
+# requirement of an image, with hashes, from its resolve's lockfile
+LOCKFILE_REQUIREMENTS = "pants_docker_lockfile.txt"
+
+# comparisons of the `extra` variable in environment markers, e.g.
+# `extra == "socks"`
+EXTRA_COMPARISON = re.compile(
+    r"""extra\s*(?P<op>==|!=)\s*(?P<q>["'])(?P<name>.*?)(?P=q)"""
+    r"""|(?P<rq>["'])(?P<rname>.*?)(?P=rq)\s*(?P<rop>==|!=)\s*extra"""
+)
+# `extra` comparisons which pip evaluates as true & as false
+TRUE_EXTRA = 'extra == ""'
+FALSE_EXTRA = 'extra != ""'
+# the string literals, & the variables & word operators, of environment
+# markers
+MARKER_STRING = re.compile(r"""(["']).*?\1""")
+MARKER_NAME = re.compile(r"[A-Za-z_.]+")
+
+# the platforms of legacy manylinux tags, as named by PEP 600
+MANYLINUX_ALIASES = (
+    ("manylinux1_", "manylinux_2_5_"),
+    ("manylinux2010_", "manylinux_2_12_"),
+    ("manylinux2014_", "manylinux_2_17_"),
+)
+
 
 @dataclass(frozen=True)
 class VirtualEnvRequest:
     enable_resolves: bool
     requirement_constraints: Optional[str]
+    # use a BuildKit cache mount for pip's download cache
+    cache_mounts: bool = False
+    # don't compile bytecode when installing requirements
+    reproducible: bool = False
+    # with resolves enabled: the lockfile of the image's resolve, and
+    # the requirements of the image to install from it
+    lockfile: Optional[str] = None
+    requirements: Tuple[str, ...] = ()
+    # the PEX platforms of the image's interpreter, which select the
+    # resolve of a lockfile locked for several platforms
+    platforms: Tuple[str, ...] = ()
+
+
+def _canonical_name(name: str) -> str:
+    """Normalize a project name as described in PEP 503."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _resolve_extra(match: "re.Match[str]", extras: FrozenSet[str]) -> str:
+    """Replace an `extra` comparison with one pip evaluates the same way
+    for the requested `extras`: pip evaluates the markers of a
+    requirements file with `extra` set to an empty string."""
+    op = match.group("op") or match.group("rop")
+    name = match.group("name") if match.group("op") else match.group("rname")
+    requested = _canonical_name(name) in extras
+    return TRUE_EXTRA if requested == (op == "==") else FALSE_EXTRA
+
+
+def _requirement_marker(
+    requirement: Requirement, extras: FrozenSet[str]
+) -> Union[bool, str]:
+    """The marker a requirement is needed under when `extras` of the
+    project requiring it are installed.
+
+    `extra` comparisons are evaluated for `extras`. Returns True or
+    False when the marker only depends on them, otherwise the marker,
+    which pip evaluates with the image's interpreter.
+    """
+    if requirement.marker is None:
+        return True
+    marker = str(
+        Marker(
+            EXTRA_COMPARISON.sub(
+                lambda match: _resolve_extra(match, extras),
+                str(requirement.marker),
+            )
+        )
+    )
+    if " or " not in marker:
+        # a conjunction, e.g. `python_version < "3.8" and extra == "x"`
+        # as written by wheels: false if any `extra` comparison is
+        if FALSE_EXTRA in marker:
+            return False
+        terms = [term for term in marker.split(" and ") if term != TRUE_EXTRA]
+        return " and ".join(terms) if terms else True
+    # the marker's variables & operators, without its string literals
+    names = set(MARKER_NAME.findall(MARKER_STRING.sub("", marker)))
+    if names <= {"extra", "and", "or", "not", "in"}:
+        return Marker(marker).evaluate({"extra": ""})
+    return "({})".format(marker)
+
+
+def _normalize_platform_tag(tag: Iterable[str]) -> Tuple[str, ...]:
+    """Name the legacy manylinux platform of a tag as PEP 600 does."""
+    normalized = []
+    for part in tag:
+        for legacy, alias in MANYLINUX_ALIASES:
+            if part.startswith(legacy):
+                part = alias + part[len(legacy) :]
+        normalized.append(part)
+    return tuple(normalized)
+
+
+def _platform_tag(platform: str) -> Tuple[str, ...]:
+    """The (interpreter, abi, platform) tag of a PEX platform, e.g.
+    `manylinux2014_x86_64-cp-38-cp38`, as recorded by PEX lockfiles."""
+    name, implementation, version, abi = platform.rsplit("-", 3)
+    return _normalize_platform_tag((implementation + version, abi, name))
+
+
+def _locked_resolve(
+    lock: Dict[str, Any], platforms: Iterable[str]
+) -> Dict[str, Any]:
+    """The resolve of a PEX lock to install requirements from.
+
+    Universal locks hold a single resolve for every platform, otherwise
+    the lock holds one resolve per platform & the one for `platforms`
+    is used.
+    """
+    resolves = lock["locked_resolves"]
+    if len(resolves) == 1:
+        return resolves[0]
+    tags = {_platform_tag(platform) for platform in platforms}
+    matching = [
+        resolve
+        for resolve in resolves
+        if resolve.get("platform_tag")
+        and _normalize_platform_tag(resolve["platform_tag"]) in tags
+    ]
+    if len(matching) == 1:
+        return matching[0]
+    raise ValueError(
+        "The lockfile holds a resolve for each of the platforms {}, set "
+        "`python_platforms` on the `docker` target to the platform of its "
+        "base image's interpreter to install from one of them".format(
+            ", ".join(
+                "-".join(resolve.get("platform_tag") or ("universal",))
+                for resolve in resolves
+            )
+        )
+    )
+
+
+def _format_conditions(conditions: Iterable[FrozenSet[str]]) -> str:
+    """Join the alternative conditions a project is needed under into
+    one marker, or an empty string if it is always needed."""
+    alternatives = sorted(" and ".join(sorted(c)) for c in conditions)
+    if "" in alternatives:
+        return ""
+    return " or ".join(alternatives)
+
+
+def _lockfile_requirements(
+    lockfile: str, requirements: Iterable[str], platforms: Iterable[str] = ()
+) -> str:
+    """Convert a pants lockfile into a hash-pinned pip requirements file.
+
+    PEX (JSON) lockfiles are reduced to the subset of locked projects
+    `requirements` depend on, each pinned to its locked version & the
+    hashes of its artifacts. Dependencies on extras are only followed
+    for the extras requested, and the environment markers of
+    dependencies are written to the requirements file, so pip skips the
+    projects the image's interpreter doesn't need. Lockfiles generated
+    by pip are already requirements files & are returned without their
+    header.
+    """
+    body = "".join(
+        line
+        for line in lockfile.splitlines(keepends=True)
+        if not line.startswith("//")
+    )
+    if not body.lstrip().startswith("{"):
+        return "".join(
+            line
+            for line in body.splitlines(keepends=True)
+            if not line.startswith("#")
+        )
+    locked_resolve = _locked_resolve(json.loads(body), platforms)
+    locked: Dict[str, Dict[str, Any]] = {
+        _canonical_name(req["project_name"]): req
+        for req in locked_resolve["locked_requirements"]
+    }
+    # each (project, extra) needed, with the alternative conditions it
+    # is needed under: each a set of markers which must all be true
+    conditions: Dict[Tuple[str, Optional[str]], List[FrozenSet[str]]] = {}
+    # requirements to add, with the condition they are needed under &
+    # whether the image requires them directly
+    pending: List[Tuple[Requirement, FrozenSet[str], bool]] = []
+
+    def require(
+        requirement: Requirement,
+        extras: FrozenSet[str],
+        condition: FrozenSet[str],
+        direct: bool = False,
+    ) -> None:
+        marker = _requirement_marker(requirement, extras)
+        if marker is True:
+            pending.append((requirement, condition, direct))
+        elif marker is not False:
+            pending.append((requirement, condition | {marker}, direct))
+
+    for req in requirements:
+        require(Requirement(req), frozenset(), frozenset(), direct=True)
+    while pending:
+        requirement, condition, direct = pending.pop()
+        name = _canonical_name(requirement.name)
+        if name not in locked:
+            if direct or not condition:
+                raise ValueError(
+                    "{} is not in the lockfile, which may be out of date: "
+                    "regenerate it with `./pants generate-lockfiles`".format(
+                        requirement
+                    )
+                )
+            # a dependency only needed under markers which exclude every
+            # platform the lockfile was generated for
+            continue
+        for extra in (None, *sorted(requirement.extras)):
+            extra = extra and _canonical_name(extra)
+            known = conditions.setdefault((name, extra), [])
+            if any(c <= condition for c in known):
+                # needed under a weaker condition already
+                continue
+            known[:] = [c for c in known if not condition <= c]
+            known.append(condition)
+            extras = frozenset([extra]) if extra else frozenset()
+            for dist in locked[name]["requires_dists"]:
+                require(Requirement(dist), extras, condition)
+    lines = []
+    for name in sorted(name for name, extra in conditions if extra is None):
+        marker = _format_conditions(conditions[(name, None)])
+        hashes = "".join(
+            " \\\n    --hash={}:{}".format(
+                artifact["algorithm"], artifact["hash"]
+            )
+            for artifact in locked[name]["artifacts"]
+        )
+        lines.append(
+            "{}=={}{}{}\n".format(
+                name,
+                locked[name]["version"],
+                " ; {}".format(marker) if marker else "",
+                hashes,
+            )
+        )
+    return "".join(lines)
 
 
 @rule
 async def create_virtual_env(
     resolve_request: VirtualEnvRequest,
 ) -> DockerComponent:
-    assert (
-        not resolve_request.enable_resolves
-    ), "Pants lockfiles not yet supported"
+    if resolve_request.enable_resolves:
+        return await Get(
+            DockerComponent, LockfileVirtualEnvRequest(resolve_request)
+        )
 
     copy_command = []
     sources = None
@@ -55,8 +331,12 @@ async def create_virtual_env(
                 "RUN python -m venv --upgrade /.virtual_env\n",
                 "ENV PATH=/.virtual_env/bin:$PATH\n",
                 "ENV VIRTUAL_ENV=/.virtual_env\n",
-                "RUN python -m pip install --upgrade pip{}\n".format(
-                    pip_upgrade_constraint
+                "{} --upgrade pip{}\n".format(
+                    _pip_install(
+                        resolve_request.cache_mounts,
+                        resolve_request.reproducible,
+                    ),
+                    pip_upgrade_constraint,
                 ),
             ]
         ),
@@ -64,20 +344,102 @@ async def create_virtual_env(
     )
 
 
+@dataclass(frozen=True)
+class LockfileVirtualEnvRequest:
+    """Create a virtual env for a VirtualEnvRequest with resolves enabled."""
+
+    request: VirtualEnvRequest
+
+
+@rule
+async def create_lockfile_virtual_env(
+    lockfile_request: LockfileVirtualEnvRequest,
+    setup: PythonSetup,
+    repos: PythonRepos,
+) -> DockerComponent:
+    """Install an image's requirements exactly as pinned by its lockfile.
+
+    Every requirement is installed with `--no-deps --require-hashes`
+    from a requirements file generated from the lockfile, so pip does
+    no dependency resolution & the layer only depends on the content
+    of the lockfile (& the base image). The pip bundled with the base
+    image's python is used rather than upgrading it, which would
+    install an unpinned version of pip from the index.
+    """
+    request = lockfile_request.request
+    if not request.lockfile:
+        raise ValueError(
+            "Installing requirements from a resolve requires the resolve's "
+            "lockfile, set it in `[python].resolves`"
+        )
+    lockfile_contents = await Get(
+        DigestContents,
+        PathGlobs(
+            [request.lockfile],
+            glob_match_error_behavior=GlobMatchErrorBehavior.error,
+            description_of_origin="the option `[python].resolves`",
+        ),
+    )
+    requirements_file = _lockfile_requirements(
+        lockfile_contents[0].content.decode("utf-8"),
+        request.requirements,
+        request.platforms,
+    )
+    sources = await Get(
+        Digest,
+        CreateDigest(
+            [
+                FileContent(
+                    LOCKFILE_REQUIREMENTS, requirements_file.encode("utf-8")
+                )
+            ]
+        ),
+    )
+    index_args, links_args, _ = _pip_arguments(setup, repos)
+    pip_install = _pip_install(request.cache_mounts, request.reproducible)
+    return DockerComponent(
+        commands=(
+            "COPY application/{} .\n".format(LOCKFILE_REQUIREMENTS),
+            "RUN python -m venv --upgrade /.virtual_env\n",
+            "ENV PATH=/.virtual_env/bin:$PATH\n",
+            "ENV VIRTUAL_ENV=/.virtual_env\n",
+            "{} {} {} --no-deps --require-hashes -r {}\n".format(
+                pip_install, index_args, links_args, LOCKFILE_REQUIREMENTS
+            ),
+        ),
+        sources=sources,
+    )
+
+
 @dataclass(frozen=True)
 class PythonRequirementsFS(FieldSet):
     required_fields = (PythonRequirementsField,)
     requirements: PythonRequirementsField
 
 
-@rule
-async def get_requirements(
-    field_set: PythonRequirementsFS, setup: PythonSetup, repos: PythonRepos
-) -> DockerComponent:
-    assert not setup.enable_resolves, "Pants lockfiles not yet supported"
+def _pip_install(cache_mounts: bool, reproducible: bool = False) -> str:
+    """Return the start of a RUN instruction running `pip install`.
+
+    With cache mounts pip's download cache persists between builds. In
+    reproducible builds pip doesn't compile bytecode, as compiled files
+    record the time they were installed.
+    """
+    mount = " {}".format(utils.PIP_CACHE_MOUNT) if cache_mounts else ""
+    no_compile = " --no-compile" if reproducible else ""
+    return "RUN{} python -m pip install{}".format(mount, no_compile)
+
+
+def _pip_arguments(
+    setup: PythonSetup, repos: PythonRepos
+) -> Tuple[str, str, str]:
+    """Build the index, find-links & constraint arguments for `pip install`.
+
+    Returned as a tuple of (index_args, links_args, constraint_arg)
+    so that each can be formatted into a pip command line.
+    """
     if repos.repos:
         links_args = " ".join(
-            "--find-links {}".format(repo for repo in repos.repos)
+            "--find-links {}".format(repo) for repo in repos.repos
         )
     else:
         links_args = ""
@@ -93,10 +455,26 @@ async def get_requirements(
     constraint_arg = ""
     if setup.requirement_constraints:
         constraint_arg = f"--constraint {setup.requirement_constraints}"
+    return index_args, links_args, constraint_arg
+
 
+@rule
+async def get_requirements(
+    field_set: PythonRequirementsFS,
+    setup: PythonSetup,
+    repos: PythonRepos,
+    docker: Docker,
+) -> DockerComponent:
+    assert (
+        not setup.enable_resolves
+    ), "with resolves enabled requirements are installed from the lockfile"
+    index_args, links_args, constraint_arg = _pip_arguments(setup, repos)
+    pip_install = _pip_install(
+        docker.options.buildkit_cache_mounts, docker.options.reproducible
+    )
     commands = tuple(
-        "RUN python -m pip install {} {} {} {}\n".format(
-            index_args, links_args, constraint_arg, lib
+        "{} {} {} {} {}\n".format(
+            pip_install, index_args, links_args, constraint_arg, lib
         )
         for lib in field_set.requirements.value
     )
@@ -106,6 +484,127 @@ async def get_requirements(
     )
 
 
+@dataclass(frozen=True)
+class RequirementsFileRequest:
+    """Install every third-party requirement of an image at once.
+
+    The requirements are written to a single requirements file in the
+    build context & installed with one `pip install -r`, so that pip
+    resolves the full set of dependencies once, in a single layer.
+    """
+
+    requirements: Tuple[str, ...]
+
+
+@rule
+async def create_requirements_file(
+    request: RequirementsFileRequest,
+    setup: PythonSetup,
+    repos: PythonRepos,
+    docker: Docker,
+) -> DockerComponent:
+    assert (
+        not setup.enable_resolves
+    ), "with resolves enabled requirements are installed from the lockfile"
+    contents = "".join(f"{req}\n" for req in request.requirements)
+    sources = await Get(
+        Digest,
+        CreateDigest(
+            [FileContent(REQUIREMENTS_FILE, contents.encode("utf-8"))]
+        ),
+    )
+    index_args, links_args, constraint_arg = _pip_arguments(setup, repos)
+    return DockerComponent(
+        commands=(
+            "COPY application/{} .\n".format(REQUIREMENTS_FILE),
+            "{} {} {} {} -r {}\n".format(
+                _pip_install(
+                    docker.options.buildkit_cache_mounts,
+                    docker.options.reproducible,
+                ),
+                index_args,
+                links_args,
+                constraint_arg,
+                REQUIREMENTS_FILE,
+            ),
+        ),
+        sources=sources,
+    )
+
+
+@dataclass(frozen=True)
+class PexVirtualEnvRequest:
+    """Build the third-party requirements of an image into a PEX.
+
+    addresses: the python_requirement targets to include
+    platforms: PEX platforms matching the base image's interpreter, or
+        empty to resolve for the local interpreter
+    cache_mounts: the image is built with BuildKit, so the PEX can be
+        bind mounted rather than copied into the image
+    """
+
+    addresses: Tuple[Address, ...]
+    platforms: Tuple[str, ...]
+    cache_mounts: bool = False
+
+
+@rule
+async def create_pex_virtual_env(
+    request: PexVirtualEnvRequest,
+) -> DockerComponent:
+    """Resolve third-party requirements with pants, outside the image.
+
+    The requirements are resolved into a PEX by the pants python
+    backend - using the constraints file or lockfile, [python-repos]
+    and the process cache exactly as `pex_binary` targets do - and the
+    image only runs the PEX's venv tool to lay the PEX out as a virtual
+    env. Nothing is downloaded or built during `docker build`.
+
+    The PEX is placed in the build context under VIRTUAL_ENV_DIR,
+    which (unlike other component sources) is not copied into the
+    image's working directory.
+    """
+    pex = await Get(
+        Pex,
+        PexFromTargetsRequest(
+            request.addresses,
+            output_filename=VIRTUAL_ENV_PEX,
+            internal_only=False,
+            include_source_files=False,
+            platforms=PexPlatforms(request.platforms),
+            additional_args=("--include-tools",),
+            description="Resolving third-party requirements for the image",
+        ),
+    )
+    context_path = "{}/{}".format(VIRTUAL_ENV_DIR, pex.name)
+    venv_command = "PEX_TOOLS=1 python {} venv /.virtual_env"
+    if request.cache_mounts:
+        # read the PEX straight from the build context, so that it is
+        # not stored in a layer of the image
+        install_commands = [
+            "RUN --mount=type=bind,source={},target=/tmp/{} {}\n".format(
+                context_path,
+                pex.name,
+                venv_command.format("/tmp/{}".format(pex.name)),
+            )
+        ]
+    else:
+        install_commands = [
+            "COPY {} /tmp/{}\n".format(context_path, pex.name),
+            "RUN {} && rm /tmp/{}\n".format(
+                venv_command.format("/tmp/{}".format(pex.name)), pex.name
+            ),
+        ]
+    return DockerComponent(
+        commands=(
+            *install_commands,
+            "ENV PATH=/.virtual_env/bin:$PATH\n",
+            "ENV VIRTUAL_ENV=/.virtual_env\n",
+        ),
+        sources=pex.digest,
+    )
+
+
 def rules():
     return [
         UnionRule(DockerComponentFieldSet, PythonRequirementsFS),
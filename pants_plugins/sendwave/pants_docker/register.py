@@ -1,6 +1,14 @@
 """Register Sendwave pants-docker plugin rules with the pants build system."""
+import sendwave.pants_docker.binary as binary
+import sendwave.pants_docker.incremental as incremental
+import sendwave.pants_docker.layers as layers
+import sendwave.pants_docker.oci as oci
 import sendwave.pants_docker.package as package
+import sendwave.pants_docker.pinning as pinning
+import sendwave.pants_docker.plan as plan
+import sendwave.pants_docker.push as push
 import sendwave.pants_docker.python_requirement as python_requirement
+import sendwave.pants_docker.size_report as size_report
 import sendwave.pants_docker.sources as sources
 import sendwave.pants_docker.subsystem as subsystem
 import sendwave.pants_docker.target as target
@@ -10,7 +18,15 @@ def rules():
     """Collect all pants rules in the plugin."""
     return [
         *subsystem.rules(),
+        *binary.rules(),
+        *incremental.rules(),
         *package.rules(),
+        *layers.rules(),
+        *oci.rules(),
+        *pinning.rules(),
+        *plan.rules(),
+        *push.rules(),
+        *size_report.rules(),
         *sources.rules(),
         *python_requirement.rules(),
         *target.rules(),
@@ -0,0 +1,214 @@
+"""Report the size of each layer of an image, & where it came from.
+
+Run by the plugin (with `python -c`) inside a pants process sandbox,
+with an image tarball written by `docker save`. Only depends on the
+python standard library.
+
+Each layer of the image is matched with the entry of the image's
+history which created it, and attributed to an "origin": the part of
+the target (e.g. its setup commands, third-party requirements, or the
+sources of a directory) which generated the Dockerfile instruction, as
+given by `--origins`, or else to the base image. For every layer the
+report records its uncompressed size, its size once gzipped (i.e.
+about what is pushed to & pulled from registries) and its largest
+files.
+
+The last report of each target is kept (at `--previous`, in a pants
+named cache shared by every sandbox) and each new report includes how
+much the image, & each of its origins, grew or shrank since then.
+"""
+import argparse
+import heapq
+import json
+import os
+import re
+import sys
+import tarfile
+import zlib
+from typing import IO, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+BASE_IMAGE = "base image"
+UNATTRIBUTED = "unattributed"
+# the flags of Dockerfile instructions, e.g. `--mount=type=cache,...`
+FLAG = re.compile(r"^--\S+$")
+CHUNK_SIZE = 1 << 20
+
+
+def instruction_body(instruction: str) -> str:
+    """A Dockerfile instruction without its keyword & flags, as found in
+    the `created_by` of the history entry it creates."""
+    words = instruction.split()[1:]
+    while words and FLAG.match(words[0]):
+        words.pop(0)
+    return " ".join(words)
+
+
+def find_origin(
+    created_by: str, origins: Sequence[Tuple[str, str]]
+) -> Optional[str]:
+    """The origin of the longest instruction found in the `created_by`
+    of a history entry, if any."""
+    created_by = " ".join(created_by.split())
+    matches = []
+    for instruction, origin in origins:
+        body = instruction_body(instruction)
+        if body and body in created_by:
+            matches.append((len(body), origin))
+    return max(matches)[1] if matches else None
+
+
+def _chunks(f: IO[bytes]) -> Iterator[bytes]:
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+def measure_layer(open_layer: Callable[[], IO[bytes]], top: int) -> Dict:
+    """The compressed & uncompressed size of a layer tarball (which may
+    already be gzipped), and its `top` largest files."""
+    with open_layer() as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    compressed = uncompressed = 0
+    with open_layer() as f:
+        if gzipped:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            for chunk in _chunks(f):
+                compressed += len(chunk)
+                uncompressed += len(decompressor.decompress(chunk))
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            for chunk in _chunks(f):
+                uncompressed += len(chunk)
+                compressed += len(compressor.compress(chunk))
+            compressed += len(compressor.flush())
+    largest: List[Tuple[int, str]] = []
+    with open_layer() as f, tarfile.open(fileobj=f, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                heapq.heappush(largest, (member.size, member.name))
+                if len(largest) > top:
+                    heapq.heappop(largest)
+    return {
+        "compressed_bytes": compressed,
+        "uncompressed_bytes": uncompressed,
+        "largest_files": [
+            {"path": path, "bytes": size}
+            for size, path in sorted(largest, reverse=True)
+        ],
+    }
+
+
+def analyze_archive(
+    path: str, origins: Sequence[Tuple[str, str]], top: int
+) -> List[Dict]:
+    """Measure & attribute each layer of the (first) image in an image
+    tarball."""
+    with tarfile.open(path, "r:") as tar:
+        manifest = json.load(tar.extractfile("manifest.json"))[0]
+        config = json.load(tar.extractfile(manifest["Config"]))
+        history = [
+            entry
+            for entry in config.get("history", [])
+            if not entry.get("empty_layer")
+        ]
+        layer_names = manifest["Layers"]
+        # history is only recorded for the last layers when a base
+        # image has none
+        created_by = [""] * (len(layer_names) - len(history)) + [
+            entry.get("created_by", "") for entry in history
+        ][-len(layer_names) :]
+        layers = []
+        # layers before the first one created by the target's own
+        # instructions are the base image's
+        default = BASE_IMAGE
+        for name, command in zip(layer_names, created_by):
+            origin = find_origin(command, origins)
+            if origin is None:
+                origin = default
+            else:
+                default = UNATTRIBUTED
+            sizes = measure_layer(lambda: tar.extractfile(name), top)
+            layers.append({"created_by": command, "origin": origin, **sizes})
+    return layers
+
+
+def build_report(
+    target: str, layers: List[Dict], previous: Optional[Dict] = None
+) -> Dict:
+    """Summarize an image's layers by origin, and compare them with the
+    previous report of the target."""
+    origins: Dict[str, Dict[str, int]] = {}
+    for layer in layers:
+        summary = origins.setdefault(
+            layer["origin"],
+            {"layers": 0, "compressed_bytes": 0, "uncompressed_bytes": 0},
+        )
+        summary["layers"] += 1
+        summary["compressed_bytes"] += layer["compressed_bytes"]
+        summary["uncompressed_bytes"] += layer["uncompressed_bytes"]
+    report = {
+        "target": target,
+        "compressed_bytes": sum(layer["compressed_bytes"] for layer in layers),
+        "uncompressed_bytes": sum(
+            layer["uncompressed_bytes"] for layer in layers
+        ),
+        "origins": origins,
+        "layers": layers,
+    }
+    if previous is not None:
+        report["diff"] = diff_reports(previous, report)
+    return report
+
+
+def diff_reports(previous: Dict, report: Dict) -> Dict:
+    """How much an image, & each origin of it, changed in size."""
+    sizes = ("compressed_bytes", "uncompressed_bytes")
+    empty = dict.fromkeys(sizes, 0)
+    origins = {}
+    for origin in sorted({*previous["origins"], *report["origins"]}):
+        old = previous["origins"].get(origin, empty)
+        new = report["origins"].get(origin, empty)
+        change = {size: new[size] - old[size] for size in sizes}
+        if any(change.values()):
+            origins[origin] = change
+    return {
+        **{size: report[size] - previous[size] for size in sizes},
+        "origins": origins,
+    }
+
+
+def load_report(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--target", required=True)
+    parser.add_argument("--origins", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--previous")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("archive")
+    args = parser.parse_args(argv)
+    with open(args.origins) as f:
+        origins = [tuple(origin) for origin in json.load(f)]
+    layers = analyze_archive(args.archive, origins, args.top)
+    previous = load_report(args.previous) if args.previous else None
+    report = build_report(args.target, layers, previous)
+    contents = json.dumps(report, indent=2, sort_keys=True)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        f.write(contents)
+    if args.previous:
+        # the report without its diff, for the next build to compare with
+        os.makedirs(os.path.dirname(args.previous) or ".", exist_ok=True)
+        with open(args.previous + ".tmp", "w") as f:
+            json.dump({k: v for k, v in report.items() if k != "diff"}, f)
+        os.replace(args.previous + ".tmp", args.previous)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
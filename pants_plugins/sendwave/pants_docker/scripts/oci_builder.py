@@ -0,0 +1,646 @@
+"""Assemble an OCI image archive from a Dockerfile without a docker daemon.
+
+Run by the 'oci' backend of the pants-docker plugin inside a pants
+process sandbox which contains the docker build context & an OCI image
+layout holding the base image. Only depends on the python standard
+library.
+
+Supports the Dockerfile instructions which can be applied to an image
+without running a container: FROM, WORKDIR, ENV, LABEL, COPY, CMD,
+ENTRYPOINT, USER, EXPOSE & ARG. Any other instruction (e.g. RUN) is an
+error. Every COPY instruction produces one gzipped layer, written with
+sorted entries & fixed timestamps & ownership. Layers never depend on
+the layers before them, so `COPY --link` is accepted & has no effect.
+
+The image's creation time is fixed too (the unix epoch, unless given
+a SOURCE_DATE_EPOCH or `--created-now`), so that building the same
+inputs twice writes the same image. The image is written as a tarball
+of an OCI image layout. The tarball
+also contains a docker `manifest.json` so that it can be loaded with
+`docker load`.
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import posixpath
+import re
+import shlex
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER = "application/vnd.oci.image.layer.v1.tar+gzip"
+DOCKER_MANIFEST_LIST = (
+    "application/vnd.docker.distribution.manifest.list.v2+json"
+)
+# docker media types which may be used by the base image & their OCI
+# equivalents
+MEDIA_TYPES = {
+    "application/vnd.docker.container.image.v1+json": OCI_CONFIG,
+    "application/vnd.docker.image.rootfs.diff.tar.gzip": OCI_LAYER,
+    "application/vnd.docker.image.rootfs.diff.tar": (
+        "application/vnd.oci.image.layer.v1.tar"
+    ),
+}
+REF_NAME_ANNOTATION = "org.opencontainers.image.ref.name"
+IMAGE_NAME_ANNOTATION = "io.containerd.image.name"
+
+VARIABLE = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+
+
+class BuildError(Exception):
+    """Raised when an image can not be assembled without a daemon."""
+
+
+def parse_dockerfile(text: str) -> List[Tuple[str, str]]:
+    """Split a Dockerfile into (INSTRUCTION, arguments) pairs.
+
+    Joins lines continued with a trailing backslash & drops comments.
+    """
+    instructions = []
+    current = ""
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        if stripped.endswith("\\"):
+            current += stripped[:-1].rstrip() + " "
+            continue
+        current += stripped
+        keyword, _, arguments = current.partition(" ")
+        instructions.append((keyword.upper(), arguments.strip()))
+        current = ""
+    if current.strip():
+        keyword, _, arguments = current.strip().partition(" ")
+        instructions.append((keyword.upper(), arguments.strip()))
+    return instructions
+
+
+def expand_variables(value: str, env: Dict[str, str]) -> str:
+    """Substitute $NAME & ${NAME} with values from the environment."""
+    return VARIABLE.sub(
+        lambda match: env.get(match.group(1) or match.group(2), ""), value
+    )
+
+
+def parse_key_values(
+    arguments: str, env: Dict[str, str]
+) -> List[Tuple[str, str]]:
+    """Parse the `key=value ...` (or legacy `key value`) arguments of
+    ENV & LABEL instructions."""
+    words = shlex.split(arguments)
+    if words and "=" not in words[0]:
+        key, _, value = arguments.partition(" ")
+        return [(key, expand_variables(value.strip(), env))]
+    pairs = []
+    for word in words:
+        key, _, value = word.partition("=")
+        pairs.append((key, expand_variables(value, env)))
+    return pairs
+
+
+def parse_command(arguments: str) -> List[str]:
+    """Parse the exec (JSON) or shell form of CMD & ENTRYPOINT."""
+    if arguments.startswith("["):
+        try:
+            command = json.loads(arguments)
+        except ValueError:
+            pass
+        else:
+            if isinstance(command, list):
+                return [str(part) for part in command]
+    return ["/bin/sh", "-c", arguments]
+
+
+def split_reference(reference: str) -> Tuple[str, Optional[str], Optional[str]]:
+    """Split an image reference into (repository, tag, digest)."""
+    reference, _, digest = reference.partition("@")
+    repository, tag = reference, None
+    if ":" in reference.rpartition("/")[2]:
+        repository, _, tag = reference.rpartition(":")
+    return repository, tag, digest or None
+
+
+def repo_tag(reference: str) -> str:
+    """Return an image reference in the `repository:tag` form docker
+    expects, defaulting the tag to `latest`."""
+    repository, tag, _ = split_reference(reference)
+    return "{}:{}".format(repository, tag or "latest")
+
+
+def sha256_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    return "sha256:" + hasher.hexdigest()
+
+
+def _platform_name(platform: Dict[str, str]) -> str:
+    name = "{}/{}".format(platform.get("os"), platform.get("architecture"))
+    if platform.get("variant"):
+        name = "{}/{}".format(name, platform["variant"])
+    return name
+
+
+class Layout:
+    """An OCI image layout directory, from which base images are read."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def blob_path(self, digest: str) -> str:
+        algorithm, _, encoded = digest.partition(":")
+        return os.path.join(self.path, "blobs", algorithm, encoded)
+
+    def read_json(self, digest: str) -> dict:
+        with open(self.blob_path(digest), "rb") as f:
+            return json.load(f)
+
+    def find_manifest(self, reference: str, platform: str) -> dict:
+        """Find the image manifest for `reference` in the layout.
+
+        Images are matched by their `ref.name` annotation (either the
+        full reference or only its tag) or by manifest digest. A layout
+        holding a single image is used for any reference.
+        """
+        with open(os.path.join(self.path, "index.json"), "rb") as f:
+            descriptors = json.load(f).get("manifests", [])
+        repository, tag, digest = split_reference(reference)
+        names = {reference}
+        if tag:
+            names.update({tag, "{}:{}".format(repository, tag)})
+        candidates = [
+            descriptor
+            for descriptor in descriptors
+            if descriptor.get("digest") == digest
+            or names.intersection(
+                descriptor.get("annotations", {}).get(annotation)
+                for annotation in (REF_NAME_ANNOTATION, IMAGE_NAME_ANNOTATION)
+            )
+        ]
+        if not candidates and len(descriptors) == 1:
+            candidates = descriptors
+        if not candidates:
+            raise BuildError(
+                "Base image {} was not found in the OCI layout {}".format(
+                    reference, self.path
+                )
+            )
+        return self._resolve(candidates[0], platform)
+
+    def _resolve(self, descriptor: dict, platform: str) -> dict:
+        if descriptor.get("mediaType") not in (OCI_INDEX, DOCKER_MANIFEST_LIST):
+            return self.read_json(descriptor["digest"])
+        for child in self.read_json(descriptor["digest"])["manifests"]:
+            if _platform_name(child.get("platform", {})).startswith(platform):
+                return self._resolve(child, platform)
+        raise BuildError(
+            "No image for platform {} in {}".format(
+                platform, descriptor["digest"]
+            )
+        )
+
+
+def _timestamp(seconds: float) -> str:
+    """The RFC 3339 UTC time `seconds` after the unix epoch."""
+    return datetime.datetime.utcfromtimestamp(seconds).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+class ImageBuilder:
+    """Apply Dockerfile instructions on top of a base image from a layout.
+
+    New layers are written into `blob_dir`, base image layers are read
+    from the layout when the image is written.
+    """
+
+    def __init__(
+        self,
+        layout: Layout,
+        context: str,
+        blob_dir: str,
+        platform: str = "linux/amd64",
+        created: Optional[str] = None,
+        mtime: int = 0,
+    ):
+        self.layout = layout
+        self.context = context
+        self.blob_dir = blob_dir
+        self.platform = platform
+        self.created = created or _timestamp(0)
+        self.mtime = mtime
+        self.image_config: Optional[dict] = None
+        self.layers: List[dict] = []
+        self.env: Dict[str, str] = {}
+        self.workdir = "/"
+        self.handlers = {
+            "FROM": self._from,
+            "WORKDIR": self._workdir,
+            "ENV": self._env,
+            "LABEL": self._label,
+            "COPY": self._copy,
+            "CMD": self._cmd,
+            "ENTRYPOINT": self._entrypoint,
+            "USER": self._user,
+            "EXPOSE": self._expose,
+            "ARG": self._arg,
+        }
+
+    @property
+    def config(self) -> dict:
+        assert self.image_config is not None
+        return self.image_config.setdefault("config", {})
+
+    def build(self, instructions: Sequence[Tuple[str, str]]) -> None:
+        for keyword, arguments in instructions:
+            handler = self.handlers.get(keyword)
+            if handler is None:
+                raise BuildError(
+                    "{} instructions need a container runtime & can not be "
+                    "built without a docker daemon: {} {}".format(
+                        keyword, keyword, arguments
+                    )
+                )
+            if keyword != "FROM" and self.image_config is None:
+                raise BuildError("Dockerfile must start with FROM")
+            layer = handler(arguments)
+            if keyword == "FROM":
+                continue
+            history = {
+                "created": self.created,
+                "created_by": "{} {}".format(keyword, arguments),
+            }
+            if layer is None:
+                history["empty_layer"] = True
+            else:
+                self.layers.append(layer)
+            self.image_config.setdefault("history", []).append(history)
+
+    def _from(self, arguments: str) -> None:
+        if self.image_config is not None:
+            raise BuildError(
+                "Multi-stage builds need a docker daemon, found a second "
+                "FROM {}".format(arguments)
+            )
+        reference = arguments.split()[0]
+        manifest = self.layout.find_manifest(reference, self.platform)
+        self.image_config = self.layout.read_json(manifest["config"]["digest"])
+        self.layers = [
+            dict(
+                layer,
+                mediaType=MEDIA_TYPES.get(
+                    layer["mediaType"], layer["mediaType"]
+                ),
+            )
+            for layer in manifest["layers"]
+        ]
+        for variable in self.config.get("Env") or []:
+            key, _, value = variable.partition("=")
+            self.env[key] = value
+        self.workdir = self.config.get("WorkingDir") or "/"
+
+    def _workdir(self, arguments: str) -> None:
+        self.workdir = posixpath.normpath(
+            posixpath.join(self.workdir, expand_variables(arguments, self.env))
+        )
+        self.config["WorkingDir"] = self.workdir
+
+    def _env(self, arguments: str) -> None:
+        for key, value in parse_key_values(arguments, self.env):
+            self.env[key] = value
+        self.config["Env"] = [
+            "{}={}".format(key, value) for key, value in self.env.items()
+        ]
+
+    def _label(self, arguments: str) -> None:
+        labels = self.config.get("Labels") or {}
+        labels.update(parse_key_values(arguments, self.env))
+        self.config["Labels"] = labels
+
+    def _cmd(self, arguments: str) -> None:
+        self.config["Cmd"] = parse_command(arguments)
+
+    def _entrypoint(self, arguments: str) -> None:
+        self.config["Entrypoint"] = parse_command(arguments)
+
+    def _user(self, arguments: str) -> None:
+        self.config["User"] = expand_variables(arguments, self.env)
+
+    def _expose(self, arguments: str) -> None:
+        ports = self.config.get("ExposedPorts") or {}
+        for port in arguments.split():
+            ports[port if "/" in port else port + "/tcp"] = {}
+        self.config["ExposedPorts"] = ports
+
+    def _arg(self, arguments: str) -> None:
+        # build arguments can't be passed to this builder, only their
+        # default values are used
+        key, sep, value = arguments.partition("=")
+        if sep and key not in self.env:
+            self.env[key] = value
+
+    def _copy(self, arguments: str) -> dict:
+        if arguments.startswith("["):
+            words = json.loads(arguments)
+        else:
+            words = shlex.split(arguments)
+        owner, mode = (0, 0), None
+        while words and words[0].startswith("--"):
+            flag, _, value = words.pop(0).partition("=")
+            if flag == "--chown":
+                user, _, group = value.partition(":")
+                if not (user.isdigit() and (group or user).isdigit()):
+                    raise BuildError(
+                        "Only numeric --chown values are supported: "
+                        "COPY {}".format(arguments)
+                    )
+                owner = (int(user), int(group or user))
+            elif flag == "--chmod":
+                mode = int(value, 8)
+            elif flag == "--link":
+                # every layer is already built independently of the
+                # layers before it
+                pass
+            else:
+                raise BuildError(
+                    "Unsupported COPY flag {}: COPY {}".format(flag, arguments)
+                )
+        if len(words) < 2:
+            raise BuildError("COPY needs a source & a destination")
+        sources, destination = words[:-1], expand_variables(words[-1], self.env)
+        destination = posixpath.join(self.workdir, destination)
+        copy_into = (
+            len(sources) > 1
+            or words[-1].endswith("/")
+            or words[-1] in (".", "./")
+        )
+        entries: Dict[str, Optional[str]] = {}
+        for source in sources:
+            path = os.path.normpath(os.path.join(self.context, source))
+            if not (path + os.sep).startswith(
+                os.path.normpath(self.context) + os.sep
+            ):
+                raise BuildError(
+                    "COPY source {} is outside of the build context".format(
+                        source
+                    )
+                )
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    relative = os.path.relpath(root, path)
+                    target = posixpath.normpath(
+                        posixpath.join(
+                            destination, relative.replace(os.sep, "/")
+                        )
+                    )
+                    if relative != ".":
+                        entries[target] = None
+                    for name in files:
+                        entries[posixpath.join(target, name)] = os.path.join(
+                            root, name
+                        )
+            elif os.path.isfile(path):
+                if copy_into:
+                    target = posixpath.join(destination, os.path.basename(path))
+                else:
+                    target = destination
+                entries[target] = path
+            else:
+                raise BuildError(
+                    "COPY source {} does not exist in the build context".format(
+                        source
+                    )
+                )
+        return self._write_layer(entries, owner, mode)
+
+    def _write_layer(
+        self,
+        entries: Dict[str, Optional[str]],
+        owner: Tuple[int, int],
+        mode: Optional[int],
+    ) -> dict:
+        """Write a gzipped layer of the given files & directories.
+
+        `entries` maps absolute paths in the image to files in the
+        build context, or to None for directories.
+        """
+        tar_path = os.path.join(self.blob_dir, "layer.tar")
+        with tarfile.open(tar_path, "w", format=tarfile.PAX_FORMAT) as tar:
+            for target in sorted(entries):
+                source = entries[target]
+                info = tarfile.TarInfo(target.lstrip("/"))
+                info.mtime = self.mtime
+                info.uid, info.gid = owner
+                info.uname = info.gname = ""
+                if source is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = mode or 0o755
+                    tar.addfile(info)
+                    continue
+                executable = os.stat(source).st_mode & 0o111
+                info.mode = mode or (0o755 if executable else 0o644)
+                info.size = os.path.getsize(source)
+                with open(source, "rb") as f:
+                    tar.addfile(info, f)
+        diff_id = sha256_file(tar_path)
+        gzip_path = tar_path + ".gz"
+        with open(tar_path, "rb") as raw, open(gzip_path, "wb") as out:
+            with gzip.GzipFile(
+                filename="", mode="wb", fileobj=out, mtime=0
+            ) as compressed:
+                shutil.copyfileobj(raw, compressed)
+        os.remove(tar_path)
+        digest = sha256_file(gzip_path)
+        size = os.path.getsize(gzip_path)
+        os.replace(gzip_path, self._blob_path(digest))
+        rootfs = self.image_config.setdefault(
+            "rootfs", {"type": "layers", "diff_ids": []}
+        )
+        rootfs["diff_ids"].append(diff_id)
+        return {"mediaType": OCI_LAYER, "digest": digest, "size": size}
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest.partition(":")[2])
+
+    def _write_blob(self, content: bytes) -> dict:
+        digest = "sha256:" + hashlib.sha256(content).hexdigest()
+        with open(self._blob_path(digest), "wb") as f:
+            f.write(content)
+        return {"digest": digest, "size": len(content)}
+
+    def write(self, output: str, tags: Sequence[str]) -> str:
+        """Write the image as an OCI layout tarball & return the
+        manifest digest."""
+        if self.image_config is None:
+            raise BuildError("Dockerfile must start with FROM")
+        self.image_config["created"] = self.created
+        config = dict(
+            mediaType=OCI_CONFIG,
+            **self._write_blob(_canonical_json(self.image_config)),
+        )
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": OCI_MANIFEST,
+            "config": config,
+            "layers": self.layers,
+        }
+        manifest_descriptor = dict(
+            mediaType=OCI_MANIFEST,
+            **self._write_blob(_canonical_json(manifest)),
+        )
+        index = {
+            "schemaVersion": 2,
+            "mediaType": OCI_INDEX,
+            "manifests": [
+                dict(
+                    manifest_descriptor,
+                    annotations={
+                        REF_NAME_ANNOTATION: split_reference(tag)[1]
+                        or "latest",
+                        IMAGE_NAME_ANNOTATION: repo_tag(tag),
+                    },
+                )
+                for tag in tags
+            ]
+            or [manifest_descriptor],
+        }
+        docker_manifest = [
+            {
+                "Config": _blob_name(config["digest"]),
+                "RepoTags": [repo_tag(tag) for tag in tags],
+                "Layers": [
+                    _blob_name(layer["digest"]) for layer in self.layers
+                ],
+            }
+        ]
+        files = {
+            "oci-layout": _canonical_json({"imageLayoutVersion": "1.0.0"}),
+            "index.json": _canonical_json(index),
+            "manifest.json": _canonical_json(docker_manifest),
+        }
+        blobs = {
+            _blob_name(digest): self._find_blob(digest)
+            for digest in [
+                config["digest"],
+                manifest_descriptor["digest"],
+                *(layer["digest"] for layer in self.layers),
+            ]
+        }
+        with tarfile.open(output, "w", format=tarfile.PAX_FORMAT) as tar:
+            for directory in ("blobs", "blobs/sha256"):
+                info = self._tar_info(directory)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            for name in sorted(blobs):
+                info = self._tar_info(name)
+                info.size = os.path.getsize(blobs[name])
+                with open(blobs[name], "rb") as f:
+                    tar.addfile(info, f)
+            for name, content in sorted(files.items()):
+                info = self._tar_info(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        return manifest_descriptor["digest"]
+
+    def _find_blob(self, digest: str) -> str:
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return path
+        return self.layout.blob_path(digest)
+
+    def _tar_info(self, name: str) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        info.uname = info.gname = ""
+        return info
+
+
+def _blob_name(digest: str) -> str:
+    return "blobs/sha256/" + digest.partition(":")[2]
+
+
+def _canonical_json(value) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode(
+        "utf-8"
+    )
+
+
+def build_image(
+    context: str,
+    base_layout: str,
+    output: str,
+    tags: Sequence[str],
+    platform: str = "linux/amd64",
+    source_date_epoch: Optional[int] = None,
+    created_now: bool = False,
+) -> str:
+    """Build the Dockerfile in `context` into an OCI image tarball.
+
+    The image's creation time is the unix epoch, or `source_date_epoch`
+    (which is also the time of every copied file), so that the image
+    only depends on its inputs. With `created_now` it is the current
+    time instead.
+    """
+    with open(os.path.join(context, "Dockerfile"), encoding="utf-8") as f:
+        instructions = parse_dockerfile(f.read())
+    created = None
+    mtime = 0
+    if source_date_epoch is not None:
+        created = _timestamp(source_date_epoch)
+        mtime = source_date_epoch
+    if created_now:
+        created = _timestamp(time.time())
+    with tempfile.TemporaryDirectory() as blob_dir:
+        builder = ImageBuilder(
+            Layout(base_layout), context, blob_dir, platform, created, mtime
+        )
+        builder.build(instructions)
+        return builder.write(output, tags)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--context", required=True)
+    parser.add_argument("--base-layout", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--platform", default="linux/amd64")
+    parser.add_argument("--tag", action="append", default=[])
+    parser.add_argument("--source-date-epoch", type=int)
+    parser.add_argument("--created-now", action="store_true")
+    args = parser.parse_args(argv)
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    try:
+        digest = build_image(
+            args.context,
+            args.base_layout,
+            args.output,
+            args.tag,
+            args.platform,
+            args.source_date_epoch,
+            args.created_now,
+        )
+    except BuildError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print("Wrote image {} to {}".format(digest, args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
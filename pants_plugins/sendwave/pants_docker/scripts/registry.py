@@ -0,0 +1,724 @@
+"""Talk to container registries for the pants-docker plugin.
+
+Run by the plugin (with `python -c`) inside a pants process sandbox.
+Only depends on the python standard library.
+
+`resolve` pins image references to the digest of the manifest they
+currently point to, e.g. `python:3.8-slim` to
+`python:3.8-slim@sha256:...`. Resolved digests are kept in a JSON cache
+file (in a pants named cache, shared by every sandbox) & reused until
+they are older than `--ttl` seconds, so the registry is only asked
+again once an entry has expired. When the registry can't be reached an
+expired entry is used rather than failing the build.
+
+With `--registry` every image is resolved against that registry
+instead of its own, e.g. a local registry (`localhost:5000`) mirroring
+the images used as base images, and pinned to its reference in that
+registry (e.g. `localhost:5000/library/python:3.8-slim@sha256:...`),
+so that images are pulled from the registry whose manifest was
+resolved.
+
+`push` pushes every tagged image in image tarballs (written by `docker
+save`, or by the 'oci' backend) to the registries they are tagged for,
+with at most `--concurrency` requests in flight at once. Each blob is
+checked for once per registry, however many images & tags share it:
+only missing blobs are uploaded, and blobs already pushed to another
+repository of the same registry are mounted from it rather than
+uploaded again. Each tag's manifest is pushed once all of its blobs
+are. The uncompressed layers `docker save` writes are first gzipped
+(once per layer, however many images share it, & deterministically so
+every push of a layer has the same digest) and pushed compressed.
+
+Registries on localhost are reached over plain HTTP, all others over
+HTTPS. Bearer tokens are requested when a registry asks for them, with
+the credentials of `docker login` when there are any, or anonymously.
+Like docker, credentials are read from the registry's helper in
+`credHelpers` or else the `credsStore` of docker's config.json (by
+running `docker-credential-<helper> get`), and otherwise from its
+`auths`.
+"""
+import argparse
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass, replace
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+DOCKER_HUB = "registry-1.docker.io"
+MANIFEST_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+)
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER = "application/vnd.oci.image.layer.v1.tar"
+OCI_LAYER_GZIP = "application/vnd.oci.image.layer.v1.tar+gzip"
+# the key of Docker Hub's credentials in docker's config.json
+DOCKER_HUB_AUTH = "https://index.docker.io/v1/"
+AUTH_PARAM = re.compile(r'(\w+)="([^"]*)"')
+# the name of blobs which are named after their digest in an archive
+BLOB_NAME = re.compile(r"^blobs/sha256/([0-9a-f]{64})$")
+
+# a request body: bytes, or a function opening a file to stream it from
+Body = Union[bytes, Callable[[], IO[bytes]], None]
+
+
+class RegistryError(Exception):
+    """A registry could not be reached or answered with an error."""
+
+    def __init__(self, message: str, status: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def parse_reference(
+    reference: str,
+) -> Tuple[str, str, Optional[str], Optional[str]]:
+    """Split an image reference into (registry, repository, tag, digest).
+
+    Images without a registry are on Docker Hub, where single name
+    repositories are in the `library` namespace.
+    """
+    name, _, digest = reference.partition("@")
+    tag = None
+    if ":" in name.rpartition("/")[2]:
+        name, _, tag = name.rpartition(":")
+    first, sep, rest = name.partition("/")
+    if sep and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, rest
+    else:
+        registry, repository = DOCKER_HUB, name
+        if "/" not in repository:
+            repository = f"library/{repository}"
+    if not tag and not digest:
+        tag = "latest"
+    return registry, repository, tag, digest or None
+
+
+def _scheme(registry: str) -> str:
+    host = registry.rpartition(":")[0] if ":" in registry else registry
+    if host in ("localhost", "127.0.0.1"):
+        return "http"
+    return "https"
+
+
+def _helper_credentials(helper: str, server: str) -> Optional[str]:
+    """The base64 encoded `user:password` a docker credential helper
+    stores for a server, if any."""
+    command = f"docker-credential-{helper}"
+    try:
+        result = subprocess.run(
+            [command, "get"], input=server.encode("utf-8"), capture_output=True
+        )
+    except OSError as e:
+        raise RegistryError(
+            f"Can't run {command} for the credentials of {server}: {e}"
+        )
+    output = result.stdout.decode("utf-8", errors="replace").strip()
+    if result.returncode != 0:
+        if "credentials not found" in output:
+            return None
+        raise RegistryError(
+            f"{command} failed to get the credentials of {server}: "
+            + (output or result.stderr.decode("utf-8", errors="replace"))
+        )
+    try:
+        secret = json.loads(output)
+        user_password = f"{secret['Username']}:{secret['Secret']}"
+    except (ValueError, KeyError, TypeError):
+        raise RegistryError(f"{command} returned invalid credentials")
+    return base64.b64encode(user_password.encode("utf-8")).decode("ascii")
+
+
+def docker_credentials(registry: str, config_dir: str) -> Optional[str]:
+    """The base64 encoded `user:password` stored by `docker login` for a
+    registry, if any.
+
+    As with docker, the registry's credential helper is used when one
+    is configured, then the default `credsStore`, and otherwise the
+    credentials in docker's config.json. Raises a RegistryError when a
+    helper can't be run, rather than continuing anonymously.
+    """
+    try:
+        with open(os.path.join(config_dir, "config.json")) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return None
+    keys = [registry, f"https://{registry}", f"http://{registry}"]
+    if registry == DOCKER_HUB:
+        keys.extend([DOCKER_HUB_AUTH, "index.docker.io", "docker.io"])
+    helpers = config.get("credHelpers") or {}
+    for key in keys:
+        if helpers.get(key):
+            return _helper_credentials(helpers[key], key)
+    if config.get("credsStore"):
+        server = DOCKER_HUB_AUTH if registry == DOCKER_HUB else registry
+        return _helper_credentials(config["credsStore"], server)
+    auths = config.get("auths") or {}
+    for key in keys:
+        auth = auths.get(key, {}).get("auth")
+        if auth:
+            return auth
+    return None
+
+
+class RegistryClient:
+    """A minimal client of the registry HTTP API (v2).
+
+    `credentials` are the base64 encoded `user:password` to log in with.
+    Clients may be used by several threads at once.
+    """
+
+    def __init__(
+        self,
+        registry: str,
+        timeout: float = 30,
+        credentials: Optional[str] = None,
+    ) -> None:
+        self.registry = registry
+        self.base_url = f"{_scheme(registry)}://{registry}"
+        self.timeout = timeout
+        self.credentials = credentials
+        # the Authorization header of each repository
+        self._authorizations: Dict[str, str] = {}
+
+    def _token(self, challenge: str) -> str:
+        """Request a bearer token for a `WWW-Authenticate` challenge."""
+        params = dict(AUTH_PARAM.findall(challenge))
+        if "realm" not in params:
+            raise RegistryError(f"Unsupported authentication: {challenge}")
+        query = urllib.parse.urlencode(
+            {k: v for k, v in params.items() if k in ("service", "scope")}
+        )
+        request = urllib.request.Request(
+            params["realm"] + ("?" + query if query else "")
+        )
+        if self.credentials:
+            request.add_header("Authorization", f"Basic {self.credentials}")
+        try:
+            with urllib.request.urlopen(
+                request, timeout=self.timeout
+            ) as response:
+                body = json.load(response)
+            return body.get("token") or body["access_token"]
+        except (OSError, ValueError, KeyError) as e:
+            raise RegistryError(f"Requesting a token failed: {e}") from e
+
+    def _authorization(self, challenge: str) -> str:
+        """The Authorization header answering a challenge."""
+        if challenge.split(" ", 1)[0].lower() == "basic":
+            if not self.credentials:
+                raise RegistryError(f"{self.registry} requires a login")
+            return f"Basic {self.credentials}"
+        return f"Bearer {self._token(challenge)}"
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        repository: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: Body = None,
+    ):
+        """Send a request, authenticating for `repository` if needed.
+
+        `path` is either relative to the registry or an absolute URL
+        (e.g. the location of an upload).
+        """
+        headers = dict(headers or {})
+        url = urllib.parse.urljoin(self.base_url + "/", path)
+        for attempt in range(2):
+            if repository in self._authorizations:
+                headers["Authorization"] = self._authorizations[repository]
+            data = body() if callable(body) else body
+            request = urllib.request.Request(
+                url, data=data, method=method, headers=headers
+            )
+            try:
+                return urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                challenge = e.headers.get("WWW-Authenticate", "")
+                if e.code == 401 and attempt == 0 and challenge:
+                    self._authorizations[repository] = self._authorization(
+                        challenge
+                    )
+                    continue
+                raise RegistryError(
+                    f"{method} {url} failed: {e.code}", e.code
+                ) from e
+            except OSError as e:
+                raise RegistryError(f"{method} {url} failed: {e}") from e
+            finally:
+                if hasattr(data, "close"):
+                    data.close()
+        raise AssertionError("unreachable")
+
+    def manifest_digest(self, repository: str, reference: str) -> str:
+        """The digest of the manifest (or index) `reference` points to."""
+        path = f"/v2/{repository}/manifests/{reference}"
+        headers = {"Accept": ", ".join(MANIFEST_TYPES)}
+        with self.request("HEAD", path, repository, headers) as response:
+            digest = response.headers.get("Docker-Content-Digest")
+        if not digest:
+            raise RegistryError(
+                f"{self.registry} did not return the digest of "
+                f"{repository}:{reference}"
+            )
+        return digest
+
+    def blob_exists(self, repository: str, digest: str) -> bool:
+        path = f"/v2/{repository}/blobs/{digest}"
+        try:
+            with self.request("HEAD", path, repository):
+                return True
+        except RegistryError as e:
+            if e.status == 404:
+                return False
+            raise
+
+    def mount_blob(
+        self, repository: str, digest: str, source: str
+    ) -> Optional[str]:
+        """Mount a blob from another repository of the registry.
+
+        Returns None once the blob is mounted, or the location to upload
+        it to if the registry didn't mount it.
+        """
+        query = urllib.parse.urlencode({"mount": digest, "from": source})
+        path = f"/v2/{repository}/blobs/uploads/?{query}"
+        with self.request("POST", path, repository) as response:
+            if response.status == 201:
+                return None
+            return response.headers["Location"]
+
+    def upload_blob(
+        self,
+        repository: str,
+        digest: str,
+        size: int,
+        open_blob: Callable[[], IO[bytes]],
+        location: Optional[str] = None,
+    ) -> None:
+        """Upload a blob in a single request, starting a new upload unless
+        given its `location`."""
+        if location is None:
+            path = f"/v2/{repository}/blobs/uploads/"
+            with self.request("POST", path, repository) as response:
+                location = response.headers["Location"]
+        separator = "&" if "?" in location else "?"
+        query = urllib.parse.urlencode({"digest": digest})
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(size),
+        }
+        with self.request(
+            "PUT",
+            f"{location}{separator}{query}",
+            repository,
+            headers,
+            open_blob,
+        ):
+            pass
+
+    def put_manifest(
+        self, repository: str, tag: str, manifest: bytes, media_type: str
+    ) -> None:
+        path = f"/v2/{repository}/manifests/{tag}"
+        headers = {"Content-Type": media_type}
+        with self.request("PUT", path, repository, headers, manifest):
+            pass
+
+
+@contextlib.contextmanager
+def locked_cache(path: str) -> Iterator[Dict[str, dict]]:
+    """Load, & then save, the JSON cache at `path` while holding a lock
+    on it."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        try:
+            yield cache
+        finally:
+            with open(path + ".tmp", "w") as f:
+                json.dump(cache, f, indent=2, sort_keys=True)
+            os.replace(path + ".tmp", path)
+
+
+def resolve(
+    references: Sequence[str],
+    cache: Dict[str, dict],
+    ttl: int,
+    registry: Optional[str] = None,
+    now: Callable[[], float] = time.time,
+    warn: Callable[[str], None] = lambda message: None,
+    credentials: Callable[[str], Optional[str]] = lambda registry: None,
+) -> Dict[str, str]:
+    """Pin each reference to a digest, using & updating `cache`.
+
+    References which already include a digest are unchanged. With a
+    `registry`, references are pinned to the image in that registry.
+    Registries are logged in to with the `credentials` of each.
+    """
+    clients: Dict[str, RegistryClient] = {}
+    pinned = {}
+    for reference in references:
+        image_registry, repository, tag, digest = parse_reference(reference)
+        if digest:
+            pinned[reference] = reference
+            continue
+        image_registry = registry or image_registry
+        key = f"{image_registry}/{repository}:{tag}"
+        entry = cache.get(key)
+        if entry is None or now() - entry["resolved_at"] >= ttl:
+            if image_registry not in clients:
+                clients[image_registry] = RegistryClient(
+                    image_registry, credentials=credentials(image_registry)
+                )
+            try:
+                digest = clients[image_registry].manifest_digest(
+                    repository, tag
+                )
+                entry = {"digest": digest, "resolved_at": now()}
+                cache[key] = entry
+            except RegistryError as e:
+                if entry is None:
+                    raise
+                warn(f"Using the expired digest of {reference}: {e}")
+        # the digest is of the manifest in `registry`, which a mirror
+        # may not store byte-for-byte like the image's own registry
+        pinned_reference = key if registry else reference
+        pinned[reference] = f"{pinned_reference}@{entry['digest']}"
+    return pinned
+
+
+class _BlobReader:
+    """Read `size` bytes of a file from `offset`."""
+
+    def __init__(self, path: str, offset: int, size: int) -> None:
+        self._file = open(path, "rb")
+        self._file.seek(offset)
+        self._remaining = size
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self._file.close()
+
+
+@dataclass(frozen=True)
+class Blob:
+    """A blob stored in an image archive."""
+
+    archive: str
+    offset: int
+    size: int
+    digest: str
+    media_type: str
+
+    def open(self) -> IO[bytes]:
+        return _BlobReader(self.archive, self.offset, self.size)
+
+
+@dataclass(frozen=True)
+class ArchivedImage:
+    """An image in an archive, with the tags it is to be pushed as."""
+
+    tags: Tuple[str, ...]
+    config: Blob
+    layers: Tuple[Blob, ...]
+
+    def manifest(self) -> bytes:
+        """The OCI manifest of the image."""
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": OCI_MANIFEST,
+            "config": {
+                "mediaType": OCI_CONFIG,
+                "digest": self.config.digest,
+                "size": self.config.size,
+            },
+            "layers": [
+                {
+                    "mediaType": layer.media_type,
+                    "digest": layer.digest,
+                    "size": layer.size,
+                }
+                for layer in self.layers
+            ],
+        }
+        return json.dumps(manifest, sort_keys=True).encode("utf-8")
+
+
+def read_archive(path: str) -> List[ArchivedImage]:
+    """The images in an (uncompressed) image tarball, read from the
+    docker `manifest.json` it contains."""
+    with tarfile.open(path, "r:") as tar:
+        members = {member.name: member for member in tar.getmembers()}
+        manifest = json.load(tar.extractfile("manifest.json"))
+
+        def blob(name: str, media_type: Optional[str] = None) -> Blob:
+            member = members[name]
+            match = BLOB_NAME.match(name)
+            with tar.extractfile(member) as f:
+                if match:
+                    digest = f"sha256:{match.group(1)}"
+                    magic = f.read(2)
+                else:
+                    hasher = hashlib.sha256()
+                    magic = f.read(2)
+                    hasher.update(magic)
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        hasher.update(chunk)
+                    digest = f"sha256:{hasher.hexdigest()}"
+            if media_type is None:
+                media_type = (
+                    OCI_LAYER_GZIP if magic == b"\x1f\x8b" else OCI_LAYER
+                )
+            return Blob(
+                path, member.offset_data, member.size, digest, media_type
+            )
+
+        return [
+            ArchivedImage(
+                tuple(image.get("RepoTags") or ()),
+                blob(image["Config"], OCI_CONFIG),
+                tuple(blob(layer) for layer in image["Layers"]),
+            )
+            for image in manifest
+        ]
+
+
+def _compress_layer(layer: Blob, directory: str) -> Blob:
+    """Gzip an uncompressed layer to a file in `directory`.
+
+    The gzip header has no file name or timestamp, so compressing the
+    same layer always gives the same blob.
+    """
+    path = os.path.join(directory, layer.digest.partition(":")[2] + ".gz")
+    reader = layer.open()
+    try:
+        with open(path, "wb") as f, gzip.GzipFile(
+            filename="", mode="wb", fileobj=f, compresslevel=6, mtime=0
+        ) as compressed:
+            for chunk in iter(lambda: reader.read(1 << 20), b""):
+                compressed.write(chunk)
+    finally:
+        reader.close()
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    return Blob(
+        path,
+        0,
+        os.path.getsize(path),
+        f"sha256:{hasher.hexdigest()}",
+        OCI_LAYER_GZIP,
+    )
+
+
+def compress_layers(
+    images: Sequence[ArchivedImage], directory: str, concurrency: int
+) -> List[ArchivedImage]:
+    """Replace the uncompressed layers of `images` with gzipped copies
+    written to `directory`, compressing each distinct layer once."""
+    layers = {
+        layer.digest: layer
+        for image in images
+        for layer in image.layers
+        if layer.media_type == OCI_LAYER
+    }
+    with concurrent.futures.ThreadPoolExecutor(max(concurrency, 1)) as pool:
+        futures = {
+            digest: pool.submit(_compress_layer, layer, directory)
+            for digest, layer in layers.items()
+        }
+        compressed = {
+            digest: future.result() for digest, future in futures.items()
+        }
+    return [
+        replace(
+            image,
+            layers=tuple(
+                compressed.get(layer.digest, layer)
+                if layer.media_type == OCI_LAYER
+                else layer
+                for layer in image.layers
+            ),
+        )
+        for image in images
+    ]
+
+
+def push(
+    images: Sequence[ArchivedImage],
+    concurrency: int,
+    credentials: Callable[[str], Optional[str]] = lambda registry: None,
+) -> Dict[str, int]:
+    """Push every tag of `images`, uploading each blob at most once per
+    registry. Returns counts of what was pushed."""
+    # the repositories of each registry a blob is pushed to
+    blob_repositories: Dict[Tuple[str, str], List[str]] = {}
+    blobs: Dict[str, Blob] = {}
+    manifests = []
+    for image in images:
+        manifest = image.manifest()
+        for reference in image.tags:
+            registry, repository, tag, _ = parse_reference(reference)
+            manifests.append((registry, repository, tag, manifest))
+            for blob in (image.config, *image.layers):
+                blobs[blob.digest] = blob
+                repositories = blob_repositories.setdefault(
+                    (registry, blob.digest), []
+                )
+                if repository not in repositories:
+                    repositories.append(repository)
+    clients = {
+        registry: RegistryClient(registry, credentials=credentials(registry))
+        for registry, _ in blob_repositories
+    }
+    counts: Dict[str, int] = collections.Counter()
+    lock = threading.Lock()
+
+    def count(key: str, n: int = 1) -> None:
+        with lock:
+            counts[key] += n
+
+    def push_blob(registry: str, digest: str, repositories: List[str]) -> None:
+        client = clients[registry]
+        blob = blobs[digest]
+        first, *others = repositories
+        count("blobs")
+        if client.blob_exists(first, digest):
+            count("existing_blobs")
+        else:
+            client.upload_blob(first, digest, blob.size, blob.open)
+            count("uploaded_blobs")
+            count("uploaded_bytes", blob.size)
+        for repository in others:
+            location = client.mount_blob(repository, digest, first)
+            if location is None:
+                count("mounted_blobs")
+            else:
+                client.upload_blob(
+                    repository, digest, blob.size, blob.open, location
+                )
+                count("uploaded_blobs")
+                count("uploaded_bytes", blob.size)
+
+    def push_manifest(
+        registry: str, repository: str, tag: str, manifest: bytes
+    ) -> None:
+        clients[registry].put_manifest(repository, tag, manifest, OCI_MANIFEST)
+        count("manifests")
+
+    with concurrent.futures.ThreadPoolExecutor(max(concurrency, 1)) as pool:
+        # every blob is pushed before any manifest referring to it
+        for future in [
+            pool.submit(push_blob, registry, digest, repositories)
+            for (registry, digest), repositories in blob_repositories.items()
+        ]:
+            future.result()
+        for future in [
+            pool.submit(push_manifest, *manifest) for manifest in manifests
+        ]:
+            future.result()
+    return dict(counts)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    resolve_parser = commands.add_parser(
+        "resolve", help="pin image references to digests"
+    )
+    resolve_parser.add_argument("--cache", required=True)
+    resolve_parser.add_argument("--ttl", type=int, default=86400)
+    resolve_parser.add_argument("--registry")
+    resolve_parser.add_argument("reference", nargs="+")
+    push_parser = commands.add_parser(
+        "push", help="push the tagged images in image tarballs"
+    )
+    push_parser.add_argument("--concurrency", type=int, default=8)
+    push_parser.add_argument("archive", nargs="+")
+    for command_parser in (resolve_parser, push_parser):
+        command_parser.add_argument(
+            "--docker-config",
+            default=os.environ.get("DOCKER_CONFIG")
+            or os.path.join(os.path.expanduser("~"), ".docker"),
+        )
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "push":
+            images = [
+                image
+                for archive in args.archive
+                for image in read_archive(archive)
+            ]
+            with tempfile.TemporaryDirectory(dir=".") as directory:
+                result = push(
+                    compress_layers(images, directory, args.concurrency),
+                    args.concurrency,
+                    lambda registry: docker_credentials(
+                        registry, args.docker_config
+                    ),
+                )
+        else:
+            with locked_cache(args.cache) as cache:
+                result = resolve(
+                    args.reference,
+                    cache,
+                    args.ttl,
+                    args.registry,
+                    warn=lambda message: print(message, file=sys.stderr),
+                    credentials=lambda registry: docker_credentials(
+                        registry, args.docker_config
+                    ),
+                )
+    except RegistryError as e:
+        print(e, file=sys.stderr)
+        return 1
+    json.dump(result, sys.stdout, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""Run a docker command for the pants-docker plugin.
+
+Run by the plugin (with `python -c`) in place of the docker CLI for
+image builds. Each pants process runs in its own sandbox, but all of
+them share a pants named cache directory, which this script uses to:
+
+- limit concurrent builds: the cache holds one lock file per slot, and
+  a build waits until it can lock one of them, so at most `--slots`
+  builds run against the docker daemon at once, no matter how many
+  pants runs are in parallel.
+- stream output: with `--log-file` every line of output is written to
+  that file as soon as it arrives, so a running build can be followed
+  with `tail -f`.
+
+With `--tail` only the last lines of output (and the status lines of
+each BuildKit step) are kept & printed once the command exits, so the
+memory used for the output of a long build is bounded. Only depends on
+the python standard library.
+"""
+import argparse
+import collections
+import fcntl
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import IO, Iterable, List, Optional, Sequence
+
+POLL_INTERVAL = 0.2
+
+# status lines of a step in the `--progress plain` output of BuildKit
+STEP_STATUS = re.compile(r"^#\d+ (\[.*\] .*|DONE .*|CACHED|ERROR.*)$")
+
+
+def acquire_slot(lock_dir: str, slots: int) -> IO:
+    """Block until one of `slots` lock files in `lock_dir` is locked.
+
+    Returns the open, locked, slot file. The lock is released when
+    the file is closed (or the process exits).
+    """
+    os.makedirs(lock_dir, exist_ok=True)
+    while True:
+        for slot in range(slots):
+            handle = open(os.path.join(lock_dir, f"slot-{slot}.lock"), "a")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            return handle
+        time.sleep(POLL_INTERVAL)
+
+
+def relay_output(
+    lines: Iterable[str], log: Optional[IO], tail: int
+) -> List[str]:
+    """Copy `lines` to `log` as they arrive & return the lines to keep.
+
+    With `tail` the last `tail` lines are kept, preceded by the status
+    line of every BuildKit step which is not among them. Otherwise all
+    lines are kept.
+    """
+    recent = collections.deque(maxlen=tail or None)
+    steps = []
+    for line in lines:
+        if log:
+            log.write(line)
+            log.flush()
+        if tail and len(recent) == tail:
+            dropped = recent[0]
+            if STEP_STATUS.match(dropped.rstrip("\n")):
+                steps.append(dropped)
+        recent.append(line)
+    if steps:
+        steps.append("[...]\n")
+    return [*steps, *recent]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=0,
+        help="maximum number of concurrent commands, 0 for no limit",
+    )
+    parser.add_argument("--lock-dir", required=True)
+    parser.add_argument(
+        "--log-file", help="file to stream the command's output to"
+    )
+    parser.add_argument(
+        "--tail",
+        type=int,
+        default=0,
+        help="number of lines of output to keep, 0 to keep all output",
+    )
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    command = args.command
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        parser.error("no command to run")
+    slot = acquire_slot(args.lock_dir, args.slots) if args.slots > 0 else None
+    log = None
+    if args.log_file:
+        os.makedirs(os.path.dirname(args.log_file) or ".", exist_ok=True)
+        log = open(args.log_file, "w")
+    try:
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+        output = relay_output(process.stdout, log, args.tail)
+        returncode = process.wait()
+    finally:
+        if log:
+            log.close()
+        if slot:
+            slot.close()
+    sys.stdout.writelines(output)
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
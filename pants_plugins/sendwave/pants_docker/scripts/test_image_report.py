@@ -0,0 +1,170 @@
+import gzip
+import io
+import json
+import tarfile
+
+from sendwave.pants_docker.scripts.image_report import (
+    BASE_IMAGE,
+    UNATTRIBUTED,
+    analyze_archive,
+    build_report,
+    find_origin,
+    instruction_body,
+    main,
+    measure_layer,
+)
+
+ORIGINS = [
+    ("RUN apt-get update", "image_setup_commands"),
+    (
+        "RUN --mount=type=cache,target=/root/.cache/pip pip install flask",
+        "third-party requirements",
+    ),
+    ("COPY --link application .", "third-party files"),
+    ("COPY --link layers/content/abc .", "sources of app"),
+]
+
+
+def _tar(files) -> bytes:
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return out.getvalue()
+
+
+def _write_image(path, layers, history) -> None:
+    """Write a `docker save` style tarball of one image."""
+    files = {
+        "config.json": json.dumps({"history": history}).encode(),
+        "manifest.json": json.dumps(
+            [
+                {
+                    "Config": "config.json",
+                    "RepoTags": ["app:latest"],
+                    "Layers": [f"{i}/layer.tar" for i in range(len(layers))],
+                }
+            ]
+        ).encode(),
+    }
+    for i, layer in enumerate(layers):
+        files[f"{i}/layer.tar"] = layer
+    with open(path, "wb") as f:
+        f.write(_tar(files))
+
+
+def test_instruction_body() -> None:
+    assert instruction_body(ORIGINS[1][0]) == "pip install flask"
+    assert instruction_body("COPY --link application .") == "application ."
+    assert instruction_body(
+        "RUN python -m compileall -q --invalidation-mode unchecked-hash ."
+    ) == ("python -m compileall -q --invalidation-mode unchecked-hash .")
+
+
+def test_find_origin() -> None:
+    assert (
+        find_origin("RUN /bin/sh -c pip install flask # buildkit", ORIGINS)
+        == "third-party requirements"
+    )
+    assert (
+        find_origin("COPY layers/content/abc . # buildkit", ORIGINS)
+        == "sources of app"
+    )
+    assert find_origin("/bin/sh -c #(nop) ADD file:123 in /", ORIGINS) is None
+
+
+def test_measure_layer() -> None:
+    layer = _tar({"big.bin": b"\0" * 10000, "small.txt": b"hi"})
+    sizes = measure_layer(lambda: io.BytesIO(layer), top=1)
+    assert sizes["uncompressed_bytes"] == len(layer)
+    assert 0 < sizes["compressed_bytes"] < len(layer)
+    assert sizes["largest_files"] == [{"path": "big.bin", "bytes": 10000}]
+    compressed = gzip.compress(layer)
+    gzipped = measure_layer(lambda: io.BytesIO(compressed), top=2)
+    assert gzipped["compressed_bytes"] == len(compressed)
+    assert gzipped["uncompressed_bytes"] == len(layer)
+    assert len(gzipped["largest_files"]) == 2
+
+
+def test_analyze_archive(tmp_path) -> None:
+    archive = str(tmp_path / "image.tar")
+    _write_image(
+        archive,
+        [
+            _tar({"bin/sh": b"sh"}),
+            _tar({"app/main.py": b"print()"}),
+            _tar({"app/tmp": b""}),
+        ],
+        [
+            {"created_by": "/bin/sh -c #(nop) ADD file:123 in /"},
+            {"created_by": "/bin/sh -c #(nop) CMD [bash]", "empty_layer": True},
+            {"created_by": "COPY layers/content/abc . # buildkit"},
+            {"created_by": "RUN /bin/sh -c touch /app/tmp # buildkit"},
+        ],
+    )
+    layers = analyze_archive(archive, ORIGINS, top=5)
+    assert [layer["origin"] for layer in layers] == [
+        BASE_IMAGE,
+        "sources of app",
+        UNATTRIBUTED,
+    ]
+    assert layers[1]["largest_files"] == [{"path": "app/main.py", "bytes": 7}]
+
+
+def test_build_report_diff() -> None:
+    def layer(origin, size):
+        return {
+            "origin": origin,
+            "compressed_bytes": size // 2,
+            "uncompressed_bytes": size,
+        }
+
+    previous = build_report(
+        "app:image", [layer(BASE_IMAGE, 100), layer("sources of app", 10)]
+    )
+    report = build_report(
+        "app:image",
+        [layer(BASE_IMAGE, 100), layer("sources of app", 30)],
+        previous,
+    )
+    assert report["uncompressed_bytes"] == 130
+    assert report["origins"]["sources of app"]["layers"] == 1
+    assert report["diff"] == {
+        "compressed_bytes": 10,
+        "uncompressed_bytes": 20,
+        "origins": {
+            "sources of app": {
+                "compressed_bytes": 10,
+                "uncompressed_bytes": 20,
+            }
+        },
+    }
+
+
+def test_main_compares_with_previous_report(tmp_path) -> None:
+    archive = str(tmp_path / "image.tar")
+    origins = tmp_path / "origins.json"
+    origins.write_text(json.dumps(ORIGINS))
+    argv = [
+        "--target",
+        "app:image",
+        "--origins",
+        str(origins),
+        "--output",
+        str(tmp_path / "dist" / "image.size.json"),
+        "--previous",
+        str(tmp_path / "cache" / "app.json"),
+        archive,
+    ]
+    history = [{"created_by": "COPY application . # buildkit"}]
+    _write_image(archive, [_tar({"a": b"a"})], history)
+    assert main(argv) == 0
+    first = json.loads((tmp_path / "dist" / "image.size.json").read_text())
+    assert "diff" not in first
+    _write_image(archive, [_tar({"a": b"a", "b": b"b" * 20000})], history)
+    assert main(argv) == 0
+    second = json.loads((tmp_path / "dist" / "image.size.json").read_text())
+    assert second["diff"]["uncompressed_bytes"] > 0
+    assert list(second["diff"]["origins"]) == ["third-party files"]
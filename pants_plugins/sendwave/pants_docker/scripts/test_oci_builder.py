@@ -0,0 +1,233 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import pytest
+from sendwave.pants_docker.scripts.oci_builder import (
+    BuildError,
+    build_image,
+    parse_dockerfile,
+    split_reference,
+)
+
+
+def _write_blob(layout, content: bytes) -> dict:
+    digest = hashlib.sha256(content).hexdigest()
+    blob_dir = os.path.join(layout, "blobs", "sha256")
+    os.makedirs(blob_dir, exist_ok=True)
+    with open(os.path.join(blob_dir, digest), "wb") as f:
+        f.write(content)
+    return {"digest": "sha256:" + digest, "size": len(content)}
+
+
+def _layer(files) -> bytes:
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return gzip.compress(raw.getvalue())
+
+
+@pytest.fixture
+def base_layout(tmp_path) -> str:
+    """An OCI layout holding a one layer image tagged 3.8-slim."""
+    layout = str(tmp_path / "layout")
+    layer = _write_blob(layout, _layer({"etc/hostname": b"base\n"}))
+    config = _write_blob(
+        layout,
+        json.dumps(
+            {
+                "architecture": "amd64",
+                "os": "linux",
+                "config": {"Env": ["PATH=/usr/bin"], "Cmd": ["python3"]},
+                "rootfs": {"type": "layers", "diff_ids": ["sha256:base"]},
+                "history": [{"created_by": "base"}],
+            }
+        ).encode(),
+    )
+    manifest = _write_blob(
+        layout,
+        json.dumps(
+            {
+                "schemaVersion": 2,
+                "config": dict(
+                    config,
+                    mediaType="application/vnd.docker.container.image.v1+json",
+                ),
+                "layers": [
+                    dict(
+                        layer,
+                        mediaType="application/vnd.docker.image.rootfs.diff.tar.gzip",
+                    )
+                ],
+            }
+        ).encode(),
+    )
+    with open(os.path.join(layout, "index.json"), "w") as f:
+        json.dump(
+            {
+                "schemaVersion": 2,
+                "manifests": [
+                    dict(
+                        manifest,
+                        mediaType="application/vnd.oci.image.manifest.v1+json",
+                        annotations={
+                            "org.opencontainers.image.ref.name": "3.8-slim"
+                        },
+                    )
+                ],
+            },
+            f,
+        )
+    with open(os.path.join(layout, "oci-layout"), "w") as f:
+        json.dump({"imageLayoutVersion": "1.0.0"}, f)
+    return layout
+
+
+@pytest.fixture
+def context(tmp_path) -> str:
+    context = tmp_path / "context"
+    (context / "application" / "app").mkdir(parents=True)
+    (context / "application" / "app" / "main.py").write_text("print(1)\n")
+    (context / "application" / "run.sh").write_text("#!/bin/sh\n")
+    os.chmod(context / "application" / "run.sh", 0o755)
+    return str(context)
+
+
+def _write_dockerfile(context: str, text: str) -> None:
+    with open(os.path.join(context, "Dockerfile"), "w") as f:
+        f.write(text)
+
+
+def _read_image(path: str):
+    with tarfile.open(path) as tar:
+
+        def read(name):
+            return tar.extractfile(name).read()
+
+        docker_manifest = json.loads(read("manifest.json"))[0]
+        config = json.loads(read(docker_manifest["Config"]))
+        layers = []
+        for layer in docker_manifest["Layers"]:
+            with tarfile.open(
+                fileobj=io.BytesIO(gzip.decompress(read(layer)))
+            ) as t:
+                layers.append({m.name: m for m in t.getmembers()})
+        return docker_manifest, config, layers, json.loads(read("index.json"))
+
+
+DOCKERFILE = (
+    "FROM python:3.8-slim\n"
+    "WORKDIR root\n"
+    "ENV PATH=/.virtual_env/bin:$PATH\n"
+    "# copy the sources\n"
+    "COPY application .\n"
+    'CMD ["python","-m","app.main"]\n'
+)
+
+
+def test_parse_dockerfile() -> None:
+    assert parse_dockerfile("# syntax\nFROM a\nRUN b \\\n  && c\n\nCMD d") == [
+        ("FROM", "a"),
+        ("RUN", "b && c"),
+        ("CMD", "d"),
+    ]
+
+
+def test_split_reference() -> None:
+    assert split_reference("python:3.8") == ("python", "3.8", None)
+    assert split_reference("localhost:5000/app") == (
+        "localhost:5000/app",
+        None,
+        None,
+    )
+    assert split_reference("python:3.8@sha256:ab") == (
+        "python",
+        "3.8",
+        "sha256:ab",
+    )
+
+
+def test_build_image(base_layout, context, tmp_path) -> None:
+    _write_dockerfile(context, DOCKERFILE)
+    output = str(tmp_path / "image.tar")
+    build_image(context, base_layout, output, ["app:v1", "app"])
+
+    docker_manifest, config, layers, index = _read_image(output)
+    assert docker_manifest["RepoTags"] == ["app:v1", "app:latest"]
+    assert [
+        m["annotations"]["org.opencontainers.image.ref.name"]
+        for m in index["manifests"]
+    ] == ["v1", "latest"]
+    assert config["config"]["Env"] == ["PATH=/.virtual_env/bin:/usr/bin"]
+    assert config["config"]["WorkingDir"] == "/root"
+    assert config["config"]["Cmd"] == ["python", "-m", "app.main"]
+    assert len(config["rootfs"]["diff_ids"]) == 2
+    assert len(layers) == 2
+    assert set(layers[0]) == {"etc/hostname"}
+    copied = layers[1]
+    assert sorted(copied) == ["root/app", "root/app/main.py", "root/run.sh"]
+    assert copied["root/app"].isdir()
+    assert copied["root/run.sh"].mode == 0o755
+    assert copied["root/app/main.py"].mode == 0o644
+    assert all(m.mtime == 0 and m.uid == 0 for m in copied.values())
+
+
+def test_layers_are_reproducible(base_layout, context, tmp_path) -> None:
+    _write_dockerfile(context, DOCKERFILE)
+    first, second = str(tmp_path / "first.tar"), str(tmp_path / "second.tar")
+    build_image(context, base_layout, first, ["app"])
+    build_image(context, base_layout, second, ["app"])
+    assert _read_image(first)[0]["Layers"] == _read_image(second)[0]["Layers"]
+
+
+def test_run_instructions_are_rejected(base_layout, context, tmp_path) -> None:
+    _write_dockerfile(context, "FROM python:3.8-slim\nRUN pip install flask\n")
+    with pytest.raises(BuildError, match="RUN"):
+        build_image(context, base_layout, str(tmp_path / "image.tar"), [])
+
+
+def test_missing_base_image(base_layout, context, tmp_path) -> None:
+    with open(os.path.join(base_layout, "index.json")) as f:
+        index = json.load(f)
+    index["manifests"].append(index["manifests"][0])
+    with open(os.path.join(base_layout, "index.json"), "w") as f:
+        json.dump(index, f)
+    _write_dockerfile(context, "FROM alpine:3.16\n")
+    with pytest.raises(BuildError, match="alpine:3.16"):
+        build_image(context, base_layout, str(tmp_path / "image.tar"), [])
+
+
+def test_source_date_epoch(base_layout, context, tmp_path) -> None:
+    _write_dockerfile(context, DOCKERFILE)
+    output = str(tmp_path / "image.tar")
+    build_image(context, base_layout, output, ["app"], source_date_epoch=86400)
+
+    _, config, layers, _ = _read_image(output)
+    assert config["created"] == "1970-01-02T00:00:00Z"
+    assert all(m.mtime == 86400 for m in layers[1].values())
+
+
+def test_created(base_layout, context, tmp_path) -> None:
+    _write_dockerfile(context, DOCKERFILE)
+    first, second = str(tmp_path / "first.tar"), str(tmp_path / "second.tar")
+    assert build_image(context, base_layout, first, ["app"]) == build_image(
+        context, base_layout, second, ["app"]
+    )
+    assert _read_image(first)[1]["created"] == "1970-01-01T00:00:00Z"
+    build_image(context, base_layout, first, ["app"], created_now=True)
+    assert _read_image(first)[1]["created"] > "2000"
+
+
+def test_copy_link(base_layout, context, tmp_path) -> None:
+    first, second = str(tmp_path / "first.tar"), str(tmp_path / "second.tar")
+    _write_dockerfile(context, DOCKERFILE)
+    build_image(context, base_layout, first, ["app"])
+    _write_dockerfile(context, DOCKERFILE.replace("COPY", "COPY --link"))
+    build_image(context, base_layout, second, ["app"])
+    assert _read_image(first)[0]["Layers"] == _read_image(second)[0]["Layers"]
@@ -0,0 +1,453 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sendwave.pants_docker.scripts.registry import (
+    OCI_LAYER,
+    OCI_LAYER_GZIP,
+    RegistryError,
+    compress_layers,
+    docker_credentials,
+    locked_cache,
+    main,
+    parse_reference,
+    push,
+    read_archive,
+    resolve,
+)
+
+DIGEST = "sha256:" + "a" * 64
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    """Serve manifest digests, requiring a bearer token like Docker Hub."""
+
+    def do_GET(self) -> None:
+        # the token endpoint
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({"token": "secret"}).encode())
+
+    def do_HEAD(self) -> None:
+        self.server.requests.append(self.path)
+        if self.headers.get("Authorization") != "Bearer secret":
+            self.send_response(401)
+            realm = f"http://localhost:{self.server.server_port}/token"
+            self.send_header(
+                "WWW-Authenticate",
+                f'Bearer realm="{realm}",service="registry"',
+            )
+            self.end_headers()
+            return
+        digest = self.server.manifests.get(self.path)
+        self.send_response(200 if digest else 404)
+        if digest:
+            self.send_header("Docker-Content-Digest", digest)
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def registry():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeRegistryHandler)
+    server.requests = []
+    server.manifests = {"/v2/library/python/manifests/3.8-slim": DIGEST}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _registry_host(server) -> str:
+    return f"localhost:{server.server_port}"
+
+
+def test_parse_reference() -> None:
+    assert parse_reference("python") == (
+        "registry-1.docker.io",
+        "library/python",
+        "latest",
+        None,
+    )
+    assert parse_reference("org/app:1.0") == (
+        "registry-1.docker.io",
+        "org/app",
+        "1.0",
+        None,
+    )
+    assert parse_reference("localhost:5000/app:1.0") == (
+        "localhost:5000",
+        "app",
+        "1.0",
+        None,
+    )
+    assert parse_reference(f"ghcr.io/org/app@{DIGEST}") == (
+        "ghcr.io",
+        "org/app",
+        None,
+        DIGEST,
+    )
+
+
+def test_resolve(registry) -> None:
+    cache = {}
+    pinned = resolve(
+        ["python:3.8-slim", f"python@{DIGEST}"],
+        cache,
+        ttl=60,
+        registry=_registry_host(registry),
+    )
+    key = f"{_registry_host(registry)}/library/python:3.8-slim"
+    assert pinned == {
+        "python:3.8-slim": f"{key}@{DIGEST}",
+        f"python@{DIGEST}": f"python@{DIGEST}",
+    }
+    assert cache[key]["digest"] == DIGEST
+
+
+def test_resolve_uses_cache_until_expired(registry) -> None:
+    clock = [1000.0]
+    cache = {}
+    host = _registry_host(registry)
+    resolve(["python:3.8-slim"], cache, 60, host, now=lambda: clock[0])
+    requests = len(registry.requests)
+    clock[0] += 30
+    resolve(["python:3.8-slim"], cache, 60, host, now=lambda: clock[0])
+    assert len(registry.requests) == requests
+    clock[0] += 60
+    registry.manifests["/v2/library/python/manifests/3.8-slim"] = (
+        "sha256:" + "b" * 64
+    )
+    pinned = resolve(["python:3.8-slim"], cache, 60, host, now=lambda: clock[0])
+    assert pinned["python:3.8-slim"].endswith("b" * 64)
+
+
+def test_resolve_offline_uses_expired_entry() -> None:
+    cache = {
+        "localhost:1/library/python:3.8-slim": {
+            "digest": DIGEST,
+            "resolved_at": 0,
+        }
+    }
+    warnings = []
+    pinned = resolve(
+        ["python:3.8-slim"], cache, 60, "localhost:1", warn=warnings.append
+    )
+    assert pinned["python:3.8-slim"] == (
+        f"localhost:1/library/python:3.8-slim@{DIGEST}"
+    )
+    assert len(warnings) == 1
+    with pytest.raises(RegistryError):
+        resolve(["python:3.9-slim"], cache, 60, "localhost:1")
+
+
+def test_main(registry, tmp_path, capsys) -> None:
+    cache_path = str(tmp_path / "cache" / "base_images.json")
+    argv = [
+        "resolve",
+        "--cache",
+        cache_path,
+        "--registry",
+        _registry_host(registry),
+        "python:3.8-slim",
+    ]
+    assert main(argv) == 0
+    assert json.loads(capsys.readouterr().out) == {
+        "python:3.8-slim": (
+            f"{_registry_host(registry)}/library/python:3.8-slim@{DIGEST}"
+        )
+    }
+    with locked_cache(cache_path) as cache:
+        assert len(cache) == 1
+
+
+class FakeBasicAuthRegistryHandler(FakeRegistryHandler):
+    """Serve manifest digests to a logged in user, like a private
+    registry."""
+
+    def do_HEAD(self) -> None:
+        self.server.requests.append(self.path)
+        if self.headers.get("Authorization") != "Basic dXNlcjpzZWNyZXQ=":
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", 'Basic realm="registry"')
+            self.end_headers()
+            return
+        digest = self.server.manifests.get(self.path)
+        self.send_response(200 if digest else 404)
+        if digest:
+            self.send_header("Docker-Content-Digest", digest)
+        self.end_headers()
+
+
+def test_main_resolves_with_docker_login(tmp_path, capsys) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBasicAuthRegistryHandler)
+    server.requests = []
+    server.manifests = {"/v2/library/python/manifests/3.8-slim": DIGEST}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        host = _registry_host(server)
+        argv = [
+            "resolve",
+            "--cache",
+            str(tmp_path / "base_images.json"),
+            "--docker-config",
+            str(tmp_path),
+            "--registry",
+            host,
+            "python:3.8-slim",
+        ]
+        assert main(argv) == 1
+        assert "login" in capsys.readouterr().err
+        auths = {"auths": {host: {"auth": "dXNlcjpzZWNyZXQ="}}}
+        (tmp_path / "config.json").write_text(json.dumps(auths))
+        assert main(argv) == 0
+        assert json.loads(capsys.readouterr().out) == {
+            "python:3.8-slim": f"{host}/library/python:3.8-slim@{DIGEST}"
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FakePushRegistryHandler(BaseHTTPRequestHandler):
+    """Store pushed blobs & manifests, like a local registry."""
+
+    def _send(self, status: int, headers=()) -> None:
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _log(self) -> None:
+        self.server.requests.append((self.command, self.path.split("?")[0]))
+
+    def do_HEAD(self) -> None:
+        self._log()
+        repository, _, digest = self.path[4:].rpartition("/blobs/")
+        found = digest in self.server.blobs.get(repository, {})
+        self._send(200 if found else 404)
+
+    def do_POST(self) -> None:
+        self._log()
+        path, _, query = self.path.partition("?")
+        repository = path[4:].rpartition("/blobs/")[0]
+        params = dict(p.split("=", 1) for p in query.split("&") if p)
+        if "mount" in params:
+            digest = params["mount"].replace("%3A", ":")
+            source = self.server.blobs.get(params["from"], {})
+            if digest in source:
+                self.server.blobs.setdefault(repository, {})[digest] = source[
+                    digest
+                ]
+                self._send(201)
+                return
+        upload = uuid.uuid4().hex
+        self.server.uploads[upload] = repository
+        self._send(202, [("Location", f"/v2/{repository}/uploads/{upload}")])
+
+    def do_PUT(self) -> None:
+        self._log()
+        path, _, query = self.path.partition("?")
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if "/manifests/" in path:
+            repository, _, tag = path[4:].rpartition("/manifests/")
+            self.server.manifests[(repository, tag)] = json.loads(body)
+            self._send(201)
+            return
+        repository = self.server.uploads.pop(path.rpartition("/")[2])
+        digest = query.partition("digest=")[2].replace("%3A", ":")
+        assert digest == "sha256:" + hashlib.sha256(body).hexdigest()
+        self.server.blobs.setdefault(repository, {})[digest] = body
+        self._send(201)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def push_registry():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakePushRegistryHandler)
+    server.requests = []
+    server.blobs = {}
+    server.uploads = {}
+    server.manifests = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _write_archive(path, images) -> None:
+    """Write a `docker save` style tarball of images, each given as
+    (tags, config, layers)."""
+    manifest = []
+    files = {}
+    for tags, config, layers in images:
+        config_name = hashlib.sha256(config).hexdigest() + ".json"
+        files[config_name] = config
+        layer_names = []
+        for layer in layers:
+            name = hashlib.sha256(layer).hexdigest()[:12] + "/layer.tar"
+            files[name] = layer
+            layer_names.append(name)
+        manifest.append(
+            {"Config": config_name, "RepoTags": tags, "Layers": layer_names}
+        )
+    files["manifest.json"] = json.dumps(manifest).encode()
+    with tarfile.open(path, "w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def test_read_archive(tmp_path) -> None:
+    archive = str(tmp_path / "images.tar")
+    _write_archive(archive, [(["app:1"], b"{}", [b"base", b"sources"])])
+    (image,) = read_archive(archive)
+    assert image.tags == ("app:1",)
+    assert image.config.digest == "sha256:" + hashlib.sha256(b"{}").hexdigest()
+    assert [layer.media_type for layer in image.layers] == [OCI_LAYER] * 2
+    assert image.layers[1].open().read() == b"sources"
+    manifest = json.loads(image.manifest())
+    assert [layer["size"] for layer in manifest["layers"]] == [4, 7]
+
+
+def test_push_uploads_each_blob_once(push_registry, tmp_path) -> None:
+    host = _registry_host(push_registry)
+    archive = str(tmp_path / "images.tar")
+    _write_archive(
+        archive,
+        [
+            (
+                [f"{host}/app:1", f"{host}/app:latest"],
+                b'{"a": 1}',
+                [b"base", b"app"],
+            ),
+            ([f"{host}/worker:1"], b'{"w": 1}', [b"base", b"worker"]),
+        ],
+    )
+    counts = push(read_archive(archive), concurrency=4)
+    assert counts["manifests"] == 3
+    # 2 configs & 3 distinct layers, the shared base layer is mounted
+    assert counts["uploaded_blobs"] == 5
+    assert counts["mounted_blobs"] == 1
+    heads = [
+        path for method, path in push_registry.requests if method == "HEAD"
+    ]
+    assert len(heads) == len(set(heads)) == 5
+    assert set(push_registry.manifests) == {
+        ("app", "1"),
+        ("app", "latest"),
+        ("worker", "1"),
+    }
+    worker = push_registry.manifests[("worker", "1")]
+    for descriptor in (worker["config"], *worker["layers"]):
+        assert descriptor["digest"] in push_registry.blobs["worker"]
+    # pushing again only checks the blobs exist
+    push_registry.requests.clear()
+    counts = push(read_archive(archive), concurrency=4)
+    assert counts["existing_blobs"] == 5
+    assert "uploaded_blobs" not in counts
+    assert not [
+        r
+        for r in push_registry.requests
+        if r[0] == "PUT" and "/uploads/" in r[1]
+    ]
+
+
+def test_compress_layers(tmp_path) -> None:
+    archive = str(tmp_path / "images.tar")
+    _write_archive(
+        archive,
+        [
+            (["app:1"], b'{"a": 1}', [b"base", b"app"]),
+            (["worker:1"], b'{"w": 1}', [b"base", b"worker"]),
+        ],
+    )
+    images = read_archive(archive)
+    (tmp_path / "first").mkdir()
+    (tmp_path / "second").mkdir()
+    app, worker = compress_layers(images, str(tmp_path / "first"), 2)
+    # the shared base layer is compressed once
+    assert len(list((tmp_path / "first").iterdir())) == 3
+    assert app.layers[0] == worker.layers[0]
+    assert app.config == images[0].config
+    for layer, content in zip(app.layers, [b"base", b"app"]):
+        assert layer.media_type == OCI_LAYER_GZIP
+        reader = layer.open()
+        compressed = reader.read()
+        reader.close()
+        assert gzip.decompress(compressed) == content
+        assert layer.size == len(compressed)
+        assert layer.digest == (
+            "sha256:" + hashlib.sha256(compressed).hexdigest()
+        )
+    # compressing again gives the same digests
+    again = compress_layers(images, str(tmp_path / "second"), 2)
+    assert [layer.digest for layer in again[0].layers] == [
+        layer.digest for layer in app.layers
+    ]
+    manifest = json.loads(app.manifest())
+    assert {layer["mediaType"] for layer in manifest["layers"]} == {
+        OCI_LAYER_GZIP
+    }
+
+
+def test_docker_credentials(tmp_path) -> None:
+    auths = {
+        "auths": {
+            "https://index.docker.io/v1/": {"auth": "aHViOnNlY3JldA=="},
+            "ghcr.io": {"auth": "Z2g6dG9rZW4="},
+        }
+    }
+    (tmp_path / "config.json").write_text(json.dumps(auths))
+    assert docker_credentials("registry-1.docker.io", str(tmp_path)) == (
+        "aHViOnNlY3JldA=="
+    )
+    assert docker_credentials("ghcr.io", str(tmp_path)) == "Z2g6dG9rZW4="
+    assert docker_credentials("localhost:5000", str(tmp_path)) is None
+
+
+def test_docker_credentials_helpers(tmp_path, monkeypatch) -> None:
+    # a credential helper storing credentials for ghcr.io only
+    helper = tmp_path / "bin" / "docker-credential-fake"
+    helper.parent.mkdir()
+    helper.write_text(
+        f"#!{sys.executable}\n"
+        "import json, sys\n"
+        "server = sys.stdin.read()\n"
+        "if server != 'ghcr.io':\n"
+        "    print('credentials not found in native keychain')\n"
+        "    sys.exit(1)\n"
+        "print(json.dumps({'Username': 'gh', 'Secret': 'token'}))\n"
+    )
+    helper.chmod(0o755)
+    monkeypatch.setenv("PATH", str(helper.parent), prepend=os.pathsep)
+    config = {
+        "auths": {"ghcr.io": {}, "quay.io": {"auth": "cXVheTpzZWNyZXQ="}},
+        "credHelpers": {"ghcr.io": "fake", "gcr.io": "missing"},
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    assert docker_credentials("ghcr.io", str(tmp_path)) == "Z2g6dG9rZW4="
+    assert docker_credentials("quay.io", str(tmp_path)) == "cXVheTpzZWNyZXQ="
+    with pytest.raises(RegistryError, match="docker-credential-missing"):
+        docker_credentials("gcr.io", str(tmp_path))
+    config["credsStore"] = "fake"
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    assert docker_credentials("quay.io", str(tmp_path)) is None
@@ -0,0 +1,77 @@
+import fcntl
+import sys
+
+import pytest
+from sendwave.pants_docker.scripts.run_docker import (
+    acquire_slot,
+    main,
+    relay_output,
+)
+
+
+def test_acquire_slot_uses_free_slots(tmp_path):
+    first = acquire_slot(str(tmp_path), 2)
+    second = acquire_slot(str(tmp_path), 2)
+    assert first.name != second.name
+    first.close()
+    third = acquire_slot(str(tmp_path), 2)
+    assert third.name == first.name
+    second.close()
+    third.close()
+
+
+def test_acquired_slot_is_locked(tmp_path):
+    slot = acquire_slot(str(tmp_path), 1)
+    with open(slot.name, "a") as other:
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    slot.close()
+
+
+@pytest.mark.parametrize("slots", [0, 1])
+def test_main_returns_command_exit_code(tmp_path, slots):
+    command = [sys.executable, "-c", "import sys; sys.exit(3)"]
+    argv = ["--slots", str(slots), "--lock-dir", str(tmp_path), "--", *command]
+    assert main(argv) == 3
+
+
+def test_relay_output_streams_every_line(tmp_path):
+    lines = [f"line {i}\n" for i in range(5)]
+    with open(tmp_path / "build.log", "w") as log:
+        assert relay_output(iter(lines), log, 0) == lines
+    assert (tmp_path / "build.log").read_text() == "".join(lines)
+
+
+def test_relay_output_keeps_tail_and_steps():
+    lines = [
+        "#5 [2/3] RUN pip install flask\n",
+        "#5 0.1 Collecting flask\n",
+        "#5 DONE 3.2s\n",
+        "#6 [3/3] COPY application .\n",
+        "#6 DONE 0.1s\n",
+    ]
+    assert relay_output(iter(lines), None, 2) == [
+        "#5 [2/3] RUN pip install flask\n",
+        "#5 DONE 3.2s\n",
+        "[...]\n",
+        "#6 [3/3] COPY application .\n",
+        "#6 DONE 0.1s\n",
+    ]
+
+
+def test_main_streams_to_log_file(tmp_path, capsys):
+    log_file = tmp_path / "logs" / "image.log"
+    command = [sys.executable, "-c", "print('a'); print('b'); print('c')"]
+    argv = [
+        "--lock-dir",
+        str(tmp_path),
+        "--log-file",
+        str(log_file),
+        "--tail",
+        "1",
+        "--",
+        *command,
+    ]
+    assert main(argv) == 0
+    assert log_file.read_text() == "a\nb\nc\n"
+    assert capsys.readouterr().out == "c\n"
@@ -0,0 +1,155 @@
+import json
+import os
+import sys
+
+from sendwave.pants_docker.scripts.thin_layer import (
+    FULL_BUILD,
+    diff_manifests,
+    file_manifest,
+    main,
+    thin_dockerfile,
+)
+
+# a docker CLI which logs its arguments & the Dockerfile it builds, and
+# knows a single image
+FAKE_DOCKER = """\
+import json, os, sys
+log = os.environ["FAKE_DOCKER_LOG"]
+args = sys.argv[1:]
+entry = {"args": args}
+if args[0] == "build":
+    with open(os.path.join(args[-1], "Dockerfile")) as f:
+        entry["dockerfile"] = f.read()
+    entry["files"] = sorted(
+        os.path.relpath(os.path.join(d, n), args[-1])
+        for d, _, names in os.walk(args[-1])
+        for n in names
+    )
+with open(log, "a") as f:
+    f.write(json.dumps(entry) + "\\n")
+if args[:2] == ["image", "inspect"]:
+    if args[-1] == "missing:latest":
+        sys.exit(1)
+    ref = args[-1]
+    print(ref if ref.startswith("sha256:") else "sha256:" + ref)
+"""
+
+
+def _fake_docker(tmp_path, monkeypatch):
+    script = tmp_path / "docker"
+    script.write_text(f"#!{sys.executable}\n{FAKE_DOCKER}")
+    script.chmod(0o755)
+    log = tmp_path / "docker.log"
+    monkeypatch.setenv("FAKE_DOCKER_LOG", str(log))
+    return str(script), log
+
+
+def _write_files(root, files):
+    for path, content in files.items():
+        os.makedirs(os.path.dirname(root / path), exist_ok=True)
+        (root / path).write_text(content)
+
+
+def test_diff_manifests():
+    old = {"a.py": "1", "b.py": "2", "c.txt": "3"}
+    new = {"a.py": "1", "b.py": "changed", "d.py": "4"}
+    assert diff_manifests(old, new) == (["b.py", "d.py"], ["c.txt"])
+
+
+def test_file_manifest(tmp_path):
+    _write_files(tmp_path, {"app/main.py": "print()", "data.txt": ""})
+    manifest = file_manifest(str(tmp_path))
+    assert sorted(manifest) == ["app/main.py", "data.txt"]
+    assert manifest["data.txt"] == (
+        "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    )
+
+
+def test_thin_dockerfile():
+    assert thin_dockerfile(
+        "sha256:abc", ["app/main.py", "data.txt"], ["app/old.py"], True
+    ) == (
+        "FROM sha256:abc\n"
+        "COPY files/ ./\n"
+        "RUN rm -f -- app/old.py\n"
+        "RUN python -m compileall -q --invalidation-mode unchecked-hash "
+        "app/main.py\n"
+    )
+    assert thin_dockerfile("sha256:abc", [], ["a b.txt"], False) == (
+        "FROM sha256:abc\nRUN rm -f -- 'a b.txt'\n"
+    )
+
+
+def _args(command, tmp_path, docker, recipe="recipe"):
+    return [
+        command,
+        "--record",
+        str(tmp_path / "cache" / "app.json"),
+        "--recipe",
+        recipe,
+        "--files",
+        str(tmp_path / "files"),
+        "--docker",
+        docker,
+    ]
+
+
+def test_build_without_record_needs_full_build(tmp_path, monkeypatch):
+    docker, _ = _fake_docker(tmp_path, monkeypatch)
+    _write_files(tmp_path / "files", {"main.py": "v1"})
+    argv = [*_args("build", tmp_path, docker), "--tag", "app"]
+    assert main(argv) == FULL_BUILD
+
+
+def test_build_adds_changed_files(tmp_path, monkeypatch):
+    docker, log = _fake_docker(tmp_path, monkeypatch)
+    monkeypatch.chdir(tmp_path)
+    _write_files(tmp_path / "files", {"main.py": "v1", "old.py": "v1"})
+    assert main([*_args("record", tmp_path, docker), "--image", "app"]) == 0
+    os.remove(tmp_path / "files" / "old.py")
+    _write_files(tmp_path / "files", {"main.py": "v2", "new.txt": ""})
+    build = [*_args("build", tmp_path, docker), "--tag", "app"]
+    assert main([*build, "--label", "fingerprint=1"]) == 0
+    builds = [
+        json.loads(line)
+        for line in log.read_text().splitlines()
+        if json.loads(line)["args"][0] == "build"
+    ]
+    assert builds[0]["args"][:5] == [
+        "build",
+        "-t",
+        "app",
+        "--label",
+        "fingerprint=1",
+    ]
+    assert builds[0]["dockerfile"] == (
+        "FROM sha256:app\nCOPY files/ ./\nRUN rm -f -- old.py\n"
+    )
+    assert builds[0]["files"] == [
+        "Dockerfile",
+        "files/main.py",
+        "files/new.txt",
+    ]
+    record = json.loads((tmp_path / "cache" / "app.json").read_text())
+    assert record["thin_layers"] == 1
+    assert sorted(record["files"]) == ["main.py", "new.txt"]
+    # nothing changed since the thin layer was added, so none is added
+    assert main([*build, "--max-layers", "2"]) == 0
+    assert main([*build, "--max-layers", "1"]) == FULL_BUILD
+
+
+def test_build_with_other_recipe_needs_full_build(tmp_path, monkeypatch):
+    docker, _ = _fake_docker(tmp_path, monkeypatch)
+    _write_files(tmp_path / "files", {"main.py": "v1"})
+    assert main([*_args("record", tmp_path, docker), "--image", "app"]) == 0
+    build = [*_args("build", tmp_path, docker, "other"), "--tag", "app"]
+    assert main(build) == FULL_BUILD
+
+
+def test_build_without_previous_image_needs_full_build(tmp_path, monkeypatch):
+    docker, _ = _fake_docker(tmp_path, monkeypatch)
+    _write_files(tmp_path / "files", {"main.py": "v1"})
+    record = [*_args("record", tmp_path, docker), "--image", "missing:latest"]
+    assert main(record) == 0
+    build = [*_args("build", tmp_path, docker), "--tag", "app"]
+    assert main(build) == FULL_BUILD
@@ -0,0 +1,190 @@
+"""Rebuild an image by adding a thin layer of changed sources to it.
+
+Run by the plugin (with `python -c`) inside a pants process sandbox,
+which holds the files copied into the image's working directory under
+`--files`. The last image built for a target is recorded in a JSON
+file (in a pants named cache, shared by every sandbox) along with:
+
+- the image's "recipe": a fingerprint of every input of the image
+  except the files it copies, i.e. its Dockerfile without its COPY
+  instructions & the files used to install third-party requirements
+- a manifest of the copied files, with the sha256 of each
+
+`build` checks whether the recorded image has the same recipe & still
+exists. If so, the new image is built `FROM` it with one COPY of the
+files which changed, and a RUN removing the files which were deleted
+(and compiling the changed python files when the image's bytecode is
+precompiled). Otherwise, or once an image has `--max-layers` thin
+layers, it exits with FULL_BUILD and the image has to be built from
+its full Dockerfile, after which `record` records it.
+
+Only depends on the python standard library.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# exit code of `build` when the image can't be built incrementally
+FULL_BUILD = 3
+
+
+def file_manifest(root: str) -> Dict[str, str]:
+    """Map the path of every file under `root` to its sha256."""
+    manifest = {}
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            relative = os.path.relpath(path, root).replace(os.sep, "/")
+            manifest[relative] = digest
+    return manifest
+
+
+def diff_manifests(
+    old: Dict[str, str], new: Dict[str, str]
+) -> Tuple[List[str], List[str]]:
+    """The (changed or added, deleted) files between two manifests."""
+    changed = sorted(path for path in new if old.get(path) != new[path])
+    deleted = sorted(path for path in old if path not in new)
+    return changed, deleted
+
+
+def thin_dockerfile(
+    image: str, changed: Sequence[str], deleted: Sequence[str], compile: bool
+) -> str:
+    """A Dockerfile adding `changed` files to, & removing `deleted`
+    files from, the working directory of `image`."""
+    lines = [f"FROM {image}\n"]
+    if changed:
+        lines.append("COPY files/ ./\n")
+    if deleted:
+        lines.append("RUN rm -f -- {}\n".format(shlex.join(deleted)))
+    sources = [path for path in changed if path.endswith(".py")]
+    if compile and sources:
+        lines.append(
+            "RUN python -m compileall -q --invalidation-mode unchecked-hash "
+            "{}\n".format(shlex.join(sources))
+        )
+    return "".join(lines)
+
+
+def load_record(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_record(path: str, record: dict) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(record, f, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def image_id(docker: str, reference: str) -> Optional[str]:
+    """The ID of a local image, or None if it doesn't exist."""
+    result = subprocess.run(
+        [docker, "image", "inspect", "--format", "{{.Id}}", reference],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def build(args: argparse.Namespace) -> int:
+    record = load_record(args.record)
+    if record is None or record.get("recipe") != args.recipe:
+        print("No previous image with the same recipe", file=sys.stderr)
+        return FULL_BUILD
+    if record.get("thin_layers", 0) >= args.max_layers:
+        print("The previous image has too many thin layers", file=sys.stderr)
+        return FULL_BUILD
+    previous = image_id(args.docker, record["image"])
+    if previous is None:
+        print("The previous image no longer exists", file=sys.stderr)
+        return FULL_BUILD
+    manifest = file_manifest(args.files)
+    changed, deleted = diff_manifests(record["files"], manifest)
+    with tempfile.TemporaryDirectory(dir=".") as context:
+        for path in changed:
+            destination = os.path.join(context, "files", path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(os.path.join(args.files, path), destination)
+            shutil.copymode(os.path.join(args.files, path), destination)
+        with open(os.path.join(context, "Dockerfile"), "w") as f:
+            f.write(thin_dockerfile(previous, changed, deleted, args.compile))
+        command = [args.docker, "build"]
+        for tag in args.tag:
+            command.extend(["-t", tag])
+        for label in args.label:
+            command.extend(["--label", label])
+        if args.progress:
+            command.extend(["--progress", args.progress])
+        result = subprocess.run([*command, context])
+    if result.returncode != 0:
+        return result.returncode
+    print(
+        f"Added {len(changed)} changed & removed {len(deleted)} deleted "
+        f"files to the image"
+    )
+    save_record(
+        args.record,
+        {
+            "recipe": args.recipe,
+            "image": image_id(args.docker, args.tag[0]) or args.tag[0],
+            "files": manifest,
+            "thin_layers": record.get("thin_layers", 0)
+            + bool(changed or deleted),
+        },
+    )
+    return 0
+
+
+def record(args: argparse.Namespace) -> int:
+    save_record(
+        args.record,
+        {
+            "recipe": args.recipe,
+            "image": image_id(args.docker, args.image) or args.image,
+            "files": file_manifest(args.files),
+            "thin_layers": 0,
+        },
+    )
+    return 0
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build")
+    record_parser = commands.add_parser("record")
+    for command_parser in (build_parser, record_parser):
+        command_parser.add_argument("--record", required=True)
+        command_parser.add_argument("--recipe", required=True)
+        command_parser.add_argument("--files", required=True)
+        command_parser.add_argument("--docker", default="docker")
+    build_parser.add_argument("--tag", action="append", required=True)
+    build_parser.add_argument("--label", action="append", default=[])
+    build_parser.add_argument("--compile", action="store_true")
+    build_parser.add_argument("--max-layers", type=int, default=10)
+    build_parser.add_argument("--progress", help="`docker build` progress")
+    build_parser.set_defaults(run=build)
+    record_parser.add_argument("--image", required=True)
+    record_parser.set_defaults(run=record)
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""Report where the size of built images comes from.
+
+With `--sendwave-docker-size-report` every image built with docker is
+read back from the daemon with `docker save` (or, with
+`--sendwave-docker-export-image`, read from the exported tarball) and
+analyzed by scripts/image_report.py, which writes a JSON report next to
+the package's output (under dist/) with:
+
+- the compressed & uncompressed size of each layer of the image, and
+  its largest files
+- the "origin" of each layer: the part of the target which produced
+  the Dockerfile instruction that created it (its base image, setup
+  commands, third-party requirements, or the sources of a directory;
+  see `DockerBuildContext.origins`), and the total size of each origin
+- how much the image & each origin grew or shrank since the previous
+  report of the same target, which is kept in the `sendwave_docker`
+  pants named cache
+
+Images which are tagged rather than built, with
+`--sendwave-docker-skip-unchanged`, aren't reported on.
+"""
+import json
+import pkgutil
+import shlex
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from pants.core.util_rules.system_binaries import BashBinary
+from pants.engine.addresses import Address
+from pants.engine.fs import (
+    EMPTY_DIGEST,
+    CreateDigest,
+    Digest,
+    FileContent,
+    MergeDigests,
+)
+from pants.engine.process import Process, ProcessCacheScope, ProcessResult
+from pants.engine.rules import Get, collect_rules, rule
+from sendwave.pants_docker.binary import CACHE_DIR, CACHE_NAME, DockerBinary
+
+# the last report of each target, in the CACHE_NAME named cache
+REPORT_DIR = f"{CACHE_DIR}/size_reports"
+REPORT_SCRIPT = "__image_report.py"
+ORIGINS_FILE = "__origins.json"
+SAVED_IMAGE = "__image.tar"
+
+
+@dataclass(frozen=True)
+class SizeReportRequest:
+    """Analyze the size of an image built from a target.
+
+    archive: holds a tarball of the image at `archive_path`, if it was
+      exported, which is read instead of the image in the daemon
+    """
+
+    address: Address
+    image: str
+    origins: Tuple[Tuple[str, str], ...]
+    output_path: str
+    archive: Digest = EMPTY_DIGEST
+    archive_path: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class SizeReport:
+    digest: Digest
+
+
+@rule
+async def create_size_report(
+    request: SizeReportRequest, docker_binary: DockerBinary, bash: BashBinary
+) -> SizeReport:
+    script = pkgutil.get_data(
+        "sendwave.pants_docker.scripts", "image_report.py"
+    )
+    assert script is not None
+    report_files = await Get(
+        Digest,
+        CreateDigest(
+            [
+                FileContent(REPORT_SCRIPT, script),
+                FileContent(
+                    ORIGINS_FILE, json.dumps(request.origins).encode("utf-8")
+                ),
+            ]
+        ),
+    )
+    input_digest = await Get(
+        Digest, MergeDigests([report_files, request.archive])
+    )
+    archive_path = request.archive_path or SAVED_IMAGE
+    report_argv = [
+        docker_binary.python,
+        REPORT_SCRIPT,
+        "--target",
+        str(request.address),
+        "--origins",
+        ORIGINS_FILE,
+        "--output",
+        request.output_path,
+        "--previous",
+        f"{REPORT_DIR}/{request.address.path_safe_spec}.json",
+        archive_path,
+    ]
+    command = shlex.join(report_argv)
+    if not request.archive_path:
+        save_argv = [docker_binary.path, "save", "--output", SAVED_IMAGE]
+        command = "{} && {}".format(
+            shlex.join([*save_argv, request.image]), command
+        )
+    result = await Get(
+        ProcessResult,
+        Process(
+            argv=(bash.path, "-c", command),
+            env=docker_binary.env,
+            input_digest=input_digest,
+            output_files=(request.output_path,),
+            description=f"Analyzing the size of the image of {request.address}",
+            cache_scope=ProcessCacheScope.PER_SESSION,
+            append_only_caches={CACHE_NAME: CACHE_DIR},
+        ),
+    )
+    return SizeReport(result.output_digest)
+
+
+def rules():
+    return [
+        *collect_rules(),
+    ]
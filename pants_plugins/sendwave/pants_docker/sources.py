@@ -1,5 +1,6 @@
 import logging
 from dataclasses import dataclass
+from typing import Tuple
 
 from pants.backend.python.target_types import PythonSourceField
 from pants.core.target_types import (
@@ -10,7 +11,7 @@ from pants.core.target_types import (
 from pants.core.util_rules.source_files import SourceFiles, SourceFilesRequest
 from pants.core.util_rules.stripped_source_files import StrippedSourceFiles
 from pants.engine.rules import Get, collect_rules, rule
-from pants.engine.target import FieldSet
+from pants.engine.target import FieldSet, SourcesField
 from pants.engine.unions import UnionRule
 from sendwave.pants_docker.docker_component import (
     DockerComponent,
@@ -96,6 +97,26 @@ async def get_sources(field_set: DockerPythonSourcesFS) -> DockerComponent:
     return DockerComponent(commands=(), sources=source_files.snapshot.digest)
 
 
+# field sets whose component is only their (stripped) source files,
+# which can be hydrated for many targets at once
+BATCHED_FIELD_SETS = (DockerPythonSourcesFS, DockerResourcesFS, DockerFilesFS)
+
+
+@dataclass(frozen=True)
+class SourcesBatchRequest:
+    """The source fields of many targets of one BATCHED_FIELD_SETS type."""
+
+    sources: Tuple[SourcesField, ...]
+
+
+@rule
+async def get_sources_batch(request: SourcesBatchRequest) -> DockerComponent:
+    source_files = await Get(
+        StrippedSourceFiles, SourceFilesRequest(request.sources)
+    )
+    return DockerComponent(commands=(), sources=source_files.snapshot.digest)
+
+
 def rules():
     return [
         UnionRule(DockerComponentFieldSet, DockerPythonSourcesFS),
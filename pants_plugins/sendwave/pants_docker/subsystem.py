@@ -1,9 +1,38 @@
 """Configuration for the Sendwave pants-docker plugin."""
+from enum import Enum
+
 from pants.engine.rules import SubsystemRule
-from pants.option.option_types import BoolOption
+from pants.option.option_types import (
+    BoolOption,
+    EnumOption,
+    IntOption,
+    StrOption,
+)
 from pants.option.subsystem import Subsystem
 
 
+class LayerStrategy(Enum):
+    """How source files are split into layers of the built image."""
+
+    single = "single"
+    split = "split"
+    content = "content"
+
+
+class VirtualEnvBuilder(Enum):
+    """Where third-party python requirements are resolved."""
+
+    image = "image"
+    pex = "pex"
+
+
+class BuildBackend(Enum):
+    """What builds images from the generated Dockerfile & context."""
+
+    docker = "docker"
+    oci = "oci"
+
+
 class Docker(Subsystem):
     """Options for Docker Plugin.
 
@@ -11,8 +40,88 @@ class Docker(Subsystem):
     pants.toml, or by passing --docker-{option-name} to your command.
     Available Options:
 
-    report-progress (boolean): if true, log the output of the docker
-        build process.
+    report-progress (boolean): if true, stream the output of the docker
+        build process to a log file, and log the end of it.
+
+    batch-requirements (boolean): if true, install all third-party
+        python requirements with a single `pip install -r`.
+
+    layers ('single', 'split' or 'content'): how the source files of
+        an image are grouped into `COPY` layers.
+
+    virtual-env ('image' or 'pex'): install third-party requirements
+        with pip while building the image, or resolve them with pants
+        into a PEX which is installed as the image's virtual env.
+
+    skip-unchanged (boolean): if true, do not rebuild images whose
+        Dockerfile & build context are unchanged since the last build.
+
+    buildkit-cache-mounts (boolean): if true, keep pip & apt download
+        caches in BuildKit cache mounts between builds.
+
+    share-base-images (boolean): if true, build the base image, setup
+        commands & third-party requirements of images once, as an
+        intermediate image shared by every image with identical ones.
+
+    build-concurrency (integer): the maximum number of images built by
+        the docker daemon at once, 0 for no limit.
+
+    exclude-tests (boolean): if true, leave python test files out of
+        the build context.
+
+    exclude-bytecode (boolean): if true, leave compiled python bytecode
+        out of the build context.
+
+    reproducible (boolean): if true, build images whose layers only
+        depend on their inputs, with every timestamp set to
+        source-date-epoch.
+
+    source-date-epoch (integer): the timestamp (seconds since the unix
+        epoch) used in reproducible images.
+
+    metrics (boolean): if true, write a JSON report of where the time
+        building each image went next to the package's output.
+
+    export-image (boolean): if true, write images built with docker to
+        the target's output path with `docker save`.
+
+    backend ('docker' or 'oci'): build images with the docker CLI, or
+        assemble them into an OCI tarball without a docker daemon.
+
+    oci-layout (string): path of the OCI image layout holding base
+        images for the 'oci' backend.
+
+    oci-platform (string): platform of the base image to use from the
+        OCI image layout.
+
+    collapse-setup (boolean): if true, run the setup commands of an
+        image in a single layer, which removes package manager caches.
+
+    pin-base-images (boolean): if true, resolve base images to the
+        digest they point to & build `FROM image@sha256:...`.
+
+    base-image-ttl (integer): how long, in seconds, a resolved base
+        image digest is reused before it is resolved again.
+
+    base-image-registry (string): a registry (e.g. localhost:5000) to
+        resolve & pull every base image from, instead of its own.
+
+    incremental (boolean): if true, rebuild images whose only changes
+        are to their sources by adding a layer of the changed files to
+        the last image built from the target.
+
+    max-thin-layers (integer): how many layers of changed files are
+        added to an image before it is rebuilt in full.
+
+    push-concurrency (integer): the maximum number of requests sent to
+        registries at once by `docker-push`.
+
+    size-report (boolean): if true, write a JSON report of the size of
+        each layer of images built with docker, and what added it.
+
+    dockerfile-frontend (string): the Dockerfile frontend image (e.g.
+        docker/dockerfile:1.4) declared by Dockerfiles using
+        `RUN --mount` or `COPY --link`.
     """
 
     options_scope = "sendwave-docker"
@@ -21,7 +130,307 @@ class Docker(Subsystem):
     report_progress = BoolOption(
         "--report-progress",
         default=False,
-        help="If true: the plugin will report output of `docker build`",
+        help=(
+            "If true: the plugin will report output of `docker build`. "
+            "Output is streamed to a log file (in the `sendwave_docker` "
+            "pants named cache) while the build runs, the path of which "
+            "is logged when the build starts, and the last lines of "
+            "output & the status of every build step are logged once it "
+            "completes"
+        ),
+    )
+    batch_requirements = BoolOption(
+        "--batch-requirements",
+        default=False,
+        help=(
+            "If true: write every third-party requirement of an image into "
+            "one requirements file & install them with a single "
+            "`pip install -r`, instead of one `pip install` layer per "
+            "requirement"
+        ),
+    )
+    layers = EnumOption(
+        "--layers",
+        default=LayerStrategy.single,
+        help=(
+            "How source files are copied into the image. `single`: copy "
+            "every file with one `COPY` instruction. `split`: copy "
+            "third-party inputs (e.g. the constraints file), then "
+            "resources & files, then python sources (one layer per "
+            "top-level package), each with their own `COPY` instruction, "
+            "so that changing a file only invalidates the layer it is in. "
+            "`content`: copy the sources & resources of each directory with "
+            "a BUILD file into their own layer, keyed by the digest of its "
+            "contents & copied with `COPY --link`, so that images sharing a "
+            "library share an identical layer in the docker daemon & "
+            "registry (requires BuildKit, & `--sendwave-docker-reproducible` "
+            "for the layers to be byte-identical)"
+        ),
+    )
+    virtual_env = EnumOption(
+        "--virtual-env",
+        default=VirtualEnvBuilder.image,
+        help=(
+            "How third-party python requirements are installed. `image`: "
+            "run `pip install` inside the image during `docker build`. "
+            "`pex`: resolve requirements on the host with the pants python "
+            "backend (using the constraints file or lockfile, "
+            "`[python-repos]` and the pants process cache) into a PEX, "
+            "which is installed as the image's virtual env in a single "
+            "layer. Set `python_platforms` on `docker` targets whose base "
+            "image's interpreter differs from the local interpreter"
+        ),
+    )
+    skip_unchanged = BoolOption(
+        "--skip-unchanged",
+        default=False,
+        help=(
+            "If true: before building an image look for an image in the "
+            "local docker daemon built from an identical Dockerfile & "
+            "build context, and if one exists apply the target's tags to "
+            "it instead of running `docker build`. No metrics or size "
+            "report are written for images which aren't built"
+        ),
+    )
+    buildkit_cache_mounts = BoolOption(
+        "--buildkit-cache-mounts",
+        default=False,
+        help=(
+            "If true: build images with BuildKit, and run pip installs and "
+            "`image_setup_commands` using apt with persistent "
+            "`--mount=type=cache` mounts for pip's download cache and apt's "
+            "package lists & archives, so that invalidated layers only "
+            "download packages which changed"
+        ),
+    )
+    share_base_images = BoolOption(
+        "--share-base-images",
+        default=False,
+        help=(
+            "If true: build the `base_image`, `image_setup_commands` & "
+            "third-party requirements of each image as an intermediate "
+            "image, tagged with a fingerprint of its inputs. Images with "
+            "the same base image, setup commands & requirements are built "
+            "on top of the same intermediate image, which is only built "
+            "once"
+        ),
+    )
+    build_concurrency = IntOption(
+        "--build-concurrency",
+        default=0,
+        help=(
+            "The maximum number of `docker build` processes to run at "
+            "once, across every concurrent pants run on this machine. 0 "
+            "means no limit (beyond pants' own process parallelism)"
+        ),
+    )
+    exclude_tests = BoolOption(
+        "--exclude-tests",
+        default=False,
+        help=(
+            "If true: exclude python test files (`test_*.py`, `*_test.py`, "
+            "`tests.py` & `conftest.py`) from the build context of every "
+            "image, in addition to each target's `docker_ignore` patterns"
+        ),
+    )
+    exclude_bytecode = BoolOption(
+        "--exclude-bytecode",
+        default=False,
+        help=(
+            "If true: exclude `__pycache__` directories and `.pyc` & `.pyo` "
+            "files from the build context of every image, in addition to "
+            "each target's `docker_ignore` patterns"
+        ),
+    )
+    reproducible = BoolOption(
+        "--reproducible",
+        default=False,
+        help=(
+            "If true: build reproducible images, so that identical inputs "
+            "give identical image & layer digests on any machine. Every "
+            "timestamp in the image is set to `--source-date-epoch` "
+            "(with the `docker` backend this requires BuildKit v0.13 or "
+            "later), `SOURCE_DATE_EPOCH` is set for RUN instructions & pip "
+            "doesn't compile bytecode"
+        ),
+    )
+    source_date_epoch = IntOption(
+        "--source-date-epoch",
+        default=0,
+        help=(
+            "The timestamp, in seconds since the unix epoch, of every file "
+            "& the creation time of reproducible images (e.g. the time of "
+            "the last commit: `git log -1 --format=%ct`)"
+        ),
+    )
+    metrics = BoolOption(
+        "--metrics",
+        default=False,
+        help=(
+            "If true: write a JSON report next to the output of each "
+            "image built with docker (`{output_path}.metrics.json` under "
+            "dist/, where `output_path` is the target's, or its path "
+            "without a file ending by default), recording the duration of each phase of the build, "
+            "the size of the build context, the number of layers and the "
+            "duration of each step of `docker build` (with BuildKit)"
+        ),
+    )
+    export_image = BoolOption(
+        "--export-image",
+        default=False,
+        help=(
+            "If true: after building an image with docker, write it to the "
+            "target's `output_path` with `docker save`. The tarball is the "
+            "package's output, so it is cached by pants (locally & "
+            "remotely) and can be consumed by other targets. When the "
+            "tarball comes from the pants cache the image is loaded into "
+            "the docker daemon from it, unless the daemon already has an "
+            "image built from the same inputs. `--skip-unchanged` & "
+            "`--incremental` don't apply to exported images, whose builds "
+            "are skipped by the pants cache instead. Images built with the "
+            "`oci` backend are always written to `output_path`"
+        ),
+    )
+    backend = EnumOption(
+        "--backend",
+        default=BuildBackend.docker,
+        help=(
+            "How images are built. `docker`: run `docker build`. `oci`: "
+            "assemble the image in python, without a docker daemon, into "
+            "an OCI image tarball written to the target's `output_path`. "
+            "The `oci` backend can only build images whose Dockerfile has "
+            "no RUN instructions, and reads base images from "
+            "`--oci-layout`. `--skip-unchanged`, `--share-base-images`, "
+            "`--build-concurrency`, `--export-image` & `--metrics` only "
+            "apply to the `docker` backend"
+        ),
+    )
+    oci_layout = StrOption(
+        "--oci-layout",
+        default=None,
+        help=(
+            "Path, relative to the build root, of an OCI image layout "
+            "(e.g. created with `skopeo copy docker://python:3.8-slim "
+            "oci:base-images:3.8-slim`) holding the base images of "
+            "targets built with the `oci` backend"
+        ),
+    )
+    oci_platform = StrOption(
+        "--oci-platform",
+        default="linux/amd64",
+        help=(
+            "The platform (os/architecture) to use when a base image in "
+            "`--oci-layout` is available for several platforms"
+        ),
+    )
+    collapse_setup = BoolOption(
+        "--collapse-setup",
+        default=False,
+        help=(
+            "If true: chain the `image_setup_commands` of a target with "
+            "`&&` into a single RUN instruction, which then removes the "
+            "package indexes & caches left behind by the package managers "
+            "they use (apt, apk, yum/dnf & pip), so they never end up in a "
+            "layer of the image. Gives fewer & smaller layers, but every "
+            "setup command reruns when any of them changes"
+        ),
+    )
+    pin_base_images = BoolOption(
+        "--pin-base-images",
+        default=False,
+        help=(
+            "If true: resolve the `base_image` & `builder_image` of targets "
+            "to the digest of the manifest they point to, and write "
+            "`FROM image:tag@sha256:...` in the Dockerfile, so that an "
+            "upstream retag doesn't silently change the image (or "
+            "invalidate its cached layers) until the resolved digest "
+            "expires. Resolved digests are cached in the "
+            "`sendwave_docker` pants named cache. Doesn't apply to the "
+            "`oci` backend, whose base images are read from a local layout"
+        ),
+    )
+    base_image_ttl = IntOption(
+        "--base-image-ttl",
+        default=24 * 60 * 60,
+        help=(
+            "How long, in seconds, a base image digest resolved by "
+            "`--pin-base-images` is used before the registry is asked "
+            "again. When the registry can't be reached an expired digest "
+            "is used"
+        ),
+    )
+    base_image_registry = StrOption(
+        "--base-image-registry",
+        default=None,
+        help=(
+            "Resolve every base image against this registry instead of its "
+            "own, e.g. a local registry mirroring the base images "
+            "(`localhost:5000`), to pin base images without reaching "
+            "remote registries. Pinned base images are pulled from this "
+            "registry (e.g. `FROM localhost:5000/library/python:3.8@sha256:"
+            "...`), as the digest is of its copy of the manifest. "
+            "Registries on localhost are reached over HTTP"
+        ),
+    )
+    incremental = BoolOption(
+        "--incremental",
+        default=False,
+        help=(
+            "If true: when only the files an image copies into its working "
+            "directory (python sources, resources & files) changed since "
+            "the last image built from the target, build the new image "
+            "from that one, with a single layer adding the changed files & "
+            "removing the deleted ones, instead of from its Dockerfile. "
+            "The last image built from each target is recorded in the "
+            "`sendwave_docker` pants named cache. Only applies to the "
+            "`docker` backend, and not when images are exported or "
+            "reproducible"
+        ),
+    )
+    max_thin_layers = IntOption(
+        "--max-thin-layers",
+        default=10,
+        help=(
+            "With `--incremental`: the number of layers of changed files "
+            "added on top of an image built from its Dockerfile, after "
+            "which the image is built from its Dockerfile again"
+        ),
+    )
+    push_concurrency = IntOption(
+        "--push-concurrency",
+        default=8,
+        help=(
+            "The maximum number of requests (blob checks, uploads & "
+            "manifests) `docker-push` sends to registries at once, across "
+            "every image it pushes"
+        ),
+    )
+    size_report = BoolOption(
+        "--size-report",
+        default=False,
+        help=(
+            "If true: write a JSON report of the size of images built with "
+            "docker next to the package's output (under dist/), with the "
+            "compressed & uncompressed size & largest files of each layer, "
+            "the part of the target (base image, setup commands, "
+            "third-party requirements or sources) each layer comes from, "
+            "and how much each part grew or shrank since the previous "
+            "report of the target"
+        ),
+    )
+    dockerfile_frontend = StrOption(
+        "--dockerfile-frontend",
+        default=None,
+        help=(
+            "The Dockerfile frontend image declared with a `# syntax=` "
+            "directive by Dockerfiles using `RUN --mount` or `COPY --link` "
+            "(`--sendwave-docker-buildkit-cache-mounts` & the `content` "
+            "layers), for versions of BuildKit whose built-in frontend "
+            "doesn't understand them, e.g. `docker/dockerfile:1.4` or a "
+            "copy of it in a local registry. BuildKit fetches the frontend "
+            "image from its registry to build, so by default none is "
+            "declared and the built-in frontend is used"
+        ),
     )
 
 
@@ -8,6 +8,7 @@ from pants.core.goals.package import (
 )
 from pants.engine.target import (
     COMMON_TARGET_FIELDS,
+    BoolField,
     Dependencies,
     DependenciesRequest,
     DescriptionField,
@@ -30,18 +31,24 @@ class BaseImage(StringField):
     help = "This is used to set the Base Image for all future pants build steps (e.g. python:3.8.8-slim-buster)"
 
 
+class BuilderImage(StringField):
+    alias = "builder_image"
+    required = False
+    help = "If set, setup commands run & third-party python requirements are installed in a separate build stage from this image (e.g. python:3.8.8-buster), and only the resulting virtual env (/.virtual_env) and the image's sources are copied into the image built from base_image. The python interpreter must be at the same path in both images, and libraries needed at runtime must already be in base_image"
+
+
 class DockerIgnore(StringSequenceField):
     alias = "docker_ignore"
     required = False
     default = []
-    help = "A list of directories to exclude from the docker build context, each entry should be a valid line in a .dockerignore file"
+    help = 'A list of files & directories to exclude from the docker build context, each entry should be a valid line in a .dockerignore file (exceptions starting with `!` are not supported), matched against the path of the file in the image (e.g. ["app/fixtures", "**/*.md"])'
 
 
 class ImageSetup(StringSequenceField):
     alias = "image_setup_commands"
     required = False
     default = []
-    help = 'Commands to run in the image during the build process. Each will be evaluated as it\'s own process in the container and will create a new layer in the resulting image (e.g. ["apt-get update && apt-get upgrade --yes", "apt-get -y install gcc libpq-dev"],)'
+    help = 'Commands to run in the image during the build process. Each will be evaluated as it\'s own process in the container and will create a new layer in the resulting image, unless `--sendwave-docker-collapse-setup` is set (e.g. ["apt-get update && apt-get upgrade --yes", "apt-get -y install gcc libpq-dev"],)'
 
 
 class WorkDir(StringField):
@@ -64,6 +71,19 @@ class Tags(StringSequenceField):
     help = 'A list of tags to apply to the resulting docker image (e.g. ["1.0.0", "main"]) '
 
 
+class PythonPlatforms(StringSequenceField):
+    alias = "python_platforms"
+    default = []
+    required = False
+    help = 'The PEX platforms of the base image\'s python interpreter, used to resolve third-party requirements when `--sendwave-docker-virtual-env=pex` (e.g. ["manylinux2014_x86_64-cp-38-cp38"]). Only wheels can be installed for an explicit platform. If empty, requirements are resolved for the local interpreter. With `[python].enable_resolves`, selects the resolve to install from when the lockfile holds one resolve per platform'
+
+
+class PrecompileBytecode(BoolField):
+    alias = "precompile_bytecode"
+    default = False
+    help = "If true, the installed third-party packages & the image's sources are compiled to bytecode while the image is built (with the image's python interpreter & `--invalidation-mode unchecked-hash`, so the bytecode is never recompiled at runtime), each in their own layer. Avoids compiling on the first import when the container starts, and on every start with a read-only root filesystem"
+
+
 class Command(StringSequenceField):
     alias = "command"
     default = []
@@ -77,6 +97,7 @@ class DockerPackageFieldSet(pants.core.goals.package.PackageFieldSet):
     required_fields = (BaseImage,)
 
     base_image: BaseImage
+    builder_image: BuilderImage
     image_setup: ImageSetup
     ignore: DockerIgnore
     registry: Registry
@@ -84,6 +105,8 @@ class DockerPackageFieldSet(pants.core.goals.package.PackageFieldSet):
     dependencies: Dependencies
     workdir: WorkDir
     command: Command
+    python_platforms: PythonPlatforms
+    precompile_bytecode: PrecompileBytecode
     output_path: OutputPathField
 
 
@@ -94,11 +117,16 @@ class Docker(Target):
         DescriptionField,
         Dependencies,
         BaseImage,
+        BuilderImage,
+        DockerIgnore,
         ImageSetup,
         OutputPathField,
         WorkDir,
+        Registry,
         Tags,
         Command,
+        PythonPlatforms,
+        PrecompileBytecode,
     )
 
 
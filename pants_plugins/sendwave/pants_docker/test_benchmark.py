@@ -0,0 +1,40 @@
+from sendwave.pants_docker.benchmark import (
+    PACKAGES,
+    run_benchmark,
+    synthetic_repo,
+)
+
+
+def test_synthetic_repo() -> None:
+    files = synthetic_repo(sources=12, requirements=2, resources=1)
+    assert len([path for path in files if path.endswith(".py")]) == 12
+    assert len([path for path in files if path.endswith(".txt")]) == 1
+    assert len([path for path in files if path.endswith("BUILD")]) == (
+        PACKAGES + 2
+    )
+    assert "resources(" in files["src/pkg0/BUILD"]
+    assert "resources(" not in files["src/pkg1/BUILD"]
+    assert files["3rdparty/BUILD"].count("python_requirement(") == 2
+
+
+def test_run_benchmark() -> None:
+    result = run_benchmark(sources=3, requirements=2, resources=2)
+    assert (result.sources, result.requirements, result.resources) == (3, 2, 2)
+    # the python sources, resources & the Dockerfile
+    assert result.context_files == 6
+    assert result.context_bytes > 0
+    # creating the virtual env, upgrading pip, the two requirements &
+    # copying the sources
+    assert result.layers == 5
+    assert "components" in result.phases
+
+
+def test_run_benchmark_with_options() -> None:
+    result = run_benchmark(
+        sources=3,
+        requirements=0,
+        resources=0,
+        options=["--sendwave-docker-layers=split"],
+    )
+    # one layer per package
+    assert result.layers == 3
@@ -0,0 +1,37 @@
+from pants.backend.python.target_types import (
+    PythonRequirementTarget,
+    PythonSourceTarget,
+    PythonTestTarget,
+)
+from pants.core.target_types import FileTarget
+from pants.engine.addresses import Address
+from sendwave.pants_docker.docker_component import applicable_field_sets
+from sendwave.pants_docker.python_requirement import PythonRequirementsFS
+from sendwave.pants_docker.sources import DockerFilesFS, DockerPythonSourcesFS
+
+
+def test_applicable_field_sets() -> None:
+    source = PythonSourceTarget(
+        {"source": "app.py"}, Address("app", target_name="app")
+    )
+    test = PythonTestTarget(
+        {"source": "app_test.py"}, Address("app", target_name="test")
+    )
+    file = FileTarget({"source": "app.txt"}, Address("app", target_name="txt"))
+    requirement = PythonRequirementTarget(
+        {"requirements": ["flask"]}, Address("3rdparty", target_name="flask")
+    )
+    applicable = applicable_field_sets(
+        [PythonRequirementsFS, DockerPythonSourcesFS, DockerFilesFS],
+        [source, requirement, file, test],
+    )
+    assert applicable == {
+        PythonRequirementsFS: [requirement],
+        DockerPythonSourcesFS: [source, test],
+        DockerFilesFS: [file],
+    }
+    assert list(applicable) == [
+        PythonRequirementsFS,
+        DockerPythonSourcesFS,
+        DockerFilesFS,
+    ]
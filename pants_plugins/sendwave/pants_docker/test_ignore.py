@@ -0,0 +1,20 @@
+import pytest
+from sendwave.pants_docker.ignore import ignore_globs
+
+
+def test_ignore_globs() -> None:
+    assert ignore_globs(
+        ["# comment", "", "/app/fixtures/", "./docs", "**/*.md"]
+    ) == [
+        "!app/fixtures",
+        "!app/fixtures/**",
+        "!docs",
+        "!docs/**",
+        "!**/*.md",
+        "!**/*.md/**",
+    ]
+
+
+def test_ignore_globs_rejects_exceptions() -> None:
+    with pytest.raises(ValueError):
+        ignore_globs(["*.md", "!README.md"])
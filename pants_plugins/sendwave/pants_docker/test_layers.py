@@ -0,0 +1,174 @@
+import pytest
+from pants.engine.fs import CreateDigest, Digest, FileContent, Snapshot
+from pants.testutil.rule_runner import QueryRule, RuleRunner
+from sendwave.pants_docker.layers import (
+    ContextLayers,
+    ContextLayersRequest,
+    _shard_by_package,
+    rules,
+)
+from sendwave.pants_docker.subsystem import LayerStrategy
+
+
+@pytest.fixture
+def rule_runner() -> RuleRunner:
+    return RuleRunner(
+        rules=[
+            *rules(),
+            QueryRule(ContextLayers, [ContextLayersRequest]),
+            QueryRule(Digest, [CreateDigest]),
+            QueryRule(Snapshot, [Digest]),
+        ]
+    )
+
+
+def _digest(rule_runner: RuleRunner, *paths: str) -> Digest:
+    return rule_runner.request(
+        Digest, [CreateDigest([FileContent(path, b"") for path in paths])]
+    )
+
+
+def _layers_request(
+    rule_runner: RuleRunner, strategy: LayerStrategy
+) -> ContextLayersRequest:
+    return ContextLayersRequest(
+        strategy,
+        third_party=(_digest(rule_runner, "constraints.txt"),),
+        resources=(_digest(rule_runner, "app/static/style.css"),),
+        python_sources=(
+            _digest(rule_runner, "app/__init__.py", "app/main.py"),
+            _digest(rule_runner, "lib/util.py", "setup_module.py"),
+        ),
+    )
+
+
+def test_shard_by_package() -> None:
+    assert _shard_by_package(["b/x.py", "a/y/z.py", "mod.py", "a/w.py"]) == {
+        "layers/python/a": ["a/w.py", "a/y/z.py"],
+        "layers/python/b": ["b/x.py"],
+        "layers/python_modules": ["mod.py"],
+    }
+
+
+def test_single_layer(rule_runner: RuleRunner) -> None:
+    request = _layers_request(rule_runner, LayerStrategy.single)
+    layers = rule_runner.request(ContextLayers, [request])
+    assert layers.directories == ("application",)
+    snapshot = rule_runner.request(Snapshot, [layers.digest])
+    assert snapshot.files == (
+        "application/app/__init__.py",
+        "application/app/main.py",
+        "application/app/static/style.css",
+        "application/constraints.txt",
+        "application/lib/util.py",
+        "application/setup_module.py",
+    )
+
+
+def test_split_layers(rule_runner: RuleRunner) -> None:
+    request = _layers_request(rule_runner, LayerStrategy.split)
+    layers = rule_runner.request(ContextLayers, [request])
+    assert layers.directories == (
+        "application",
+        "layers/resources",
+        "layers/python/app",
+        "layers/python/lib",
+        "layers/python_modules",
+    )
+    assert layers.origins == (
+        "third-party files",
+        "resources & files",
+        "python package app",
+        "python package lib",
+        "top-level python modules",
+    )
+    snapshot = rule_runner.request(Snapshot, [layers.digest])
+    assert snapshot.files == (
+        "application/constraints.txt",
+        "layers/python/app/app/__init__.py",
+        "layers/python/app/app/main.py",
+        "layers/python/lib/lib/util.py",
+        "layers/python_modules/setup_module.py",
+        "layers/resources/app/static/style.css",
+    )
+
+
+def test_split_layers_skips_empty_layers(rule_runner: RuleRunner) -> None:
+    request = ContextLayersRequest(
+        LayerStrategy.split,
+        third_party=(),
+        resources=(),
+        python_sources=(_digest(rule_runner, "app/main.py"),),
+    )
+    layers = rule_runner.request(ContextLayers, [request])
+    assert layers.directories == ("layers/python/app",)
+
+
+def test_content_layers(rule_runner: RuleRunner) -> None:
+    lib = _digest(rule_runner, "lib/util.py")
+    request = ContextLayersRequest(
+        LayerStrategy.content,
+        third_party=(_digest(rule_runner, "constraints.txt"),),
+        resources=(_digest(rule_runner, "app/static/style.css"),),
+        python_sources=(_digest(rule_runner, "app/main.py"), lib),
+        resource_groups=("src/app",),
+        python_groups=("src/app", "src/lib"),
+    )
+    layers = rule_runner.request(ContextLayers, [request])
+    # the layer of a group is named after the digest of all its files
+    app = _digest(rule_runner, "app/main.py", "app/static/style.css")
+    assert layers.directories == (
+        "application",
+        f"layers/content/{app.fingerprint}",
+        f"layers/content/{lib.fingerprint}",
+    )
+    assert layers.origins == (
+        "third-party files",
+        "sources of src/app",
+        "sources of src/lib",
+    )
+    snapshot = rule_runner.request(Snapshot, [layers.digest])
+    assert snapshot.files == (
+        "application/constraints.txt",
+        f"layers/content/{app.fingerprint}/app/main.py",
+        f"layers/content/{app.fingerprint}/app/static/style.css",
+        f"layers/content/{lib.fingerprint}/lib/util.py",
+    )
+
+
+def test_content_layers_are_shared(rule_runner: RuleRunner) -> None:
+    def layers(*python_sources: Digest) -> ContextLayers:
+        request = ContextLayersRequest(
+            LayerStrategy.content,
+            third_party=(),
+            resources=(),
+            python_sources=python_sources,
+            python_groups=tuple(f"src/{i}" for i in range(len(python_sources))),
+        )
+        return rule_runner.request(ContextLayers, [request])
+
+    lib = _digest(rule_runner, "lib/util.py")
+    first = layers(_digest(rule_runner, "app/main.py"), lib)
+    second = layers(_digest(rule_runner, "worker/main.py"), lib)
+    assert first.directories[1] == second.directories[1]
+    assert first.directories[0] != second.directories[0]
+
+
+@pytest.mark.parametrize(
+    "strategy",
+    [LayerStrategy.single, LayerStrategy.split, LayerStrategy.content],
+)
+def test_virtual_env_is_staged(
+    rule_runner: RuleRunner, strategy: LayerStrategy
+) -> None:
+    request = ContextLayersRequest(
+        strategy,
+        third_party=(),
+        resources=(),
+        python_sources=(_digest(rule_runner, "app/main.py"),),
+        virtual_env=(_digest(rule_runner, "venv.pex"),),
+    )
+    layers = rule_runner.request(ContextLayers, [request])
+    assert "layers/venv" not in layers.directories
+    snapshot = rule_runner.request(Snapshot, [layers.digest])
+    assert "layers/venv/venv.pex" in snapshot.files
@@ -0,0 +1,77 @@
+import json
+
+from sendwave.pants_docker.metrics import (
+    PhaseTimer,
+    build_report,
+    count_layers,
+    parse_build_steps,
+)
+
+BUILD_OUTPUT = """#1 [internal] load build definition from Dockerfile
+#1 DONE 0.0s
+#5 [2/4] RUN python -m venv /.virtual_env
+#5 CACHED
+#6 [3/4] RUN python -m pip install flask
+#6 0.512 Collecting flask
+#6 DONE 12.4s
+#7 [4/4] COPY application .
+#7 DONE 0.1s
+"""
+
+
+def test_phase_timer() -> None:
+    timer = PhaseTimer()
+    timer.lap("first")
+    timer.lap("second")
+    assert [phase for phase, _ in timer.durations()] == ["first", "second"]
+    assert all(duration >= 0 for _, duration in timer.durations())
+
+
+def test_count_layers() -> None:
+    dockerfile = (
+        "FROM python:3.8\n"
+        "WORKDIR container\n"
+        "RUN apt-get update\n"
+        "COPY application .\n"
+        'CMD ["python"]\n'
+    )
+    assert count_layers(dockerfile) == 2
+
+
+def test_parse_build_steps() -> None:
+    assert parse_build_steps(BUILD_OUTPUT) == [
+        {
+            "step": "load build definition from Dockerfile",
+            "seconds": 0.0,
+            "cached": False,
+        },
+        {
+            "step": "RUN python -m venv /.virtual_env",
+            "seconds": None,
+            "cached": True,
+        },
+        {
+            "step": "RUN python -m pip install flask",
+            "seconds": 12.4,
+            "cached": False,
+        },
+        {"step": "COPY application .", "seconds": 0.1, "cached": False},
+    ]
+
+
+def test_build_report() -> None:
+    report = json.loads(
+        build_report(
+            "src/app:image",
+            "abc",
+            (("docker_build", 1.5),),
+            2048,
+            3,
+            "FROM python:3.8\nCOPY application .\n",
+            BUILD_OUTPUT,
+        )
+    )
+    assert report["phases"] == {"docker_build": 1.5}
+    assert report["context"] == {"bytes": 2048, "files": 3}
+    assert report["layers"] == 1
+    assert len(report["steps"]) == 4
@@ -0,0 +1,382 @@
+import subprocess
+
+from pants.engine.addresses import Address
+from pants.engine.fs import Digest
+from sendwave.pants_docker.package import (
+    _build_tag_argument_list,
+    _component_origin,
+    _create_dockerfile,
+    _create_multistage_dockerfile,
+    _declare_build_arg,
+    _declare_syntax,
+    _fingerprint,
+    _image_path,
+    _instruction_origins,
+    _load_exported_image_command,
+    _report_path,
+    _without_copies,
+)
+from sendwave.pants_docker.sources import DockerPythonSourcesFS
+from sendwave.pants_docker.target import Docker as DockerTarget
+from sendwave.pants_docker.target import DockerPackageFieldSet
+
+
+def test_build_tag_argument_list() -> None:
+    assert _build_tag_argument_list("app", ["1.0"], "registry.io") == [
+        "-t",
+        "registry.io/app:1.0",
+        "-t",
+        "registry.io/app",
+    ]
+
+
+def _field_set(**fields) -> DockerPackageFieldSet:
+    target = DockerTarget(
+        {"base_image": "python:3.8", **fields},
+        Address("src/app", target_name="image"),
+    )
+    return DockerPackageFieldSet.create(target)
+
+
+def test_report_path() -> None:
+    assert _report_path(_field_set(), "metrics.json") == (
+        "src.app/image.metrics.json"
+    )
+    # reports are written next to an explicit output path, not over it
+    field_set = _field_set(output_path="images/app.tar")
+    assert _report_path(field_set, "metrics.json") == (
+        "images/app.tar.metrics.json"
+    )
+    assert _report_path(field_set, "size.json") == "images/app.tar.size.json"
+
+
+def test_image_path() -> None:
+    assert _image_path(_field_set()) == "src.app/image.tar"
+    field_set = _field_set(output_path="images/app.tar")
+    assert _image_path(field_set) == "images/app.tar"
+    # the size report of an exported image never overwrites the tarball
+    # it is read from
+    assert _report_path(field_set, "size.json") != _image_path(field_set)
+
+
+def test_create_dockerfile() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8.8-slim-buster",
+        "root",
+        ["apt-get update"],
+        ["RUN python -m venv /.virtual_env\n"],
+        ["gunicorn", "app:app"],
+    )
+    assert dockerfile == (
+        "FROM python:3.8.8-slim-buster\n"
+        "WORKDIR root\n"
+        "RUN apt-get update\n"
+        "RUN python -m venv /.virtual_env\n"
+        "COPY application .\n"
+        'CMD ["gunicorn","app:app"]\n'
+    )
+
+
+def test_create_dockerfile_copies_each_directory() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8.8-slim-buster",
+        None,
+        [],
+        [],
+        [],
+        ("application", "layers/resources", "layers/python/app"),
+    )
+    assert dockerfile == (
+        "FROM python:3.8.8-slim-buster\n"
+        "COPY application .\n"
+        "COPY layers/resources .\n"
+        "COPY layers/python/app .\n"
+    )
+
+
+def test_create_dockerfile_apt_cache_mounts() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8.8-slim-buster",
+        None,
+        ["apt-get update && apt-get install -y libpq5"],
+        [],
+        [],
+        cache_mounts=True,
+    )
+    assert dockerfile.splitlines()[1].startswith(
+        "RUN rm -f /etc/apt/apt.conf.d/docker-clean"
+    )
+    assert dockerfile.splitlines()[2] == (
+        "RUN --mount=type=cache,target=/var/cache/apt,sharing=locked "
+        "--mount=type=cache,target=/var/lib/apt,sharing=locked "
+        "apt-get update && apt-get install -y libpq5"
+    )
+
+
+def test_create_dockerfile_apt_cache_mounts_only_for_apt() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8.8-slim-buster",
+        None,
+        ["apt-get update", "useradd app"],
+        [],
+        [],
+        cache_mounts=True,
+    )
+    assert dockerfile.splitlines()[2:] == [
+        "RUN --mount=type=cache,target=/var/cache/apt,sharing=locked "
+        "--mount=type=cache,target=/var/lib/apt,sharing=locked "
+        "apt-get update",
+        "RUN useradd app",
+        "COPY application .",
+    ]
+
+
+def test_create_dockerfile_collapse_setup() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8.8-slim-buster",
+        None,
+        ["apt-get update", "apt-get install -y libpq5", "pip install wheel"],
+        [],
+        [],
+        collapse_setup=True,
+    )
+    assert dockerfile == (
+        "FROM python:3.8.8-slim-buster\n"
+        "RUN (apt-get update) && (apt-get install -y libpq5) && "
+        "(pip install wheel) && "
+        "rm -rf /var/lib/apt/lists/* /var/cache/apt/archives/*.deb && "
+        "rm -rf /root/.cache/pip\n"
+        "COPY application .\n"
+    )
+
+
+def test_create_dockerfile_collapse_setup_cache_mounts() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8.8-slim-buster",
+        None,
+        ["apt-get update", "apt-get install -y libpq5"],
+        [],
+        [],
+        cache_mounts=True,
+        collapse_setup=True,
+    )
+    # apt's caches are in the cache mounts, & not removed
+    assert dockerfile.splitlines()[2] == (
+        "RUN --mount=type=cache,target=/var/cache/apt,sharing=locked "
+        "--mount=type=cache,target=/var/lib/apt,sharing=locked "
+        "(apt-get update) && (apt-get install -y libpq5)"
+    )
+
+
+def test_create_dockerfile_collapse_setup_keeps_each_command_apart(
+    tmp_path,
+) -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8",
+        None,
+        ["cd /", "test -e missing || true", "pwd > " + str(tmp_path / "cwd")],
+        [],
+        [],
+        collapse_setup=True,
+    )
+    run = dockerfile.splitlines()[1]
+    assert run == (
+        "RUN (cd /) && (test -e missing || true) && "
+        "(pwd > {})".format(tmp_path / "cwd")
+    )
+    # the `cd` doesn't apply to the commands after it, & `||` only to
+    # the command it is part of
+    subprocess.run(
+        ["sh", "-c", run[len("RUN ") :]], check=True, cwd=str(tmp_path)
+    )
+    assert (tmp_path / "cwd").read_text().strip() == str(tmp_path)
+
+
+def test_create_multistage_dockerfile() -> None:
+    dockerfile = _create_multistage_dockerfile(
+        "python:3.8.8-buster",
+        "python:3.8.8-slim-buster",
+        "container",
+        ["apt-get install -y gcc"],
+        ["RUN python -m venv /.virtual_env\n"],
+        [],
+        ["python", "app.py"],
+    )
+    assert dockerfile == (
+        "FROM python:3.8.8-buster AS builder\n"
+        "WORKDIR container\n"
+        "RUN apt-get install -y gcc\n"
+        "RUN python -m venv /.virtual_env\n"
+        "FROM python:3.8.8-slim-buster\n"
+        "WORKDIR container\n"
+        "COPY --from=builder /.virtual_env /.virtual_env\n"
+        "ENV PATH=/.virtual_env/bin:$PATH\n"
+        "ENV VIRTUAL_ENV=/.virtual_env\n"
+        "COPY application .\n"
+        'CMD ["python","app.py"]\n'
+    )
+
+
+def test_create_dockerfile_compile_sources() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8",
+        "container",
+        [],
+        [],
+        ["gunicorn", "app:app"],
+        compile_sources=True,
+    )
+    assert dockerfile == (
+        "FROM python:3.8\n"
+        "WORKDIR container\n"
+        "COPY application .\n"
+        "RUN python -m compileall -q --invalidation-mode unchecked-hash .\n"
+        'CMD ["gunicorn","app:app"]\n'
+    )
+
+
+def test_create_dockerfile_link_copies() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8",
+        None,
+        [],
+        [],
+        [],
+        ("application", "layers/content/abc"),
+        link_copies=True,
+    )
+    assert dockerfile == (
+        "FROM python:3.8\n"
+        "COPY --link application .\n"
+        "COPY --link layers/content/abc .\n"
+    )
+
+
+def test_declare_build_arg() -> None:
+    dockerfile = (
+        "FROM python:3.8 AS builder\n"
+        "RUN pip wheel .\n"
+        "FROM python:3.8-slim\n"
+        "COPY application .\n"
+    )
+    assert _declare_build_arg(dockerfile, "SOURCE_DATE_EPOCH", "0") == (
+        "FROM python:3.8 AS builder\n"
+        "ARG SOURCE_DATE_EPOCH=0\n"
+        "RUN pip wheel .\n"
+        "FROM python:3.8-slim\n"
+        "ARG SOURCE_DATE_EPOCH=0\n"
+        "COPY application .\n"
+    )
+
+
+def test_declare_syntax() -> None:
+    frontend = "localhost:5000/docker/dockerfile:1.4"
+    linked = _create_dockerfile(
+        "python:3.8", None, [], [], [], link_copies=True
+    )
+    assert _declare_syntax(linked, frontend) == (
+        "# syntax=localhost:5000/docker/dockerfile:1.4\n"
+        "FROM python:3.8\n"
+        "COPY --link application .\n"
+    )
+    assert _declare_syntax(linked, None) == linked
+    mounted = _create_dockerfile(
+        "python:3.8", None, ["apt-get update"], [], [], cache_mounts=True
+    )
+    assert _declare_syntax(mounted, frontend).startswith(
+        f"# syntax={frontend}\nFROM python:3.8\n"
+    )
+    plain = _create_dockerfile("python:3.8", None, ["apt-get update"], [], [])
+    assert _declare_syntax(plain, frontend) == plain
+
+
+def test_fingerprint() -> None:
+    context = Digest("a" * 64, 100)
+    other_context = Digest("b" * 64, 100)
+    assert _fingerprint("FROM python", context) == _fingerprint(
+        "FROM python", context
+    )
+    assert _fingerprint("FROM python", context) != _fingerprint(
+        "FROM python", other_context
+    )
+    assert _fingerprint("FROM python", context) != _fingerprint(
+        "FROM python:3.8", context
+    )
+
+
+def test_without_copies() -> None:
+    dockerfile = _create_dockerfile(
+        "python:3.8",
+        "/app",
+        [],
+        ["RUN pip install flask\n"],
+        ["python", "main.py"],
+        ["application", "layers/resources"],
+        link_copies=True,
+    )
+    assert _without_copies(dockerfile, ["application", "layers/resources"]) == (
+        "FROM python:3.8\n"
+        "WORKDIR /app\n"
+        "RUN pip install flask\n"
+        'CMD ["python","main.py"]\n'
+    )
+
+
+def test_instruction_origins() -> None:
+    origins = dict(
+        _instruction_origins(
+            [
+                (
+                    "RUN pip install flask\n",
+                    _component_origin(None, ""),
+                ),
+                (
+                    "RUN echo sources\n",
+                    _component_origin(DockerPythonSourcesFS, "src/app"),
+                ),
+            ],
+            ["apt-get update"],
+            ["application"],
+            ["sources & third-party files"],
+        )
+    )
+    assert origins["RUN pip install flask"] == "third-party requirements"
+    assert origins["RUN echo sources"] == "python sources (src/app)"
+    assert origins["RUN apt-get update"] == "image_setup_commands"
+    assert origins["COPY application ."] == "sources & third-party files"
+    assert (
+        origins["COPY --from=builder /.virtual_env /.virtual_env"]
+        == "third-party requirements (builder_image)"
+    )
+
+
+def _fake_docker(tmp_path, images: str) -> str:
+    """A docker executable logging its arguments, which has `images`."""
+    docker = tmp_path / "docker"
+    docker.write_text(
+        "#!/bin/sh\n"
+        f'echo "$@" >> {tmp_path}/calls\n'
+        f'if [ "$1" = image ]; then printf "{images}"; fi\n'
+    )
+    docker.chmod(0o755)
+    return str(docker)
+
+
+def test_load_exported_image_command_tags_existing_image(tmp_path) -> None:
+    docker = _fake_docker(tmp_path, "sha256:abc\\nsha256:def\\n")
+    command = _load_exported_image_command(
+        docker, "f" * 64, ["app:1.0", "app"], "app/image.tar"
+    )
+    subprocess.run(["bash", "-c", command], check=True)
+    calls = (tmp_path / "calls").read_text().splitlines()
+    assert calls[1:] == ["tag sha256:abc app:1.0", "tag sha256:abc app"]
+
+
+def test_load_exported_image_command_loads_tarball(tmp_path) -> None:
+    docker = _fake_docker(tmp_path, "")
+    command = _load_exported_image_command(
+        docker, "f" * 64, ["app"], "app/image.tar"
+    )
+    subprocess.run(["bash", "-c", command], check=True)
+    calls = (tmp_path / "calls").read_text().splitlines()
+    assert calls[1:] == ["load --input app/image.tar"]
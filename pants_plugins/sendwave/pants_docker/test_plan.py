@@ -0,0 +1,52 @@
+from sendwave.pants_docker.plan import (
+    ContextFile,
+    copied_directories,
+    plan_report,
+)
+
+DOCKERFILE = (
+    "FROM python:3.8\n"
+    "WORKDIR /app\n"
+    "COPY application/constraints.txt /tmp/constraints.txt\n"
+    "RUN pip install flask\n"
+    "COPY --from=builder /.virtual_env /.virtual_env\n"
+    "COPY --link application .\n"
+    "COPY --link layers/resources .\n"
+    'CMD ["python","main.py"]\n'
+)
+
+
+def test_copied_directories() -> None:
+    assert copied_directories(DOCKERFILE) == (
+        "application/constraints.txt",
+        "application",
+        "layers/resources",
+    )
+
+
+def test_plan_report() -> None:
+    report = plan_report(
+        "app:image",
+        "abc",
+        DOCKERFILE,
+        [
+            ContextFile("layers/resources/data.txt", 5, "d2"),
+            ContextFile("Dockerfile", 10, "d0"),
+            ContextFile("application/main.py", 20, "d1"),
+            ContextFile("application/constraints.txt", 3, "d3"),
+        ],
+    )
+    assert report["layers"] == 5
+    assert report["context_bytes"] == 38
+    assert report["context_files"] == 4
+    assert report["copied_bytes"] == {
+        "application/constraints.txt": 3,
+        "application": 23,
+        "layers/resources": 5,
+    }
+    assert [f["path"] for f in report["files"]] == [
+        "Dockerfile",
+        "application/constraints.txt",
+        "application/main.py",
+        "layers/resources/data.txt",
+    ]
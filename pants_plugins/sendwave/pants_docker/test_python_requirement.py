@@ -1,13 +1,39 @@
+import json
+
 import pytest
-from pants.engine.fs import Digest, PathGlobs
+from pants.backend.python.subsystems.repos import PythonRepos
+from pants.backend.python.subsystems.setup import PythonSetup
+from pants.backend.python.util_rules.pex import Pex, PexPlatforms
+from pants.backend.python.util_rules.pex_from_targets import (
+    PexFromTargetsRequest,
+)
+from pants.engine.addresses import Address
+from pants.engine.fs import EMPTY_DIGEST, Digest, DigestContents, PathGlobs
 from pants.engine.internals.scheduler import ExecutionError
-from pants.testutil.rule_runner import QueryRule, RuleRunner
+from pants.engine.rules import SubsystemRule
+from pants.testutil.rule_runner import (
+    MockGet,
+    QueryRule,
+    RuleRunner,
+    run_rule_with_mocks,
+)
 from sendwave.pants_docker.docker_component import DockerComponent
+from sendwave.pants_docker.package import _create_dockerfile
 from sendwave.pants_docker.python_requirement import (
+    VIRTUAL_ENV_PEX,
+    PexVirtualEnvRequest,
+    RequirementsFileRequest,
     VirtualEnvRequest,
+    _lockfile_requirements,
+    create_lockfile_virtual_env,
+    create_pex_virtual_env,
+    create_requirements_file,
     create_virtual_env,
     rules,
 )
+from sendwave.pants_docker.subsystem import Docker
+from sendwave.pants_docker.target import Docker as DockerTarget
+from sendwave.pants_docker.target import DockerPackageFieldSet
 
 
 @pytest.fixture
@@ -15,14 +41,188 @@ def rule_runner():
     runner = RuleRunner(
         rules=[
             create_virtual_env,
+            create_lockfile_virtual_env,
+            SubsystemRule(PythonSetup),
+            SubsystemRule(PythonRepos),
             QueryRule(DockerComponent, [VirtualEnvRequest]),
+            QueryRule(DigestContents, [Digest]),
         ]
     )
-    runner.write_files({"faux_constraints.txt": "pytest==1"})
+    runner.write_files(
+        {
+            "faux_constraints.txt": "pytest==1",
+            "faux_lockfile.lock": PEX_LOCKFILE,
+        }
+    )
     return runner
 
 
-def test_enable_resolve_execution_errors(rule_runner):
+PEX_LOCKFILE = """// This lockfile was autogenerated by Pants.
+//
+// --- BEGIN PANTS LOCKFILE METADATA: DO NOT EDIT OR REMOVE ---
+// {"version": 3}
+// --- END PANTS LOCKFILE METADATA ---
+{
+  "locked_resolves": [
+    {
+      "locked_requirements": [
+        {
+          "artifacts": [{"algorithm": "sha256", "hash": "aaa", "url": "a"}],
+          "project_name": "Flask",
+          "requires_dists": ["Werkzeug>=2.0", "click>=7.1.2"],
+          "version": "2.0.3"
+        },
+        {
+          "artifacts": [
+            {"algorithm": "sha256", "hash": "ccc", "url": "c"},
+            {"algorithm": "sha256", "hash": "ddd", "url": "d"}
+          ],
+          "project_name": "click",
+          "requires_dists": ["colorama; platform_system == 'Windows'"],
+          "version": "8.0.4"
+        },
+        {
+          "artifacts": [{"algorithm": "sha256", "hash": "www", "url": "w"}],
+          "project_name": "werkzeug",
+          "requires_dists": [],
+          "version": "2.0.3"
+        },
+        {
+          "artifacts": [{"algorithm": "sha256", "hash": "ppp", "url": "p"}],
+          "project_name": "pytest",
+          "requires_dists": [],
+          "version": "7.1.2"
+        }
+      ],
+      "platform_tag": null
+    }
+  ]
+}
+"""
+
+
+def test_lockfile_requirements_subset():
+    assert _lockfile_requirements(PEX_LOCKFILE, ["flask>=2"]) == (
+        "click==8.0.4 \\\n"
+        "    --hash=sha256:ccc \\\n"
+        "    --hash=sha256:ddd\n"
+        "flask==2.0.3 \\\n"
+        "    --hash=sha256:aaa\n"
+        "werkzeug==2.0.3 \\\n"
+        "    --hash=sha256:www\n"
+    )
+
+
+def _locked(name, version, requires_dists=()):
+    return {
+        "artifacts": [{"algorithm": "sha256", "hash": name, "url": name}],
+        "project_name": name,
+        "requires_dists": list(requires_dists),
+        "version": version,
+    }
+
+
+def _pex_lockfile(*resolves) -> str:
+    return json.dumps(
+        {
+            "locked_resolves": [
+                {"locked_requirements": requirements, "platform_tag": tag}
+                for tag, requirements in resolves
+            ]
+        }
+    )
+
+
+def test_lockfile_requirements_markers_and_extras():
+    lockfile = _pex_lockfile(
+        (
+            None,
+            [
+                _locked(
+                    "app",
+                    "1.0",
+                    [
+                        "colorama; sys_platform == 'win32'",
+                        "typing-extensions; python_version < '3.8'",
+                        "uvloop; extra == 'fast'",
+                        "pytest; extra == 'test'",
+                        "pytest; extra == 'test' or extra == 'dev'",
+                        "mypy; python_version >= '3.8' and extra == 'test'",
+                        "attrs; 'fast' == extra and python_version < '3.8'",
+                        "click",
+                    ],
+                ),
+                _locked(
+                    "click", "8.0", ["colorama; platform_system == 'Windows'"]
+                ),
+                _locked("colorama", "0.4"),
+                _locked("typing-extensions", "4.0"),
+                _locked("uvloop", "0.16"),
+                _locked("pytest", "7.0"),
+                _locked("mypy", "1.0"),
+                _locked("attrs", "22.1"),
+            ],
+        )
+    )
+    assert _lockfile_requirements(lockfile, ["app[fast]"]) == (
+        "app==1.0 \\\n    --hash=sha256:app\n"
+        'attrs==22.1 ; python_version < "3.8" \\\n'
+        "    --hash=sha256:attrs\n"
+        "click==8.0 \\\n    --hash=sha256:click\n"
+        'colorama==0.4 ; platform_system == "Windows" or '
+        'sys_platform == "win32" \\\n    --hash=sha256:colorama\n'
+        'typing-extensions==4.0 ; python_version < "3.8" \\\n'
+        "    --hash=sha256:typing-extensions\n"
+        "uvloop==0.16 \\\n    --hash=sha256:uvloop\n"
+    )
+    requirements = _lockfile_requirements(lockfile, ["app"])
+    for name in ("attrs", "mypy", "pytest", "uvloop"):
+        assert name not in requirements
+
+
+def test_lockfile_requirements_missing_requirement():
+    lockfile = _pex_lockfile(
+        (
+            None,
+            [
+                _locked("app", "1.0", ["pywin32; sys_platform == 'win32'"]),
+                _locked("worker", "1.0", ["celery"]),
+            ],
+        )
+    )
+    # dependencies needed under markers are left out of the lockfile of
+    # platforms they don't apply to
+    assert _lockfile_requirements(lockfile, ["app"]).startswith("app==1.0 ")
+    with pytest.raises(ValueError, match="generate-lockfiles"):
+        _lockfile_requirements(lockfile, ["app", "flask"])
+    with pytest.raises(ValueError, match="celery"):
+        _lockfile_requirements(lockfile, ["worker"])
+
+
+def test_lockfile_requirements_platform_resolves():
+    lockfile = _pex_lockfile(
+        (["cp38", "cp38", "manylinux_2_17_x86_64"], [_locked("app", "1.0")]),
+        (["cp38", "cp38", "macosx_11_0_arm64"], [_locked("app", "1.1")]),
+    )
+    assert _lockfile_requirements(
+        lockfile, ["app"], ["manylinux2014_x86_64-cp-38-cp38"]
+    ).startswith("app==1.0 ")
+    with pytest.raises(ValueError, match="python_platforms"):
+        _lockfile_requirements(lockfile, ["app"])
+
+
+def test_lockfile_requirements_pip_lockfile():
+    lockfile = (
+        "# This lockfile was autogenerated by Pants.\n"
+        "pytest==7.1.2 \\\n"
+        "    --hash=sha256:ppp\n"
+    )
+    assert _lockfile_requirements(lockfile, ["pytest"]) == (
+        "pytest==7.1.2 \\\n    --hash=sha256:ppp\n"
+    )
+
+
+def test_enable_resolve_requires_lockfile(rule_runner):
     request = VirtualEnvRequest(
         enable_resolves=True, requirement_constraints=None
     )
@@ -30,6 +230,26 @@ def test_enable_resolve_execution_errors(rule_runner):
         rule_runner.request(DockerComponent, [request])
 
 
+def test_enable_resolve_installs_from_lockfile(rule_runner):
+    request = VirtualEnvRequest(
+        enable_resolves=True,
+        requirement_constraints=None,
+        lockfile="faux_lockfile.lock",
+        requirements=("pytest",),
+    )
+    result = rule_runner.request(DockerComponent, [request])
+    assert (
+        result.commands[0] == "COPY application/pants_docker_lockfile.txt .\n"
+    )
+    assert result.commands[-1].endswith(
+        " --no-deps --require-hashes -r pants_docker_lockfile.txt\n"
+    )
+    # pip isn't upgraded from the index, unpinned & without hashes
+    assert not any("--upgrade pip" in command for command in result.commands)
+    contents = rule_runner.request(DigestContents, [result.sources])
+    assert contents[0].content == b"pytest==7.1.2 \\\n    --hash=sha256:ppp\n"
+
+
 def test_gets_constraints_execution_error_does_not_exist(rule_runner):
     request = VirtualEnvRequest(
         enable_resolves=False, requirement_constraints="fake_constraints.txt"
@@ -52,6 +272,27 @@ def test_create_virtual_env_no_constraints(rule_runner):
     assert result.sources is None
 
 
+def test_create_virtual_env_cache_mounts(rule_runner):
+    request = VirtualEnvRequest(
+        enable_resolves=False, requirement_constraints=None, cache_mounts=True
+    )
+    result = rule_runner.request(DockerComponent, [request])
+    assert result.commands[-1] == (
+        "RUN --mount=type=cache,target=/root/.cache/pip "
+        "python -m pip install --upgrade pip\n"
+    )
+
+
+def test_create_virtual_env_reproducible(rule_runner):
+    request = VirtualEnvRequest(
+        enable_resolves=False, requirement_constraints=None, reproducible=True
+    )
+    result = rule_runner.request(DockerComponent, [request])
+    assert result.commands[-1] == (
+        "RUN python -m pip install --no-compile --upgrade pip\n"
+    )
+
+
 def test_create_virtual_env_with_constraints(rule_runner):
     request = VirtualEnvRequest(
         enable_resolves=False, requirement_constraints="faux_constraints.txt"
@@ -65,3 +306,113 @@ def test_create_virtual_env_with_constraints(rule_runner):
         "RUN python -m pip install --upgrade pip -c faux_constraints.txt\n",
     )
     assert isinstance(result.sources, Digest)
+
+
+@pytest.fixture
+def requirements_rule_runner():
+    return RuleRunner(
+        rules=[
+            create_requirements_file,
+            SubsystemRule(PythonSetup),
+            SubsystemRule(PythonRepos),
+            SubsystemRule(Docker),
+            QueryRule(DockerComponent, [RequirementsFileRequest]),
+            QueryRule(DigestContents, [Digest]),
+        ]
+    )
+
+
+def test_create_requirements_file(requirements_rule_runner):
+    request = RequirementsFileRequest(("flask==2.0.3", "gunicorn==20.1.0"))
+    result = requirements_rule_runner.request(DockerComponent, [request])
+    assert result.commands[0] == (
+        "COPY application/pants_docker_requirements.txt .\n"
+    )
+    assert result.commands[1].startswith("RUN python -m pip install ")
+    assert result.commands[1].endswith(" -r pants_docker_requirements.txt\n")
+    contents = requirements_rule_runner.request(
+        DigestContents, [result.sources]
+    )
+    assert contents[0].path == "pants_docker_requirements.txt"
+    assert contents[0].content == b"flask==2.0.3\ngunicorn==20.1.0\n"
+
+
+PLATFORM = "manylinux2014_x86_64-cp-38-cp38"
+
+
+def _pex_virtual_env(request: PexVirtualEnvRequest):
+    """Run create_pex_virtual_env, returning the component & the request
+    the PEX was resolved with."""
+    pex_requests = []
+
+    def resolve(pex_request: PexFromTargetsRequest) -> Pex:
+        pex_requests.append(pex_request)
+        return Pex(EMPTY_DIGEST, VIRTUAL_ENV_PEX, None)
+
+    component = run_rule_with_mocks(
+        create_pex_virtual_env,
+        rule_args=[request],
+        mock_gets=[
+            MockGet(
+                output_type=Pex,
+                input_type=PexFromTargetsRequest,
+                mock=resolve,
+            )
+        ],
+    )
+    return component, pex_requests[0]
+
+
+def test_python_platforms_reach_pex_request():
+    target = DockerTarget(
+        {"base_image": "python:3.8-slim", "python_platforms": [PLATFORM]},
+        Address("app", target_name="image"),
+    )
+    field_set = DockerPackageFieldSet.create(target)
+    _, pex_request = _pex_virtual_env(
+        PexVirtualEnvRequest(
+            (Address("3rdparty", target_name="flask"),),
+            tuple(field_set.python_platforms.value),
+        )
+    )
+    assert pex_request.platforms == PexPlatforms((PLATFORM,))
+    assert pex_request.addresses == (Address("3rdparty", target_name="flask"),)
+
+
+def test_pex_virtual_env_dockerfile():
+    component, pex_request = _pex_virtual_env(
+        PexVirtualEnvRequest((Address("3rdparty", target_name="flask"),), ())
+    )
+    assert pex_request.platforms == PexPlatforms(())
+    assert _create_dockerfile(
+        "python:3.8-slim", "/app", [], component.commands, ["python", "app.py"]
+    ) == (
+        "FROM python:3.8-slim\n"
+        "WORKDIR /app\n"
+        "COPY layers/venv/pants_docker_venv.pex /tmp/pants_docker_venv.pex\n"
+        "RUN PEX_TOOLS=1 python /tmp/pants_docker_venv.pex venv /.virtual_env "
+        "&& rm /tmp/pants_docker_venv.pex\n"
+        "ENV PATH=/.virtual_env/bin:$PATH\n"
+        "ENV VIRTUAL_ENV=/.virtual_env\n"
+        "COPY application .\n"
+        'CMD ["python","app.py"]\n'
+    )
+
+
+def test_pex_virtual_env_dockerfile_cache_mounts():
+    component, _ = _pex_virtual_env(
+        PexVirtualEnvRequest(
+            (Address("3rdparty", target_name="flask"),), (), cache_mounts=True
+        )
+    )
+    assert _create_dockerfile(
+        "python:3.8-slim", None, [], component.commands, []
+    ) == (
+        "FROM python:3.8-slim\n"
+        "RUN --mount=type=bind,source=layers/venv/pants_docker_venv.pex,"
+        "target=/tmp/pants_docker_venv.pex "
+        "PEX_TOOLS=1 python /tmp/pants_docker_venv.pex venv /.virtual_env\n"
+        "ENV PATH=/.virtual_env/bin:$PATH\n"
+        "ENV VIRTUAL_ENV=/.virtual_env\n"
+        "COPY application .\n"
+    )
@@ -15,6 +15,7 @@ from sendwave.pants_docker.sources import (
     DockerPythonSourcesFS,
     DockerRelocatedFilesFS,
     DockerResourcesFS,
+    SourcesBatchRequest,
     rules,
 )
 
@@ -35,6 +36,7 @@ def rule_runner() -> RuleRunner:
             QueryRule(DockerComponent, [DockerFilesFS]),
             QueryRule(DockerComponent, [DockerResourcesFS]),
             QueryRule(DockerComponent, [DockerRelocatedFilesFS]),
+            QueryRule(DockerComponent, [SourcesBatchRequest]),
         ],
     )
     return rule_runner
@@ -83,3 +85,19 @@ def test_get_resources(sources_runner: RuleRunner) -> None:
     x = sources_runner.request(DockerComponent, [DockerResourcesFS.create(t)])
     snap = sources_runner.request(Snapshot, [x.sources])
     assert snap.files == ("app/resources.txt",)
+
+
+def test_get_sources_batch(sources_runner: RuleRunner) -> None:
+    file = sources_runner.get_target(address=Address("app", target_name="file"))
+    resource = sources_runner.get_target(
+        address=Address("app", target_name="resources")
+    )
+    request = SourcesBatchRequest(
+        (
+            DockerFilesFS.create(file).sources,
+            DockerResourcesFS.create(resource).sources,
+        )
+    )
+    x = sources_runner.request(DockerComponent, [request])
+    snap = sources_runner.request(Snapshot, [x.sources])
+    assert snap.files == ("app/resources.txt", "app/test.txt")
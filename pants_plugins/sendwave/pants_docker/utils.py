@@ -17,3 +17,22 @@ DOCKER_ENV_VARS = [
     "HTTPS_PROXY",
     "NO_PROXY",
 ]
+
+# label applied to every built image, holding a fingerprint of the
+# Dockerfile & build context the image was built from
+FINGERPRINT_LABEL = "com.sendwave.pants-docker.fingerprint"
+
+# BuildKit cache mounts which persist pip's download cache, and apt's
+# package archives & lists, between builds
+PIP_CACHE_MOUNT = "--mount=type=cache,target=/root/.cache/pip"
+APT_CACHE_MOUNTS = (
+    "--mount=type=cache,target=/var/cache/apt,sharing=locked "
+    "--mount=type=cache,target=/var/lib/apt,sharing=locked"
+)
+# debian based images delete downloaded packages after each install,
+# keep them in the cache mount instead
+APT_KEEP_CACHE = (
+    "RUN rm -f /etc/apt/apt.conf.d/docker-clean && echo "
+    "'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' "
+    "> /etc/apt/apt.conf.d/keep-cache\n"
+)